@@ -92,6 +92,7 @@ function AnthropicHandler:query(message_history, anthropic_settings)
         return nil, "Error: Failed to parse Anthropic API response"
     end
 
+    self.last_usage = self.normalizeUsage(parsed)
     local content = extract_text_from_content(parsed.content)
     if type(content) ~= "string" or #content == 0 then
         content = koutil.tableGetValue(parsed, "content", 1, "text")
@@ -29,7 +29,12 @@ function AzureOpenAIHandler:query(message_history, azure_settings )
         stream = azure_settings.stream or false,
         temperature = azure_settings.temperature or 0.7
     }
-    
+
+    if requestBodyTable.stream then
+        -- the token usage comes in a last chunk of its own
+        requestBodyTable.stream_options = { include_usage = true }
+    end
+
     local requestBody = json.encode(requestBodyTable)
     local headers = {
         ["Content-Type"] = "application/json",
@@ -48,6 +53,7 @@ function AzureOpenAIHandler:query(message_history, azure_settings )
     if status then
         local success, responseData = pcall(json.decode, response)
         if success then
+            self.last_usage = self.normalizeUsage(responseData)
             local content = koutil.tableGetValue(responseData, "choices", 1, "message", "content")
             if content then return content end
         end
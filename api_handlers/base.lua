@@ -12,11 +12,13 @@ local ffiutil = require("ffi/util")
 
 local BaseHandler = {
     trap_widget = nil,  -- widget to trap the request
+    last_usage = nil,   -- token usage of the last response (see normalizeUsage)
 }
 
 BaseHandler.CODE_CANCELLED = "USER_CANCELED"
 BaseHandler.CODE_NETWORK_ERROR = "NETWORK_ERROR"
 BaseHandler.PROTOCOL_NON_200 = "X-NON-200-STATUS:"
+BaseHandler.PROTOCOL_TRACE = "X-TRACE:"
 
 function BaseHandler:new(o)
     o = o or {}
@@ -34,6 +36,7 @@ function BaseHandler:resetTrapWidget()
 end
 
 --- Query method to be implemented by specific handlers
+--- Handlers leave the token usage of a non-streamed response in self.last_usage
 --- @param message_history table: conversation history, a list of messages
 --- @param provider_setting table: settings for the specific provider
 --- @return string response_content, string error_message
@@ -42,6 +45,102 @@ function BaseHandler:query(message_history, provider_setting)
     error("query method must be implemented")
 end
 
+local function count(t, key)
+    local value = type(t) == "table" and t[key]
+    return type(value) == "number" and value or nil
+end
+
+--- Token usage reported by a provider, in the same shape for every API:
+--- prompt_tokens (all input, cached input included), completion_tokens (all output,
+--- reasoning included), reasoning_tokens, cached_tokens and total_tokens.
+--- Understands OpenAI compatible `usage` (and Groq's `x_groq.usage`), Anthropic `usage`,
+--- Gemini `usageMetadata` and the eval counts of Ollama
+--- @param data table decoded response or stream event
+--- @return table usage, nil if data reports none
+function BaseHandler.normalizeUsage(data)
+    if type(data) ~= "table" then return nil end
+    local usage
+    local reported = data.usage or (type(data.x_groq) == "table" and data.x_groq.usage)
+    if type(reported) == "table" and (count(reported, "input_tokens") or count(reported, "output_tokens")) then
+        -- Anthropic: input_tokens leaves out the input read from or written to the cache
+        local cached = count(reported, "cache_read_input_tokens") or 0
+        usage = {
+            prompt_tokens = (count(reported, "input_tokens") or 0) + cached
+                + (count(reported, "cache_creation_input_tokens") or 0),
+            completion_tokens = count(reported, "output_tokens") or 0,
+            cached_tokens = cached,
+        }
+    elseif type(reported) == "table" and (count(reported, "prompt_tokens") or count(reported, "completion_tokens")) then
+        usage = {
+            prompt_tokens = count(reported, "prompt_tokens") or 0,
+            completion_tokens = count(reported, "completion_tokens") or 0,
+            reasoning_tokens = count(reported.completion_tokens_details, "reasoning_tokens"),
+            cached_tokens = count(reported.prompt_tokens_details, "cached_tokens")
+                or count(reported, "prompt_cache_hit_tokens"), -- DeepSeek
+        }
+    elseif type(data.usageMetadata) == "table" then
+        -- Gemini counts thinking apart from the answer, both are billed as output
+        local metadata = data.usageMetadata
+        local thoughts = count(metadata, "thoughtsTokenCount")
+        usage = {
+            prompt_tokens = count(metadata, "promptTokenCount") or 0,
+            completion_tokens = (count(metadata, "candidatesTokenCount") or 0) + (thoughts or 0),
+            reasoning_tokens = thoughts,
+            cached_tokens = count(metadata, "cachedContentTokenCount"),
+        }
+    elseif count(data, "prompt_eval_count") or count(data, "eval_count") then
+        usage = {
+            prompt_tokens = count(data, "prompt_eval_count") or 0,
+            completion_tokens = count(data, "eval_count") or 0,
+        }
+    end
+    if usage then
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    end
+    return usage
+end
+
+--- Combine usage reported in parts over a stream (Anthropic sends the input counts
+--- first and the output count last, others repeat running totals): the largest
+--- count of every field wins
+--- @return table usage, nil if neither reports any
+function BaseHandler.mergeUsage(usage, more)
+    if not more then return usage end
+    if not usage then return more end
+    local merged = {}
+    for _, key in ipairs({"prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens"}) do
+        local a, b = usage[key], more[key]
+        merged[key] = (a and b) and math.max(a, b) or a or b
+    end
+    merged.total_tokens = merged.prompt_tokens + merged.completion_tokens
+    return merged
+end
+
+--- Wrap a ltn12 source and sink to record request timings in marks:
+--- connected (request headers sent, so DNS, connect and TLS are done),
+--- sent (body uploaded) and first_byte (first chunk of the response body; LuaSocket
+--- reads the status line and headers before it, so this includes them).
+--- on_mark(name) is called for every new mark, if given
+local function timeRequest(source, sink, marks, on_mark)
+    local function mark(name)
+        if not marks[name] then
+            marks[name] = socket.gettime()
+            if on_mark then on_mark(name) end
+        end
+    end
+    local timed_source = function()
+        mark("connected")
+        local chunk, err = source()
+        if chunk == nil then mark("sent") end
+        return chunk, err
+    end
+    local timed_sink = function(chunk, err)
+        if chunk then mark("first_byte") end
+        return sink(chunk, err)
+    end
+    return timed_source, timed_sink
+end
+
 --- Post URL content with optional headers and body with timeout setting
 --- code references: KOReader/frontend/ui/wikipedia.lua `getURLContent`
 --- @param url any
@@ -49,8 +148,9 @@ end
 --- @param body any
 --- @param timeout any blocking timtout
 --- @param maxtime any total response finished max time
+--- @param marks table optional, filled with request timings (see timeRequest)
 --- @return boolean success, string status_code, string content
-local function postURLContent(url, headers, body, timeout, maxtime)
+local function postURLContent(url, headers, body, timeout, maxtime, marks)
     if string.sub(url, 1, 8) == "https://" then
         https.cert_verify = false  -- disable CA verify
     end
@@ -64,8 +164,13 @@ local function postURLContent(url, headers, body, timeout, maxtime)
         source = ltn12.source.string(body or ""),
         sink = maxtime and socketutil.table_sink(sink) or ltn12.sink.table(sink),
     }
+    if marks then
+        marks.started = socket.gettime()
+        request.source, request.sink = timeRequest(request.source, request.sink, marks)
+    end
     local code, headers, status = socket.skip(1, http.request(request)) -- skip the first return value, not needed
     socketutil:reset_timeout()
+    if marks then marks.done = socket.gettime() end
     local content = table.concat(sink)  -- response body
 
     -- check for timeouts
@@ -94,8 +199,10 @@ local function postURLContent(url, headers, body, timeout, maxtime)
 end
 
 --- func description: Make a request to the specified URL with headers and body.
+--- Timings of the request are left in self.request_marks (see timeRequest)
 function BaseHandler:makeRequest(url, headers, body, timeout, maxtime)
-    local completed, success, code, content
+    local completed, success, code, content, marks
+    local spawned = socket.gettime()
     if self.trap_widget then
         -- Use larger timeout and maxtime when running a large book analysis
         local request_timeout, request_maxtime
@@ -107,18 +214,28 @@ function BaseHandler:makeRequest(url, headers, body, timeout, maxtime)
             request_maxtime = maxtime or 120
         end
         -- If a trap widget is set, run the request in a subprocess
-        completed, success, code, content = Trapper:dismissableRunInSubprocess(function()
-                return postURLContent(url, headers, body, request_timeout, request_maxtime)
+        -- the subprocess returns its timings as a 4th value
+        completed, success, code, content, marks = Trapper:dismissableRunInSubprocess(function()
+                local child_marks = {}
+                local ok, status_code, response = postURLContent(url, headers, body, request_timeout,
+                    request_maxtime, child_marks)
+                return ok, status_code, response, child_marks
             end, self.trap_widget)
         if not completed then
+            self.request_marks = nil
             return false, self.CODE_CANCELLED, self.CODE_CANCELLED
         end
     else
         -- If no trap widget is set, run the request directly
         -- use smaller timeout because we are blocking the UI
-        success, code, content = postURLContent(url, headers, body, timeout or 20, maxtime or 45)
+        marks = {}
+        success, code, content = postURLContent(url, headers, body, timeout or 20, maxtime or 45, marks)
     end
 
+    if type(marks) == "table" then
+        marks.spawned = spawned
+    end
+    self.request_marks = marks
     return success, code, content
 end
 
@@ -152,15 +269,27 @@ function BaseHandler:backgroundRequest(url, headers, body)
             return
         end
 
+        -- request timings go through the pipe too, each on a line of its own
+        -- (the first_byte mark is written before the first body chunk)
+        local function writeMark(name, time)
+            ffiutil.writeToFD(child_write_fd, string.format("\n%s %s %.6f\n", self.PROTOCOL_TRACE, name, time))
+        end
+        local marks = {}
+        writeMark("started", socket.gettime())
+
         local pipe_w = wrap_fd(child_write_fd)  -- wrap the write end of the pipe
         local request = {
             url = url,
             method = "POST",
             headers = headers or {},
-            source = ltn12.source.string(body or ""),
-            sink = ltn12.sink.file(pipe_w),  -- response body write to pipe
         }
+        request.source, request.sink = timeRequest(
+            ltn12.source.string(body or ""),
+            ltn12.sink.file(pipe_w),  -- response body write to pipe
+            marks,
+            function(name) writeMark(name, marks[name]) end)
         local code, headers, status = socket.skip(1, http.request(request)) -- skip the first return value
+        writeMark("done", socket.gettime())
         if code ~= 200 then -- non-200 response code, write error to pipe
             logger.warn("Background request non-200:", code, "status:", status, "url:", url)
             ffiutil.writeToFD(child_write_fd, string.format("\r\n%s [%s %s] URL:%s\n\n", self.PROTOCOL_NON_200, status or "", code or "", url))  -- write end of response
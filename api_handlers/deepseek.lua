@@ -19,6 +19,11 @@ function DeepSeekHandler:query(message_history, deepseek_settings)
         max_tokens = koutil.tableGetValue(deepseek_settings, "additional_parameters", "max_tokens")
     }
 
+    if requestBodyTable.stream then
+        -- the token usage comes in a last chunk of its own
+        requestBodyTable.stream_options = { include_usage = true }
+    end
+
     local requestBody = json.encode(requestBodyTable)
     local headers = {
         ["Content-Type"] = "application/json",
@@ -60,6 +65,7 @@ function DeepSeekHandler:query(message_history, deepseek_settings)
         return nil, "Error: Failed to parse DeepSeek API response: " .. response
     end
     
+    self.last_usage = self.normalizeUsage(parsed)
     local content = koutil.tableGetValue(parsed, "choices", 1, "message", "content")
     if content then return content end
 
@@ -106,6 +106,7 @@ function GeminiHandler:query(message_history, gemini_settings)
         return nil,"Error: Failed to parse Gemini API response"
     end
     
+    self.last_usage = self.normalizeUsage(parsed)
     local content = koutil.tableGetValue(parsed, "candidates", 1, "content", "parts", 1, "text")
     if content then return content end
 
@@ -22,6 +22,11 @@ function groqHandler:query(message_history, groq_settings)
         end
     end
 
+    if requestBodyTable.stream then
+        -- the token usage comes in a last chunk of its own
+        requestBodyTable.stream_options = { include_usage = true }
+    end
+
     local requestBody = json.encode(requestBodyTable)
     local headers = {
         ["Content-Type"] = "application/json",
@@ -38,6 +43,7 @@ function groqHandler:query(message_history, groq_settings)
     if status then
         local success, responseData = pcall(json.decode, response)
         if success then
+            self.last_usage = self.normalizeUsage(responseData)
             local content = koutil.tableGetValue(responseData, "choices", 1, "message", "content")
             if content then return content end
         end
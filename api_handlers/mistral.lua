@@ -40,6 +40,7 @@ function MistralHandler:query(message_history, mistral_settings)
     if status then
         local success, responseData = pcall(json.decode, response)
         if success then
+            self.last_usage = self.normalizeUsage(responseData)
             local content = koutil.tableGetValue(responseData, "choices", 1, "message", "content")
             if content then return content end
         end
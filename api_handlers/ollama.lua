@@ -47,6 +47,7 @@ function OllamaHandler:query(message_history, ollama_settings)
         return nil, "Error: Failed to parse Ollama API response"
     end
 
+    self.last_usage = self.normalizeUsage(parsed)
     local content = koutil.tableGetValue(parsed, "message", "content")
     if content then return content end
 
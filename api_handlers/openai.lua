@@ -14,6 +14,11 @@ function OpenAIHandler:query(message_history, openai_settings)
         stream = koutil.tableGetValue(openai_settings, "additional_parameters", "stream") or false,
     }
 
+    if requestBodyTable.stream then
+        -- the token usage comes in a last chunk of its own
+        requestBodyTable.stream_options = { include_usage = true }
+    end
+
     local requestBody = json.encode(requestBodyTable)
     local headers = {
         ["Content-Type"] = "application/json",
@@ -32,6 +37,7 @@ function OpenAIHandler:query(message_history, openai_settings)
     if status then
         local success, responseData = pcall(json.decode, response)
         if success then
+            self.last_usage = self.normalizeUsage(responseData)
             local content = koutil.tableGetValue(responseData, "choices", 1, "message", "content")
             if content then return content end
         end
@@ -49,6 +49,7 @@ function OpenRouterProvider:query(message_history, openrouter_settings)
     if status then
         local success, responseData = pcall(json.decode, response)
         if success then
+            self.last_usage = self.normalizeUsage(responseData)
             local content = koutil.tableGetValue(responseData, "choices", 1, "message", "content")
             if content then return content end
         end
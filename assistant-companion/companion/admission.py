@@ -0,0 +1,167 @@
+"""
+Admission control for reporter events
+Every device has a token bucket: an event costs one token, and tokens
+come back at a steady rate up to a burst size. While a device is within
+its budget everything is admitted unchanged. When it is not, events are
+handled by priority class:
+
+- critical (query start/end, errors) are always admitted in order; they
+  may borrow up to a burst of tokens
+- stream chunks are coalesced, a run of chunks becomes one event
+- heartbeats are shed, a late heartbeat carries no information
+- anything else waits for a token
+
+Events that do not fit are deferred: the request is answered with 429
+and a Retry-After delay, and the device keeps them in its spool. A
+device always sends in order, so everything after the first deferred
+event is deferred too.
+"""
+
+import math
+import os
+import threading
+import time
+
+# Events per second and burst size per device; a rate of 0 admits everything
+DEFAULT_RATE = float(os.environ.get('COMPANION_RATE', 50))
+DEFAULT_BURST = float(os.environ.get('COMPANION_BURST', 400))
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+COALESCE = 'coalesce'
+SHED = 'shed'
+
+PRIORITIES = {
+    'query_start': CRITICAL,
+    'query_complete': CRITICAL,
+    'error': CRITICAL,
+    'stream_chunk': COALESCE,
+    'heartbeat': SHED,
+}
+
+# Plan actions for the events of a request
+KEEP = 'keep'      # store as sent
+MERGE = 'merge'    # append to the previous kept stream chunk
+DROP = 'drop'      # shed
+DEFER = 'defer'    # not admitted, the device resends it later
+
+
+class TokenBucket:
+    """Tokens refilled at rate per second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, floor=0.0):
+        """Take one token if that leaves at least floor"""
+        if self.tokens - 1 < floor:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        """Seconds until the next token"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Admission:
+    """Token buckets of all devices, and what was done to their events"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._counts = {}  # device -> counts of merged, shed and deferred events
+
+    def plan(self, device, event_types):
+        """
+        Decide what happens to the events of one request, in order
+        Returns an action per event (KEEP, MERGE, DROP or DEFER) and the
+        seconds the device should wait before resending deferred events
+        """
+        if self.rate <= 0:
+            return [KEEP] * len(event_types), None
+
+        with self._lock:
+            bucket = self._buckets.get(device)
+            if bucket is None:
+                bucket = self._buckets[device] = TokenBucket(self.rate, self.burst)
+            bucket.refill()
+
+            # Within budget: nothing to decide
+            if bucket.tokens >= len(event_types):
+                bucket.tokens -= len(event_types)
+                return [KEEP] * len(event_types), None
+
+            actions = []
+            chunk_run = False  # the previous kept event is a stream chunk
+            for i, event_type in enumerate(event_types):
+                priority = PRIORITIES.get(event_type, NORMAL)
+                if priority == SHED:
+                    actions.append(DROP)
+                    continue
+                if priority == COALESCE and chunk_run:
+                    actions.append(MERGE)
+                    continue
+                if not bucket.take(-self.burst if priority == CRITICAL else 0.0):
+                    actions.extend([DEFER] * (len(event_types) - i))
+                    break
+                actions.append(KEEP)
+                chunk_run = priority == COALESCE
+
+            counts = self._counts.setdefault(device, {MERGE: 0, DROP: 0, DEFER: 0})
+            for action in actions:
+                if action != KEEP:
+                    counts[action] += 1
+            retry_after = max(1, math.ceil(bucket.wait())) if DEFER in actions else None
+        return actions, retry_after
+
+    def stats(self, device):
+        """Tokens left and events merged, shed and deferred, None for unknown devices"""
+        with self._lock:
+            bucket = self._buckets.get(device)
+            if bucket is None:
+                return None
+            counts = self._counts.get(device, {})
+            return {
+                'tokens': round(bucket.tokens, 1),
+                'merged': counts.get(MERGE, 0),
+                'shed': counts.get(DROP, 0),
+                'deferred': counts.get(DEFER, 0),
+            }
+
+
+def apply_plan(events, actions):
+    """
+    Events to store under a plan: merged stream chunks are appended to the
+    chunk before them. Returns those events and how many of the given
+    events were handled (everything before the first deferred one)
+    """
+    kept = []
+    handled = 0
+    for event, action in zip(events, actions):
+        if action == DEFER:
+            break
+        handled += 1
+        if action == KEEP:
+            kept.append(event)
+        elif action == MERGE and kept:
+            _merge_chunk(kept[-1], event)
+    return kept, handled
+
+
+def _merge_chunk(chunk, event):
+    data = chunk.setdefault('data', {})
+    more = event.get('data') or {}
+    if isinstance(data, dict) and isinstance(more, dict):
+        data['content'] = (data.get('content') or '') + (more.get('content') or '')
+        data['coalesced'] = data.get('coalesced', 1) + more.get('coalesced', 1)
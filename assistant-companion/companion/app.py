@@ -6,23 +6,66 @@ Receives and displays real-time events from the Kindle plugin
 
 from flask import Flask, render_template, request, Response, jsonify
 from datetime import datetime
+import argparse
 import json
 import logging
-from collections import deque
+import os
+import signal
+import time
+
+from admission import apply_plan
+from backend import Backend
+from costs import KINDS as COST_KINDS
+from eventlog import start_event_log
+from export import COLUMNS, FORMATS, MIMETYPES, default_format, event_rows, export, parse_time, query_rows
+from querylog import SEARCH_FIELDS
+from rollups import RESOLUTIONS
+from wire import (WireError, ACCEPTED_FORMATS, MIN_COMPRESS_SIZE, decode_body, decode_event,
+                  accepts_gzip, gzip_bytes, gzip_stream)
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%H:%M:%S'
-)
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+LOG_DATEFMT = '%H:%M:%S'
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Received events are logged from a background thread, sampled per type;
+# every other log line (werkzeug's request log too) goes through that thread
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+event_logger = start_event_log('companion.events', _console)
+
 app = Flask(__name__)
 
-# In-memory event storage (max 1000 events)
-events = deque(maxlen=1000)
-connected_clients = 0
+# Persistent data (query log, search index) lives outside the package
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.environ.get('COMPANION_DATA_DIR', os.path.join(BASE_DIR, 'instance'))
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# In-memory events (max 1000 per device) and the searchable query log;
+# opened by __main__ when run as a script, where pre-fork mode puts a
+# proxy to the broker process in its place instead
+backend = None if __name__ == '__main__' else Backend(DATA_DIR)
+QUERY_DB = os.path.join(DATA_DIR, 'queries.db')
+
+
+def _read_payload():
+    """
+    Decode the request body: Content-Encoding (gzip/deflate) first,
+    then JSON or MessagePack depending on Content-Type
+    """
+    body = decode_body(request.get_data(), request.headers.get('Content-Encoding'))
+    if not body:
+        return None
+    return decode_event(body, request.headers.get('Content-Type'))
+
+
+@app.after_request
+def advertise_formats(response):
+    """Tell reporters which event encodings they may switch to"""
+    if request.path in ('/events', '/events/batch'):
+        response.headers['X-Companion-Accept'] = ACCEPTED_FORMATS
+    return response
 
 
 @app.route('/')
@@ -31,117 +74,363 @@ def index():
     return render_template('dashboard.html')
 
 
+def _is_event(event):
+    """Whether a decoded body is an event object, its data an object if present"""
+    return isinstance(event, dict) and isinstance(event.get('data') or {}, dict)
+
+
+def _store_events(batch):
+    """
+    Add server-side fields to events and store them, one backend call per request
+    Returns the events' sequence numbers, None for events the device resent
+    """
+    received = time.time()
+    received_at = datetime.fromtimestamp(received).isoformat()
+    items = []
+    for event in batch:
+        event['received_at'] = received_at
+        # Encoded once here, every dashboard stream reuses it
+        items.append((event, json.dumps(event)))
+    return [seq for seq, _ in backend.ingest(items, received)]
+
+
+def _admit(batch):
+    """
+    Run the events of a request through the device's admission control
+    Returns the events to store, how many of the given events were handled
+    and the Retry-After delay for the rest (None if all were handled)
+    """
+    device = batch[0].get('device') if batch else None
+    actions, retry_after = backend.admit(device or 'unknown', [event.get('event') for event in batch])
+    kept, handled = apply_plan(batch, actions)
+    return kept, handled, retry_after
+
+
+def _too_many(body, retry_after):
+    """429 answer telling the device when to send the deferred events again"""
+    response = jsonify(body)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _use_backend(client):
+    """Set up a pre-fork worker with the broker's backend (eventlog restarts its log thread)"""
+    global backend
+    backend = client
+
+
+def _log_event(data):
+    """Queue an event for the console log, formatting happens off the request path"""
+    event_logger.info('event', extra={'event': data})
+
+
 @app.route('/events', methods=['POST'])
 def receive_event():
     """Receive events from Kindle plugin"""
     try:
-        data = request.json
+        try:
+            data = _read_payload()
+        except WireError as e:
+            return jsonify({'error': str(e)}), e.status
         if not data:
             return jsonify({'error': 'No data provided'}), 400
+        if not _is_event(data):
+            return jsonify({'error': 'Event must be an object with object data'}), 400
         
-        # Add server-side timestamp
-        data['received_at'] = datetime.now().isoformat()
+        kept, handled, retry_after = _admit([data])
+        if not handled:
+            return _too_many({'status': 'deferred'}, retry_after)
+        if not kept:
+            return jsonify({'status': 'shed'}), 200
         
-        # Store event
-        events.append(data)
+        event_id = _store_events(kept)[0]
+        if event_id is None:
+            return jsonify({'status': 'duplicate'}), 200
+        _log_event(data)
         
-        # Log to console with color coding
-        event_type = data.get('event', 'unknown')
-        event_color = {
-            'query_start': '\033[92m',      # Green
-            'stream_chunk': '\033[94m',     # Blue
-            'query_complete': '\033[93m',   # Yellow
-            'error': '\033[91m',            # Red
-            'heartbeat': '\033[90m',        # Gray
-        }.get(event_type, '\033[0m')
+        return jsonify({'status': 'ok', 'event_id': event_id}), 200
         
-        reset_color = '\033[0m'
+    except Exception as e:
+        logger.error(f"Error processing event: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/events/batch', methods=['POST'])
+def receive_batch():
+    """Receive events the Kindle spooled while the companion was unreachable"""
+    try:
+        try:
+            data = _read_payload()
+        except WireError as e:
+            return jsonify({'error': str(e)}), e.status
+        batch = data.get('events') if isinstance(data, dict) else data
+        if not isinstance(batch, list) or not all(_is_event(e) for e in batch):
+            return jsonify({'error': 'Batch must be a list of event objects with object data'}), 400
         
-        logger.info(f"{event_color}[{event_type}]{reset_color} Received from Kindle")
+        # Under load stream chunks are merged and heartbeats shed; events the
+        # device's budget does not cover are left in its spool (handled says
+        # how many of the batch the device can drop)
+        kept, handled, retry_after = _admit(batch)
+        accepted = 0
+        for event, seq in zip(kept, _store_events(kept) if kept else []):
+            if seq is not None:
+                _log_event(event)
+                accepted += 1
         
-        # Log details based on event type
-        if event_type == 'query_start':
-            provider = data.get('data', {}).get('provider', 'unknown')
-            model = data.get('data', {}).get('model', 'unknown')
-            logger.info(f"  Provider: {provider}, Model: {model}")
-        elif event_type == 'stream_chunk':
-            content = data.get('data', {}).get('content', '')
-            if content:
-                preview = content[:50] + ('...' if len(content) > 50 else '')
-                logger.info(f"  Content: {preview}")
-        elif event_type == 'error':
-            error_msg = data.get('data', {}).get('message', 'Unknown error')
-            logger.error(f"  Error: {error_msg}")
+        duplicates = len(kept) - accepted
+        device = batch[0].get('device', 'unknown') if batch else 'unknown'
+        logger.info(f"Caught up {accepted} spooled events from {device}"
+                    + (f" ({duplicates} duplicates dropped)" if duplicates else '')
+                    + (f" ({handled - len(kept)} merged or shed)" if handled > len(kept) else '')
+                    + (f" ({len(batch) - handled} deferred)" if retry_after else ''))
         
-        return jsonify({'status': 'ok', 'event_id': len(events)}), 200
+        body = {'status': 'ok', 'accepted': accepted, 'duplicates': duplicates, 'handled': handled}
+        if retry_after:
+            body['status'] = 'deferred'
+            return _too_many(body, retry_after)
+        return jsonify(body), 200
         
     except Exception as e:
-        logger.error(f"Error processing event: {e}")
+        logger.error(f"Error processing batch: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/time', methods=['POST'])
+def clock_exchange():
+    """
+    NTP-style clock exchange with a device
+    The body carries the device id and the (t0, t1, t2, t3) samples of its
+    earlier exchanges; the answer has this request's receive (t1) and
+    send (t2) server times, and the device's current clock estimate
+    """
+    t1 = time.time()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    samples = data.get('samples')
+    estimate = None
+    if isinstance(samples, list) and samples:
+        estimate = backend.sync_clock(data.get('device'), samples)
+    return jsonify({'t1': t1, 't2': time.time(), 'estimate': estimate})
+
+
 @app.route('/stream')
 def stream():
-    """Server-Sent Events stream for real-time updates"""
+    """Server-Sent Events stream for real-time updates (?device= for one device)"""
+    device = request.args.get('device') or None
+    
     def generate():
-        global connected_clients
-        connected_clients += 1
-        logger.info(f"Client connected (total: {connected_clients})")
+        logger.info(f"Client connected (total: {backend.client_connected(1)})")
         
-        # Send all existing events first
-        for event in events:
-            yield f"data: {json.dumps(event)}\n\n"
-        
-        # Keep connection alive and send new events
-        last_id = len(events)
+        # Events are sent in batches (one write, and one compression
+        # flush, per poll) instead of one write per event. The cursors
+        # hold the last sequence number sent for every device.
         try:
+            # Send all existing events first
+            text, cursors = backend.stream(device, {})
+            yield text
+            
+            # Keep connection alive and send new events
             while True:
-                if len(events) > last_id:
-                    for event in list(events)[last_id:]:
-                        yield f"data: {json.dumps(event)}\n\n"
-                    last_id = len(events)
+                text, cursors = backend.stream(device, cursors)
+                if text:
+                    yield text
                 # Small delay to avoid busy-waiting
-                import time
                 time.sleep(0.1)
-        except GeneratorExit:
-            connected_clients -= 1
-            logger.info(f"Client disconnected (remaining: {connected_clients})")
+        finally:
+            logger.info(f"Client disconnected (remaining: {backend.client_connected(-1)})")
     
-    return Response(generate(), mimetype='text/event-stream')
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}
+    body = generate()
+    if accepts_gzip(request.headers.get('Accept-Encoding')):
+        headers['Content-Encoding'] = 'gzip'
+        body = gzip_stream(body)
+    return Response(body, mimetype='text/event-stream', headers=headers)
 
 
 @app.route('/api/events', methods=['GET'])
 def get_events():
-    """Get all events as JSON (for debugging)"""
-    return jsonify({
+    """Get all events as JSON (for debugging, ?device= for one device)"""
+    events = backend.events(request.args.get('device') or None)
+    response = jsonify({
         'total': len(events),
-        'events': list(events)
+        'events': events
     })
+    response.headers['Vary'] = 'Accept-Encoding'
+    body = response.get_data()
+    if len(body) >= MIN_COMPRESS_SIZE and accepts_gzip(request.headers.get('Accept-Encoding')):
+        response.set_data(gzip_bytes(body))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 @app.route('/api/clear', methods=['POST'])
 def clear_events():
     """Clear all events"""
-    events.clear()
+    backend.clear()
     logger.info("Event history cleared")
     return jsonify({'status': 'cleared'})
 
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    """Get statistics about events"""
-    event_types = {}
-    for event in events:
-        event_type = event.get('event', 'unknown')
-        event_types[event_type] = event_types.get(event_type, 0) + 1
+    """Get statistics about events (?device= for one device)"""
+    device = request.args.get('device') or None
+    stats = backend.stats(device)
+    if stats is None:
+        return jsonify({'error': 'Unknown device'}), 404
+    return jsonify(stats)
+
+
+@app.route('/api/clocks', methods=['GET'])
+def get_clocks():
+    """Clock offset, drift and accuracy of every device that synced its clock"""
+    return jsonify({'devices': backend.clock_estimates()})
+
+
+@app.route('/api/search', methods=['GET'])
+def search_queries():
+    """Full-text search over past prompts and responses"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Missing search text (q)'}), 400
     
-    return jsonify({
-        'total_events': len(events),
-        'connected_clients': connected_clients,
-        'event_types': event_types,
-        'oldest_event': events[0].get('received_at') if events else None,
-        'newest_event': events[-1].get('received_at') if events else None,
-    })
+    fields = [f for f in request.args.get('type', '').split(',') if f]
+    unknown = [f for f in fields if f not in SEARCH_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown type: {', '.join(unknown)}"}), 400
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    started = time.perf_counter()
+    result = backend.search(
+        q,
+        fields=fields,
+        provider=request.args.get('provider') or None,
+        model=request.args.get('model') or None,
+        limit=limit,
+        offset=offset,
+    )
+    result['took_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return jsonify(result)
+
+
+@app.route('/api/queries/<int:query_id>', methods=['GET'])
+def get_query(query_id):
+    """Get one stored query with its full prompt and response"""
+    query = backend.get_query(query_id)
+    if query is None:
+        return jsonify({'error': 'Query not found'}), 404
+    return jsonify(query)
+
+
+@app.route('/api/queries/<int:query_id>/trace', methods=['GET'])
+def get_trace(query_id):
+    """Waterfall of one query's on-device spans (request phases, parsing, rendering)"""
+    trace = backend.trace(query_id)
+    if trace is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    return jsonify(trace)
+
+
+@app.route('/api/render-timings', methods=['GET'])
+def get_render_timings():
+    """
+    Viewer render times by render mode (incremental, full, plain) and
+    answer size (?since= as unix time, device)
+    """
+    return jsonify({'timings': backend.render_timings(request.args.get('since', type=float),
+                                                      request.args.get('device') or None)})
+
+
+@app.route('/api/costs', methods=['GET'])
+def get_costs():
+    """
+    Token usage and cost of completed queries, totalled per provider,
+    model, book or day (?by=provider|model|book|day, limit)
+    """
+    kind = request.args.get('by', 'provider')
+    if kind not in COST_KINDS:
+        return jsonify({'error': f"Unknown grouping, use one of: {', '.join(COST_KINDS)}"}), 400
+    return jsonify(dict(backend.cost_totals(kind, request.args.get('limit', type=int)), by=kind))
+
+
+@app.route('/api/costs/prices', methods=['GET'])
+def get_prices():
+    """The price table costs are computed with (per million tokens)"""
+    return jsonify({'prices': backend.prices()})
+
+
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    """
+    Latency regressions per provider and model, newest first
+    (?status=active for the open ones only, limit)
+    """
+    return jsonify({'alerts': backend.alerts(request.args.get('status') == 'active',
+                                             request.args.get('limit', type=int))})
+
+
+@app.route('/api/rollups', methods=['GET'])
+def get_rollups():
+    """
+    Per-minute or per-hour aggregates of past queries
+    (?resolution=minute|hour&since=&until= as unix times, provider, model,
+    group=total to merge providers and models)
+    """
+    resolution = RESOLUTIONS.get(request.args.get('resolution', 'hour'))
+    if resolution is None:
+        return jsonify({'error': f"Unknown resolution, use one of: {', '.join(RESOLUTIONS)}"}), 400
+    
+    # Default windows: the last 6 hours by minute, the last 7 days by hour
+    now = time.time()
+    since = request.args.get('since', now - resolution * (360 if resolution == 60 else 168), type=float)
+    until = request.args.get('until', type=float)
+    
+    buckets = backend.rollup(
+        resolution,
+        since,
+        until,
+        provider=request.args.get('provider') or None,
+        model=request.args.get('model') or None,
+        total=request.args.get('group') == 'total',
+    )
+    return jsonify({'resolution': resolution, 'buckets': buckets})
+
+
+@app.route('/api/export/<kind>', methods=['GET'])
+def export_rows(kind):
+    """
+    Stream query summaries or stored events as Parquet (if pyarrow is
+    installed) or CSV (?format=parquet|csv, since, until as unix or ISO
+    times, provider, model, device for events)
+    """
+    if kind not in COLUMNS:
+        return jsonify({'error': f"Unknown export, use one of: {', '.join(COLUMNS)}"}), 404
+    fmt = request.args.get('format') or default_format()
+    if fmt not in FORMATS:
+        return jsonify({'error': f"Unknown format, use one of: {', '.join(FORMATS)}"}), 400
+    
+    filters = {
+        'provider': request.args.get('provider') or None,
+        'model': request.args.get('model') or None,
+    }
+    try:
+        filters['since'] = parse_time(request.args.get('since'))
+        filters['until'] = parse_time(request.args.get('until'))
+        if kind == 'queries':
+            rows = query_rows(QUERY_DB, **filters)
+        else:
+            rows = event_rows(backend.events(request.args.get('device') or None), QUERY_DB, **filters)
+        body = export(kind, rows, fmt)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    filename = f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}"
+    return Response(body, mimetype=MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 
 @app.route('/health')
@@ -150,11 +439,22 @@ def health():
     return jsonify({
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
-        'events_count': len(events)
+        'events_count': backend.count(),
+        'devices': backend.devices()
     })
 
 
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KOReader AI Assistant Companion App')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('COMPANION_WORKERS', 1)),
+                        help='worker processes sharing one event store (default: 1, threaded)')
+    args = parser.parse_args()
+    
     print("\n" + "="*60)
     print("🚀 KOReader AI Assistant Companion App")
     print("="*60)
@@ -164,9 +464,25 @@ if __name__ == '__main__':
     print("\nPress Ctrl+C to stop\n")
     print("="*60 + "\n")
     
-    app.run(
-        host='0.0.0.0',
-        port=8080,
-        debug=False,
-        threaded=True
-    )
+    if args.workers > 1:
+        from prefork import serve
+        # Only the broker process opens the backend
+        serve(app, '0.0.0.0', args.port, args.workers, DATA_DIR, _use_backend)
+    else:
+        backend = Backend(DATA_DIR)
+        # SIGTERM stops the server like Ctrl+C, so the final snapshot is written
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            app.run(
+                host='0.0.0.0',
+                port=args.port,
+                debug=False,
+                threaded=True
+            )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Another signal must not cut the shutdown short
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            backend.close()
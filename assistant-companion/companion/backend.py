@@ -0,0 +1,266 @@
+"""
+Storage backend of the companion app
+The event store and the query log behind one interface. A single-process
+companion calls it directly; in pre-fork mode (see prefork.py) one
+instance lives in the broker process and workers call it through a
+broker connection, so arguments and results are plain picklable values
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from admission import Admission
+from clock import ClockSync
+from costs import PRICES_FILE, Costs
+from querylog import QueryLog
+from regressions import Regressions
+from rollups import Rollups
+from snapshot import Snapshots
+from store import EventStore
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    """Sequence assignment, storage and search for all devices"""
+
+    def __init__(self, data_dir):
+        self.store = EventStore()
+        self.clocks = ClockSync()
+        self.admission = Admission()
+        db_path = os.path.join(data_dir, 'queries.db')
+        self.costs = Costs(db_path, PRICES_FILE or os.path.join(data_dir, 'prices.json'))
+        self.query_log = QueryLog(db_path, self.costs)
+        self.rollups = Rollups(self.query_log.path)
+        self.rollups.start()
+        self.regressions = Regressions()
+        self._clients = 0
+        self._clients_lock = threading.Lock()
+        # In-memory state survives restarts: last snapshot plus tail log
+        self.snapshots = Snapshots(data_dir)
+        self._restore()
+        self.snapshots.start(self.snapshot)
+
+    def admit(self, device, event_types):
+        """Admission plan for the events of one request (see admission.py)"""
+        return self.admission.plan(device, event_types)
+
+    def ingest(self, items, received):
+        """
+        Store decoded events
+        items are (event, json) pairs: the worker that decoded an event
+        also encodes it once for every dashboard stream. Returns a
+        (seq, query_id) pair per event, seq is None for resent events
+        """
+        results = []
+        for event, encoded in items:
+            device = event.get('device')
+            partition = self.store.partition(device, create=True)
+            with partition.ingest_lock:
+                results.append(self._ingest_one(partition, event, encoded, received))
+        self.snapshots.flush()
+        return results
+
+    def _ingest_one(self, partition, event, encoded, received):
+        device = event.get('device')
+        if not partition.claim(event.get('seq')):
+            return None, None
+        try:
+            seq, query_id = self._store_one(partition, event, encoded, received)
+        except BaseException:
+            # Not stored: the device keeps it spooled, its resend must get through
+            partition.release(event.get('seq'))
+            raise
+
+        # Latency regressions raised or resolved by the query go out on the same stream
+        if event.get('event') == 'query_complete' and query_id is not None:
+            for alert in self._observe(device, query_id):
+                self._append(partition, {
+                    'event': 'regression',
+                    'device': device,
+                    'timestamp': received,
+                    'received_at': datetime.fromtimestamp(received).isoformat(),
+                    'data': alert,
+                })
+        return seq, query_id
+
+    def _store_one(self, partition, event, encoded, received):
+        """Add server-side fields to a claimed event and store it; returns (seq, query_id)"""
+        device = event.get('device')
+
+        # Device timestamps in server time, once the device's clock is
+        # known; transit is the time spent on the network and in the spool
+        added = {}
+        reencode = False
+        event_time = self.clocks.to_server(device, event.get('timestamp'))
+        if event_time is not None:
+            added['server_time'] = event_time
+            added['transit_ms'] = round((received - event_time) * 1000, 1)
+            reencode = self._normalize_spans(device, event)
+
+        # Assemble queries for the search index
+        query_id = self.query_log.ingest(event, event_time or received)
+        if query_id is not None:
+            added['query_id'] = query_id
+
+        if added:
+            event.update(added)
+            if reencode:
+                # Moved span times are inside the data, the encoding has to be redone
+                encoded = json.dumps(event)
+            else:
+                encoded = encoded[:-1] + ''.join(f', "{k}": {json.dumps(v)}' for k, v in added.items()) + '}'
+        return self._append(partition, event, encoded), query_id
+
+    def _append(self, partition, event, encoded=None):
+        """Store an event in a partition and the snapshot tail; returns its sequence number"""
+        if encoded is None:
+            encoded = json.dumps(event)
+        seq = partition.append(event, f"data: {encoded}\n\n")
+        self.snapshots.log_event(seq, encoded)
+        return seq
+
+    def _observe(self, device, query_id):
+        """Add a completed query to the latency sketches; returns the alerts it changed"""
+        query = self.query_log.timings(query_id)
+        return self.regressions.observe(device, query) if query else []
+
+    def _normalize_spans(self, device, event):
+        """Move the spans of a trace event to server time; returns whether any moved"""
+        if event.get('event') != 'trace' or not isinstance(event.get('data'), dict):
+            return False
+        moved = False
+        for span in event['data'].get('spans') or []:
+            start = span.get('start') if isinstance(span, dict) else None
+            if isinstance(start, (int, float)):
+                span['start'] = self.clocks.to_server(device, start)
+                moved = True
+        return moved
+
+    def sync_clock(self, device, samples):
+        """Add a device's clock samples; returns its current estimate"""
+        return self.clocks.add(device, samples)
+
+    def clock_estimates(self):
+        return self.clocks.estimates()
+
+    def stream(self, device, cursors):
+        """New SSE text for a dashboard stream, and the advanced cursors"""
+        items, cursors = self.store.merged(device, cursors)
+        return ''.join(line for _, _, line in items), cursors
+
+    def events(self, device=None):
+        return self.store.events(device)
+
+    def stats(self, device=None):
+        stats = self.store.stats(device)
+        if stats is None:
+            return None
+        stats['connected_clients'] = self._clients
+        if device:
+            stats['admission'] = self.admission.stats(device)
+        else:
+            for name, device_stats in stats['devices'].items():
+                device_stats['admission'] = self.admission.stats(name)
+        return stats
+
+    def count(self):
+        return self.store.count()
+
+    def devices(self):
+        return self.store.devices()
+
+    def clear(self):
+        with self.store.frozen():
+            self.store.clear()
+            self.snapshots.log_clear()
+
+    def client_connected(self, delta):
+        """Count dashboard connections (of all workers); returns the new total"""
+        with self._clients_lock:
+            self._clients += delta
+            return self._clients
+
+    def search(self, text, **filters):
+        return self.query_log.search(text, **filters)
+
+    def get_query(self, query_id):
+        return self.query_log.get(query_id)
+
+    def trace(self, query_id):
+        return self.query_log.trace(query_id)
+
+    def render_timings(self, since=None, device=None):
+        return self.query_log.render_timings(since, device)
+
+    def cost_totals(self, kind, limit=None):
+        """Token and cost totals per provider, model, book or day, and overall"""
+        return {'totals': self.costs.totals(kind, limit), 'total': self.costs.total()}
+
+    def prices(self):
+        return self.costs.prices.table()
+
+    def alerts(self, active_only=False, limit=None):
+        return self.regressions.alerts(active_only, limit)
+
+    def rollup(self, resolution, since, until=None, provider=None, model=None, total=False):
+        """Rollup buckets, brought up to date with the latest completed queries first"""
+        self.rollups.update()
+        return self.rollups.query(resolution, since, until, provider, model, total)
+
+    def snapshot(self):
+        """
+        Write a snapshot of the in-memory state
+        Ingest is held off only while the state is copied, not while it is written
+        """
+        with self.store.frozen():
+            self.snapshots.rotate()
+            state = {
+                'partitions': [p.snapshot() for p in self.store.partitions()],
+                'open_queries': self.query_log.open_queries(),
+                'clocks': self.clocks.samples(),
+                'regressions': self.regressions.state(),
+            }
+        self.snapshots.write(state)
+
+    def _restore(self):
+        """Load the last snapshot and replay the events stored after it"""
+        started = time.monotonic()
+        state = self.snapshots.load() or {}
+        for partition_state in state.get('partitions', []):
+            self.store.partition(partition_state['device'], create=True).restore(partition_state)
+        self.query_log.restore(state.get('open_queries', {}))
+        self.clocks.restore(state.get('clocks', {}))
+        self.regressions.restore(state.get('regressions', {}))
+
+        replayed = 0
+        for entry in self.snapshots.tail():
+            if entry[0] == 'clear':
+                self.store.clear()
+                continue
+            _, seq, encoded = entry
+            event = json.loads(encoded)
+            if self.store.partition(event.get('device'), create=True).replay(seq, event, encoded):
+                self.query_log.replay(event)
+                # The regression events it raised are in the tail already
+                if event.get('event') == 'query_complete' and event.get('query_id'):
+                    self._observe(event.get('device'), event['query_id'])
+                replayed += 1
+
+        if state or replayed:
+            logger.info(f"Restored {self.store.count()} events of {len(self.store.devices())} devices "
+                        f"({replayed} from the tail log) in {time.monotonic() - started:.2f}s")
+
+    def close(self):
+        # The final snapshot must not race one the background thread is writing
+        self.snapshots.stop()
+        if self.snapshots.dirty():
+            self.snapshot()
+        self.snapshots.close()
+        self.rollups.close()
+        self.query_log.close()
+        self.costs.close()
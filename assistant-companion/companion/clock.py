@@ -0,0 +1,120 @@
+"""
+Device clock estimation
+Devices time-stamp events with their own clock. They regularly run an
+NTP-style exchange with /time: a request sent at device time t0 is
+received at server time t1 and answered at t2, and the answer arrives at
+device time t3. From these samples the offset and drift of every device
+clock are estimated, so device timestamps can be mapped to server time
+"""
+
+import threading
+from collections import deque
+
+# Samples kept per device, and the time window drift is fitted over (seconds)
+MAX_SAMPLES = 64
+FIT_WINDOW = 6 * 3600
+
+# Drift is only fitted over samples at least this far apart (seconds)
+MIN_FIT_SPAN = 60
+
+
+class DeviceClock:
+    """Offset and drift of one device's clock from round-trip samples"""
+
+    def __init__(self):
+        self.samples = deque(maxlen=MAX_SAMPLES)  # (device time, offset, round-trip delay)
+        self.ref = 0.0      # device time the offset refers to
+        self.offset = 0.0   # server time - device time at ref
+        self.drift = 0.0    # seconds of offset gained per device second
+        self.error = None   # half the round trip of the best sample
+
+    def add(self, t0, t1, t2, t3):
+        """Add one exchange; returns False if it is inconsistent"""
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0 or t2 < t1:
+            return False
+        self.samples.append((t3, ((t1 - t0) + (t2 - t3)) / 2, delay))
+        self._fit()
+        return True
+
+    def _fit(self):
+        newest = self.samples[-1][0]
+        recent = [s for s in self.samples if s[0] >= newest - FIT_WINDOW]
+        best = min(s[2] for s in recent)
+        # Queueing only ever adds delay, so the fastest round trips carry
+        # the most accurate offsets
+        good = [s for s in recent if s[2] <= best * 2 + 0.002]
+        self.error = best / 2
+
+        if len(good) < 2 or good[-1][0] - good[0][0] < MIN_FIT_SPAN:
+            sample = min(good, key=lambda s: s[2])
+            self.ref, self.offset, self.drift = sample[0], sample[1], 0.0
+            return
+
+        # Least squares line through the good samples' offsets
+        n = len(good)
+        mean_t = sum(s[0] for s in good) / n
+        mean_o = sum(s[1] for s in good) / n
+        var = sum((s[0] - mean_t) ** 2 for s in good)
+        cov = sum((s[0] - mean_t) * (s[1] - mean_o) for s in good)
+        self.ref, self.offset, self.drift = mean_t, mean_o, cov / var
+
+    def to_server(self, device_time):
+        return device_time + self.offset + self.drift * (device_time - self.ref)
+
+    def estimate(self):
+        return {
+            'offset_ms': round(self.offset * 1000, 3),
+            'drift_ppm': round(self.drift * 1e6, 3),
+            'error_ms': round(self.error * 1000, 3),
+            'samples': len(self.samples),
+        }
+
+
+class ClockSync:
+    """Clock estimates of all devices"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clocks = {}
+
+    def add(self, device, samples):
+        """
+        Add (t0, t1, t2, t3) samples reported by a device
+        Returns the device's current estimate (None without samples)
+        """
+        with self._lock:
+            for sample in samples:
+                try:
+                    t0, t1, t2, t3 = (float(t) for t in sample)
+                except (TypeError, ValueError):
+                    continue  # not a sample
+                self._clocks.setdefault(device, DeviceClock()).add(t0, t1, t2, t3)
+            clock = self._clocks.get(device)
+            return clock.estimate() if clock and clock.samples else None
+
+    def to_server(self, device, device_time):
+        """Server time of a device timestamp, None if the device's clock is unknown"""
+        clock = self._clocks.get(device)
+        if clock is None or not clock.samples or not isinstance(device_time, (int, float)):
+            return None
+        with self._lock:
+            return clock.to_server(device_time)
+
+    def samples(self):
+        """Samples of every device, for a snapshot"""
+        with self._lock:
+            return {device: list(clock.samples) for device, clock in self._clocks.items() if clock.samples}
+
+    def restore(self, samples):
+        """Load samples taken by samples() after a restart"""
+        with self._lock:
+            for device, device_samples in samples.items():
+                clock = self._clocks.setdefault(device, DeviceClock())
+                clock.samples.extend(tuple(sample) for sample in device_samples)
+                if clock.samples:
+                    clock._fit()
+
+    def estimates(self):
+        with self._lock:
+            return {device: clock.estimate() for device, clock in self._clocks.items() if clock.samples}
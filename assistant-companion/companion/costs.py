@@ -0,0 +1,187 @@
+"""
+Token and cost accounting
+Completed queries carry the token usage their provider reported. Each
+one is priced from a configurable price table and added to running
+totals per provider, model, book and day. The totals are kept in memory
+and written through to the query log's database as they change, so
+reading them costs the same however many queries there are
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Price table (JSON), default: prices.json in the data directory
+PRICES_FILE = os.environ.get('COMPANION_PRICES')
+
+KINDS = ('provider', 'model', 'book', 'day')
+TOKENS = ('prompt_tokens', 'completion_tokens', 'reasoning_tokens', 'cached_tokens')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cost_totals (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    queries INTEGER NOT NULL DEFAULT 0,
+    unpriced INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+"""
+
+COLUMNS = ('queries', 'unpriced') + TOKENS + ('cost',)
+
+
+def normalize_usage(usage):
+    """Token counts of a reported usage, None if it has none"""
+    if not isinstance(usage, dict):
+        return None
+    counts = {field: usage[field] if isinstance(usage.get(field), int) and usage[field] >= 0 else 0
+              for field in TOKENS}
+    if not counts['prompt_tokens'] and not counts['completion_tokens']:
+        return None
+    return counts
+
+
+class Prices:
+    """
+    Prices per million tokens, read from a JSON file that is reloaded when
+    it changes. Entries are keyed "provider/model", "model" or "provider/*"
+    (looked up in that order) and give prompt, completion and optionally
+    cached (input read from a cache) prices:
+
+        {"openai/gpt-4o-mini": {"prompt": 0.15, "cached": 0.075, "completion": 0.6}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._table = {}
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._mtime, self._table = None, {}
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                table = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot read price table {self.path}: {e}")
+            return  # keep the previous prices
+        if not isinstance(table, dict):
+            logger.error(f"Price table {self.path} is not an object")
+            return
+        self._mtime = mtime
+        self._table = {key: price for key, price in table.items()
+                       if isinstance(price, dict)
+                       and all(isinstance(price.get(field, 0), (int, float)) for field in ('prompt', 'completion', 'cached'))}
+
+    def table(self):
+        with self._lock:
+            self._reload()
+            return dict(self._table)
+
+    def lookup(self, provider, model):
+        """Prices of a model, None if the table has none"""
+        with self._lock:
+            self._reload()
+            for key in (f'{provider}/{model}', model, f'{provider}/*'):
+                if key in self._table:
+                    return self._table[key]
+        return None
+
+    def cost(self, provider, model, usage):
+        """Cost of normalized usage, None if the model has no price"""
+        price = self.lookup(provider, model)
+        if price is None:
+            return None
+        prompt = price.get('prompt', 0)
+        cached = min(usage['cached_tokens'], usage['prompt_tokens'])
+        return ((usage['prompt_tokens'] - cached) * prompt
+                + cached * price.get('cached', prompt)
+                + usage['completion_tokens'] * price.get('completion', 0)) / 1e6
+
+
+class Costs:
+    """Running token and cost totals per provider, model, book and day"""
+
+    def __init__(self, db_path, prices_path):
+        self.prices = Prices(prices_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        # kind -> key -> totals
+        self._totals = {kind: {} for kind in KINDS}
+        for row in self._conn.execute(f"SELECT kind, key, {', '.join(COLUMNS)} FROM cost_totals"):
+            if row[0] in self._totals:
+                self._totals[row[0]][row[1]] = dict(zip(COLUMNS, row[2:]))
+
+    def add(self, provider, model, book, finished_at, usage):
+        """
+        Count a completed query; usage is normalized (see normalize_usage)
+        Returns its cost, None if its model has no price
+        """
+        cost = self.prices.cost(provider, model, usage)
+        keys = {
+            'provider': provider or '',
+            'model': f"{provider or ''}/{model or ''}",
+            'book': book or '',
+            'day': datetime.fromtimestamp(finished_at).date().isoformat(),
+        }
+        rows = []
+        with self._lock:
+            for kind, key in keys.items():
+                totals = self._totals[kind].setdefault(key, dict.fromkeys(COLUMNS, 0))
+                totals['queries'] += 1
+                totals['unpriced'] += cost is None
+                for field in TOKENS:
+                    totals[field] += usage[field]
+                totals['cost'] += cost or 0.0
+                rows.append((kind, key) + tuple(totals[column] for column in COLUMNS))
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO cost_totals (kind, key, {', '.join(COLUMNS)}) "
+                f"VALUES (?, ?{', ?' * len(COLUMNS)})", rows)
+            self._conn.commit()
+        return cost
+
+    def totals(self, kind, limit=None):
+        """Totals of every provider, model, book or day: the costliest (latest days) first"""
+        with self._lock:
+            rows = [dict(totals, key=key) for key, totals in self._totals[kind].items()]
+        if kind == 'day':
+            rows.sort(key=lambda row: row['key'], reverse=True)
+        else:
+            rows.sort(key=lambda row: (row['cost'], row['prompt_tokens'] + row['completion_tokens']),
+                      reverse=True)
+        for row in rows:
+            row['cost'] = round(row['cost'], 6)
+        return rows[:limit] if limit else rows
+
+    def total(self):
+        """Grand total over all queries"""
+        with self._lock:
+            total = dict.fromkeys(COLUMNS, 0)
+            for totals in self._totals['provider'].values():
+                for column in COLUMNS:
+                    total[column] += totals[column]
+        total['cost'] = round(total['cost'], 6)
+        return total
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,49 @@
+"""
+Duplicate detection for reporter events
+The Kindle resends spooled events when it cannot tell whether a request
+got through; every event carries a (device, seq) id to recognise them
+"""
+
+from collections import deque
+
+# Ids remembered per device; larger than the Kindle's spool (1000 events),
+# so a resent batch is always still known
+DEFAULT_WINDOW = 4096
+
+
+class RecentIds:
+    """
+    Sliding window of the sequence numbers one device sent recently
+    Not locked, the owning device partition serializes access
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._seen = set()
+        self._order = deque()
+
+    def add(self, seq):
+        """Record a sequence number; returns False if it was already seen"""
+        if seq is None:
+            return True  # reporters without ids are never deduplicated
+        if seq in self._seen:
+            return False
+        self._seen.add(seq)
+        self._order.append(seq)
+        if len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+        return True
+
+    def discard(self, seq):
+        """Forget a sequence number, so the event is accepted when resent"""
+        if seq is None or seq not in self._seen:
+            return
+        self._seen.discard(seq)
+        if self._order[-1] == seq:
+            self._order.pop()  # the usual case: the id just recorded
+        else:
+            self._order.remove(seq)
+
+    def ids(self):
+        """Remembered sequence numbers, oldest first"""
+        return iter(self._order)
@@ -0,0 +1,151 @@
+"""
+Console log of received events
+Request handlers only enqueue the event; a listener thread does the
+formatting and terminal I/O. The other log lines, werkzeug's request log
+included, go through the same queue, so no request waits on the terminal. Stream chunks are summarized once per query
+instead of one line per chunk, and a summary line is written at most
+every SUMMARY_INTERVAL seconds
+"""
+
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Log every Nth event of a type (0 = never); unlisted types are always logged.
+# Chunks are reported with their query's query_complete line instead.
+SAMPLING = {
+    'stream_chunk': 0,
+    'heartbeat': 10,
+}
+
+SUMMARY_INTERVAL = 10  # seconds
+
+COLORS = {
+    'query_start': '\033[92m',      # Green
+    'stream_chunk': '\033[94m',     # Blue
+    'query_complete': '\033[93m',   # Yellow
+    'error': '\033[91m',            # Red
+    'heartbeat': '\033[90m',        # Gray
+}
+RESET = '\033[0m'
+
+
+class _EnqueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
+class EventConsoleHandler(logging.Handler):
+    """Writes sampled event lines and periodic summaries (runs on the listener thread)"""
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+        self.seen = {}            # event type -> count, for sampling
+        self.queries = {}         # device -> {'chunks': n, 'chars': n}
+        self.window = {}          # event type -> count since the last summary
+        self.devices = set()
+        self.window_start = time.monotonic()
+
+    def emit(self, record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            self.target.handle(record)
+            return
+        event_type = event.get('event', 'unknown')
+        device = event.get('device') or 'unknown'
+        data = event.get('data') or {}
+
+        self.window[event_type] = self.window.get(event_type, 0) + 1
+        self.devices.add(device)
+        self._track_query(device, event_type, data)
+
+        every = SAMPLING.get(event_type, 1)
+        count = self.seen.get(event_type, 0)
+        self.seen[event_type] = count + 1
+        if every and count % every == 0:
+            for level, line in self._describe(device, event_type, data):
+                self._write(record, level, line)
+
+        if time.monotonic() - self.window_start >= SUMMARY_INTERVAL:
+            self._summary(record)
+
+    def _track_query(self, device, event_type, data):
+        if event_type == 'query_start':
+            self.queries[device] = {'chunks': 0, 'chars': 0}
+        elif event_type == 'stream_chunk':
+            query = self.queries.setdefault(device, {'chunks': 0, 'chars': 0})
+            query['chunks'] += 1
+            query['chars'] += len(data.get('content') or '')
+
+    def _describe(self, device, event_type, data):
+        """Console lines for one event, as (level, message) pairs"""
+        color = COLORS.get(event_type, RESET)
+        lines = [(logging.INFO, f"{color}[{event_type}]{RESET} Received from {device}")]
+        if event_type == 'query_start':
+            provider = data.get('provider', 'unknown')
+            model = data.get('model', 'unknown')
+            lines.append((logging.INFO, f"  Provider: {provider}, Model: {model}"))
+        elif event_type == 'query_complete':
+            query = self.queries.pop(device, None)
+            if query:
+                lines.append((logging.INFO, f"  Streamed {query['chunks']} chunks, {query['chars']} chars"))
+        elif event_type == 'error':
+            lines.append((logging.ERROR, f"  Error: {data.get('message', 'Unknown error')}"))
+        elif event_type == 'trace':
+            lines.append((logging.INFO, f"  {len(data.get('spans') or [])} spans"))
+        return lines
+
+    def _summary(self, record):
+        total = sum(self.window.values())
+        elapsed = time.monotonic() - self.window_start
+        types = ', '.join(f"{count} {event_type}" for event_type, count in sorted(self.window.items()))
+        self._write(record, logging.INFO,
+                    f"{total} events in {elapsed:.0f}s from {len(self.devices)} device(s): {types}")
+        self.window = {}
+        self.devices = set()
+        self.window_start = time.monotonic()
+
+    def _write(self, record, level, message):
+        line = logging.makeLogRecord({
+            'name': record.name, 'levelno': level, 'levelname': logging.getLevelName(level),
+            'msg': message, 'created': record.created, 'msecs': record.msecs,
+        })
+        self.target.handle(line)
+
+
+def _listen(enqueue, console):
+    """Start a listener thread on a fresh queue for enqueue"""
+    enqueue.queue = queue.SimpleQueue()
+    listener = QueueListener(enqueue.queue, console)
+    listener.start()
+    return listener
+
+
+def start_event_log(name, target):
+    """
+    Create the logger for received events and route the root logger through
+    it; target is the handler that finally writes the lines (e.g. a StreamHandler)
+    """
+    enqueue = _EnqueueHandler(None)
+    console = EventConsoleHandler(target)
+    atexit.register(_listen(enqueue, console).stop)
+    # Forked processes (pre-fork broker and workers) lack the thread, they start their own
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: _listen(enqueue, console))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(enqueue)
+
+    event_logger = logging.getLogger(name)
+    event_logger.propagate = False
+    event_logger.setLevel(logging.INFO)
+    event_logger.addHandler(enqueue)
+    return event_logger
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Columnar export of query summaries and events
+Rows are read and written one row group at a time, so an export never
+holds the whole dataset in memory: Parquet when pyarrow is installed,
+chunked CSV otherwise. Run as a script for the command line tool
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Rows per row group (Parquet) or per written chunk (CSV)
+ROW_GROUP = 5000
+
+FORMATS = ('parquet', 'csv')
+MIMETYPES = {'parquet': 'application/vnd.apache.parquet', 'csv': 'text/csv'}
+
+# (name, Arrow type) of every exported column
+QUERY_COLUMNS = (
+    ('id', 'int64'),
+    ('device', 'string'),
+    ('started_at', 'float64'),
+    ('completed_at', 'float64'),
+    ('status', 'string'),
+    ('provider', 'string'),
+    ('model', 'string'),
+    ('title', 'string'),
+    ('book', 'string'),
+    ('chunks', 'int64'),
+    ('tokens', 'int64'),
+    ('prompt_tokens', 'int64'),
+    ('completion_tokens', 'int64'),
+    ('reasoning_tokens', 'int64'),
+    ('cached_tokens', 'int64'),
+    ('cost', 'float64'),
+    ('first_chunk_s', 'float64'),
+    ('duration_s', 'float64'),
+    ('prompt_chars', 'int64'),
+    ('response_chars', 'int64'),
+    ('error', 'string'),
+)
+
+EVENT_COLUMNS = (
+    ('received_at', 'string'),
+    ('server_time', 'float64'),
+    ('transit_ms', 'float64'),
+    ('device', 'string'),
+    ('seq', 'int64'),
+    ('event', 'string'),
+    ('query_id', 'int64'),
+    ('provider', 'string'),
+    ('model', 'string'),
+    ('content_chars', 'int64'),
+    ('data', 'string'),
+)
+
+COLUMNS = {'queries': QUERY_COLUMNS, 'events': EVENT_COLUMNS}
+
+
+def default_format():
+    return 'parquet' if pq else 'csv'
+
+
+def parse_time(value):
+    """Unix time or ISO 8601 date/time; None if not given"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def query_rows(db_path, since=None, until=None, provider=None, model=None, size=ROW_GROUP):
+    """
+    Query summaries started in [since, until), in lists of at most size rows
+    Reads through its own connection, so a long export does not hold up ingest
+    """
+    sql = [
+        'SELECT id, device, started_at, completed_at, status, provider, model, title, book,',
+        '       chunks, tokens, prompt_tokens, completion_tokens, reasoning_tokens, cached_tokens, cost,',
+        '       first_chunk_at - started_at, completed_at - started_at,',
+        '       length(prompt), length(response), error',
+        'FROM queries WHERE 1',
+    ]
+    params = []
+    for clause, value in (('AND started_at >= ?', since), ('AND started_at < ?', until),
+                          ('AND provider = ?', provider), ('AND model = ?', model)):
+        if value is not None:
+            sql.append(clause)
+            params.append(value)
+    sql.append('ORDER BY started_at')
+
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        cur = conn.execute('\n'.join(sql), params)
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def event_rows(events, db_path, since=None, until=None, provider=None, model=None, size=ROW_GROUP):
+    """
+    Stored events in [since, until), in lists of at most size rows
+    Provider and model come from the query an event belongs to
+    """
+    since = datetime.fromtimestamp(since).isoformat() if since is not None else None
+    until = datetime.fromtimestamp(until).isoformat() if until is not None else None
+
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        for start in range(0, len(events), size):
+            batch = [e for e in events[start:start + size]
+                     if (since is None or (e.get('received_at') or '') >= since)
+                     and (until is None or (e.get('received_at') or '') < until)]
+            queries = _query_models(conn, {e['query_id'] for e in batch if e.get('query_id')})
+            rows = []
+            for event in batch:
+                data = event.get('data') or {}
+                query_provider, query_model = queries.get(event.get('query_id'), (None, None))
+                row_provider = data.get('provider') or query_provider
+                row_model = data.get('model') or query_model
+                if (provider and row_provider != provider) or (model and row_model != model):
+                    continue
+                content = data.get('content')
+                rows.append((
+                    event.get('received_at'), event.get('server_time'), event.get('transit_ms'),
+                    event.get('device'), event.get('seq'),
+                    event.get('event'), event.get('query_id'), row_provider, row_model,
+                    len(content) if isinstance(content, str) else None,
+                    json.dumps(data, ensure_ascii=False),
+                ))
+            if rows:
+                yield rows
+    finally:
+        conn.close()
+
+
+def _query_models(conn, query_ids):
+    """query id -> (provider, model)"""
+    if not query_ids:
+        return {}
+    marks = ','.join('?' * len(query_ids))
+    rows = conn.execute(f'SELECT id, provider, model FROM queries WHERE id IN ({marks})',
+                        list(query_ids))
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def write_csv(columns, batches):
+    """CSV text, one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _Sink:
+    """Write-only file that collects what the Parquet writer produces"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def write_parquet(columns, batches):
+    """Parquet bytes, one row group per batch of rows"""
+    schema = pa.schema([(name, getattr(pa, type_)()) for name, type_ in columns])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in batches:
+            arrays = [pa.array(values, type=field.type)
+                      for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def export(kind, batches, fmt):
+    """Encoded chunks of an export; fmt is one of FORMATS"""
+    if fmt == 'parquet':
+        if pq is None:
+            raise ValueError('Parquet export needs pyarrow (pip install pyarrow), use format=csv')
+        return write_parquet(COLUMNS[kind], batches)
+    return (chunk.encode('utf-8') for chunk in write_csv(COLUMNS[kind], batches))
+
+
+def main():
+    data_dir = os.environ.get('COMPANION_DATA_DIR',
+                              os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           'instance'))
+    parser = argparse.ArgumentParser(
+        description='Export query summaries (from the query log) or events (from a running companion)')
+    parser.add_argument('kind', choices=sorted(COLUMNS))
+    parser.add_argument('-o', '--output', help='output file (default: <kind>.<format>, - for stdout)')
+    parser.add_argument('--format', choices=FORMATS, default=default_format())
+    parser.add_argument('--since', help='unix time or ISO date/time')
+    parser.add_argument('--until', help='unix time or ISO date/time')
+    parser.add_argument('--provider')
+    parser.add_argument('--model')
+    parser.add_argument('--device', help='events of one device only')
+    parser.add_argument('--data-dir', default=data_dir, help='companion data directory (queries)')
+    parser.add_argument('--url', default='http://localhost:8080', help='companion address (events)')
+    args = parser.parse_args()
+
+    try:
+        since, until = parse_time(args.since), parse_time(args.until)
+        if args.kind == 'queries':
+            db_path = os.path.join(args.data_dir, 'queries.db')
+            if not os.path.exists(db_path):
+                parser.error(f'no query log at {db_path}')
+            chunks = export('queries', query_rows(db_path, since, until, args.provider, args.model),
+                            args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    output = args.output or f'{args.kind}.{args.format}'
+    out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        if args.kind == 'queries':
+            for chunk in chunks:
+                out.write(chunk)
+        else:
+            # Events live in the companion's memory, the server encodes them
+            params = {key: value for key, value in (
+                ('format', args.format), ('since', since), ('until', until),
+                ('provider', args.provider), ('model', args.model), ('device', args.device),
+            ) if value is not None}
+            url = f"{args.url.rstrip('/')}/api/export/events?{urllib.parse.urlencode(params)}"
+            with urllib.request.urlopen(url) as response:
+                shutil.copyfileobj(response, out)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Pre-fork mode for the companion app
+A broker process owns the backend: it assigns sequence numbers,
+deduplicates and writes the query log, so there is a single writer and
+ingest is serialised there. Worker processes share one listening socket;
+they parse requests, encode events and serve dashboard streams on their
+own core, and call the broker over a small pool of authenticated local
+connections that request threads reuse.
+Workers are forked, so this mode needs Linux or macOS.
+"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from werkzeug.serving import make_server
+
+from backend import Backend
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a crashed worker is replaced, doubled while workers keep
+# crashing within STABLE_UPTIME of their start
+RESPAWN_DELAY = 0.5
+MAX_RESPAWN_DELAY = 30
+STABLE_UPTIME = 60
+
+# Idle broker connections a worker keeps for its request threads
+MAX_IDLE = 16
+
+# Seconds the broker gets to write its final snapshot on shutdown
+BROKER_STOP_TIMEOUT = 30
+
+
+class BackendClient:
+    """
+    The broker's Backend as seen from a worker
+    werkzeug starts a thread per request, so connections are pooled rather
+    than kept per thread; a call borrows one and returns it afterwards
+    """
+
+    def __init__(self, address, authkey):
+        self._address = address
+        self._authkey = authkey
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = Client(self._address, authkey=self._authkey)
+        try:
+            conn.send((method, args, kwargs))
+            ok, result = conn.recv()
+        except BaseException:
+            conn.close()  # the reply may still be on its way
+            raise
+        with self._lock:
+            if len(self._idle) < MAX_IDLE:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        if not ok:
+            raise result
+        return result
+
+
+def _run_broker(data_dir, authkey, control, parent_end):
+    """Serve the backend until the parent asks to stop or goes away"""
+    parent_end.close()  # so the parent's exit shows up as EOF on control
+    # Ctrl+C and SIGTERM reach the whole process group; the parent stops
+    # the broker once the workers are gone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    backend = Backend(data_dir)
+    listener = Listener(authkey=authkey)
+    threading.Thread(target=_accept, args=(listener, backend), daemon=True).start()
+    control.send(listener.address)
+    try:
+        control.recv()
+    except EOFError:
+        pass
+    try:
+        # The final snapshot
+        backend.close()
+    finally:
+        listener.close()
+    try:
+        control.send(True)
+    except OSError:
+        pass
+
+
+def _accept(listener, backend):
+    while True:
+        try:
+            conn = listener.accept()
+        except (EOFError, multiprocessing.AuthenticationError):
+            continue  # a client that failed the handshake
+        except OSError:
+            return  # listener closed
+        threading.Thread(target=_serve_connection, args=(conn, backend), daemon=True).start()
+
+
+def _serve_connection(conn, backend):
+    """Answer one worker connection's calls until it is closed"""
+    with conn:
+        while True:
+            try:
+                method, args, kwargs = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if method.startswith('_'):
+                    raise AttributeError(method)
+                reply = (True, getattr(backend, method)(*args, **kwargs))
+            except Exception as e:
+                reply = (False, e)
+            try:
+                conn.send(reply)
+            except (OSError, ValueError):
+                return
+            except Exception as e:
+                # An exception that cannot be pickled
+                conn.send((False, RuntimeError(f"{method}: {e!r}")))
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(flask_app, host, port, workers, data_dir, setup_worker):
+    """
+    Run the app in workers processes until interrupted
+    setup_worker(backend_client) is called in every worker before it serves
+    """
+    ctx = multiprocessing.get_context('fork')
+    authkey = os.urandom(16)
+    control, broker_end = ctx.Pipe()
+    broker = ctx.Process(target=_run_broker, args=(data_dir, authkey, broker_end, control),
+                         name='companion-broker')
+    broker.start()
+    broker_end.close()
+    try:
+        address = control.recv()
+    except EOFError:
+        raise RuntimeError('The broker process failed to start') from None
+    sock = socket.create_server((host, port), backlog=128)
+    logger.info(f"Serving on {host}:{port} with {workers} worker processes")
+
+    children = {}    # pid -> start time
+    signal.signal(signal.SIGTERM, _stop)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            control.close()
+            code = 0
+            try:
+                _run_worker(flask_app, sock, address, authkey, setup_worker)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception('Worker failed')
+                code = 1
+            os._exit(code)
+        children[pid] = time.monotonic()
+
+    try:
+        for _ in range(workers):
+            spawn()
+        delay = 0
+        while children:
+            pid, status = os.wait()
+            if pid == broker.pid:
+                logger.error(f"The broker exited with status {status}, stopping")
+                break
+            started = children.pop(pid, None)
+            if started is None:
+                continue  # not a worker
+            # Replace workers that crashed, backing off while they crash right away
+            if time.monotonic() - started >= STABLE_UPTIME:
+                delay = RESPAWN_DELAY
+            else:
+                delay = min(max(delay * 2, RESPAWN_DELAY), MAX_RESPAWN_DELAY)
+            logger.warning(f"Worker {pid} exited with status {status}, restarting in {delay:g}s")
+            time.sleep(delay)
+            spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Another signal must not cut the shutdown short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            sock.close()
+        finally:
+            _stop_broker(broker, control)
+
+
+def _stop_broker(broker, control):
+    """Ask the broker to write its final snapshot and exit"""
+    try:
+        control.send('stop')
+        if not control.poll(BROKER_STOP_TIMEOUT):
+            logger.error('The broker did not stop in time')
+    except OSError:
+        pass  # it is gone already
+    control.close()
+    broker.join(1)
+    if broker.is_alive():
+        broker.terminate()
+        broker.join()
+
+
+def _run_worker(flask_app, sock, address, authkey, setup_worker):
+    """Connect to the broker and serve requests on the shared socket"""
+    setup_worker(BackendClient(address, authkey))
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, flask_app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
@@ -0,0 +1,531 @@
+"""
+Query log for the companion app
+Assembles queries from the event stream and keeps them searchable
+with an SQLite FTS5 index
+"""
+
+import html
+import json
+from datetime import datetime
+import re
+import sqlite3
+import threading
+import time
+
+from costs import normalize_usage
+
+# Markers passed to snippet(); they cannot appear in normal text and are
+# turned into <mark> tags after the snippet has been HTML-escaped
+_HL_START = '\ue000'
+_HL_END = '\ue001'
+
+SEARCH_FIELDS = ('title', 'prompt', 'response')
+
+# Upper bounds (characters) of the answer sizes render timings are grouped by
+RENDER_SIZES = (2000, 8000, 32000)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL DEFAULT '',
+    started_at REAL NOT NULL,
+    completed_at REAL,
+    status TEXT NOT NULL DEFAULT 'running',
+    provider TEXT,
+    model TEXT,
+    title TEXT NOT NULL DEFAULT '',
+    prompt TEXT NOT NULL DEFAULT '',
+    response TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    first_chunk_at REAL,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER,
+    trace_id TEXT,
+    logged_at REAL,
+    book TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    reasoning_tokens INTEGER,
+    cached_tokens INTEGER,
+    cost REAL
+);
+CREATE INDEX IF NOT EXISTS queries_started_at ON queries(started_at);
+CREATE INDEX IF NOT EXISTS queries_logged_at ON queries(logged_at);
+CREATE INDEX IF NOT EXISTS queries_provider ON queries(provider, model);
+CREATE INDEX IF NOT EXISTS queries_trace ON queries(device, trace_id);
+
+-- Timed steps of a query on the device (start is device time in seconds)
+CREATE TABLE IF NOT EXISTS spans (
+    device TEXT NOT NULL,
+    trace_id TEXT NOT NULL,
+    span_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    attrs TEXT,
+    PRIMARY KEY (device, trace_id, span_id)
+) WITHOUT ROWID;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS queries_fts USING fts5(
+    title, prompt, response,
+    content='queries', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS queries_ai AFTER INSERT ON queries BEGIN
+    INSERT INTO queries_fts(rowid, title, prompt, response)
+    VALUES (new.id, new.title, new.prompt, new.response);
+END;
+CREATE TRIGGER IF NOT EXISTS queries_ad AFTER DELETE ON queries BEGIN
+    INSERT INTO queries_fts(queries_fts, rowid, title, prompt, response)
+    VALUES ('delete', old.id, old.title, old.prompt, old.response);
+END;
+CREATE TRIGGER IF NOT EXISTS queries_au AFTER UPDATE OF title, prompt, response ON queries BEGIN
+    INSERT INTO queries_fts(queries_fts, rowid, title, prompt, response)
+    VALUES ('delete', old.id, old.title, old.prompt, old.response);
+    INSERT INTO queries_fts(rowid, title, prompt, response)
+    VALUES (new.id, new.title, new.prompt, new.response);
+END;
+"""
+
+
+# Columns added after the first release, created on older databases
+MIGRATIONS = {
+    'first_chunk_at': 'REAL',
+    'chunks': 'INTEGER NOT NULL DEFAULT 0',
+    'tokens': 'INTEGER',
+    'trace_id': 'TEXT',
+    'logged_at': 'REAL',
+    'book': 'TEXT',
+    'prompt_tokens': 'INTEGER',
+    'completion_tokens': 'INTEGER',
+    'reasoning_tokens': 'INTEGER',
+    'cached_tokens': 'INTEGER',
+    'cost': 'REAL',
+}
+
+# Values for existing rows of added columns
+BACKFILL = {
+    'logged_at': 'UPDATE queries SET logged_at = completed_at',
+}
+
+
+def _tokens(data):
+    """Token count reported with query_complete, if any"""
+    tokens = data.get('tokens')
+    if tokens is None and isinstance(data.get('usage'), dict):
+        tokens = data['usage'].get('total_tokens')
+    return tokens if isinstance(tokens, int) else None
+
+
+def _book(data):
+    book = data.get('book')
+    return book if isinstance(book, str) and book else None
+
+
+def _open_query(query_id, data):
+    """A query being assembled, started by a query_start carrying data"""
+    return {'id': query_id, 'chunks': [], 'chunk_count': 0, 'first_chunk_at': None,
+            'provider': data.get('provider'), 'model': data.get('model'), 'book': _book(data)}
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _format_prompt(history):
+    """Flatten a message history into indexable text"""
+    if not isinstance(history, list):
+        return ''
+    parts = []
+    for msg in history:
+        if isinstance(msg, dict) and msg.get('content'):
+            parts.append(f"{msg.get('role', 'user')}: {msg['content']}")
+    return '\n\n'.join(parts)
+
+
+def _fts_query(text):
+    """
+    Turn free text into a safe FTS5 expression
+    Quoted phrases are kept as phrases, every other word is quoted on its own
+    and the last bare word is matched as a prefix (search-as-you-type)
+    """
+    terms = []
+    last_is_word = False
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        words = re.findall(r'\w+', phrase or word)
+        if not words:
+            continue
+        terms.append('"' + ' '.join(words) + '"')
+        last_is_word = bool(word) and len(words) == 1
+    if last_is_word:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags"""
+    return (html.escape(snippet or '')
+            .replace(_HL_START, '<mark>')
+            .replace(_HL_END, '</mark>'))
+
+
+class QueryLog:
+    """
+    Persistent, searchable log of queries
+
+    Stream chunks are collected in memory per device and written once
+    when the query completes, so ingest costs at most one write per
+    query_start and one per query_complete/error. Chunks only take their
+    device's lock; the connection lock is held for database access.
+    """
+
+    def __init__(self, path, costs=None):
+        self.path = path
+        # Token and cost totals, counted as queries complete (see costs.py)
+        self.costs = costs
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._conn.executescript(SCHEMA)
+        # device -> {'id': query id, 'chunks': [response text so far],
+        #            'chunk_count': n, 'first_chunk_at': time of the first chunk,
+        #            'provider', 'model', 'book': what the costs are counted under}
+        self._open = {}
+        self._device_locks = {}
+
+    def _migrate(self):
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(queries)')}
+        if not columns:
+            return  # new database, SCHEMA creates everything
+        for column, definition in MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(f'ALTER TABLE queries ADD COLUMN {column} {definition}')
+                if column in BACKFILL:
+                    self._conn.execute(BACKFILL[column])
+        self._conn.commit()
+
+    def ingest(self, event, received=None):
+        """Update the log with one event; returns the query id it belongs to"""
+        event_type = event.get('event')
+        data = event.get('data') or {}
+        device = event.get('device') or ''
+        received = received or time.time()
+
+        if event_type == 'trace':
+            return self._add_spans(device, data)
+
+        with self._device_lock(device):
+            if event_type == 'query_start':
+                return self._start(device, data, received)
+
+            current = self._open.get(device)
+            if current is None:
+                return None
+            self._apply(device, current, event_type, data, received)
+            return current['id']
+
+    def open_queries(self):
+        """Queries still being assembled, as plain values for a snapshot"""
+        return {device: dict(current, chunks=''.join(current['chunks']))
+                for device, current in list(self._open.items())}
+
+    def restore(self, open_queries):
+        """Load queries taken by open_queries() after a restart"""
+        for device, current in open_queries.items():
+            self._open[device] = dict(current, chunks=[current['chunks']] if current['chunks'] else [])
+
+    def replay(self, event):
+        """
+        Re-apply an event from the snapshot tail log to the queries being
+        assembled; the database already has everything else it did
+        """
+        device = event.get('device') or ''
+        event_type = event.get('event')
+        query_id = event.get('query_id')
+        if event_type == 'query_start' and query_id:
+            data = event.get('data') if isinstance(event.get('data'), dict) else {}
+            self._open[device] = _open_query(query_id, data)
+            return
+        current = self._open.get(device)
+        if current is None or current['id'] != query_id:
+            return
+        if event_type == 'stream_chunk':
+            data = event.get('data') if isinstance(event.get('data'), dict) else {}
+            received = event.get('server_time')
+            if received is None and event.get('received_at'):
+                received = datetime.fromisoformat(event['received_at']).timestamp()
+            coalesced = data.get('coalesced')
+            current['chunk_count'] += coalesced if isinstance(coalesced, int) and coalesced > 0 else 1
+            current['first_chunk_at'] = current['first_chunk_at'] or received
+            if data.get('content'):
+                current['chunks'].append(data['content'])
+        elif event_type in ('query_complete', 'error'):
+            self._open.pop(device, None)
+
+    def _device_lock(self, device):
+        lock = self._device_locks.get(device)
+        if lock is None:
+            with self._lock:
+                lock = self._device_locks.setdefault(device, threading.Lock())
+        return lock
+
+    def _apply(self, device, current, event_type, data, received):
+        """Add a follow-up event to the device's open query"""
+        if event_type == 'stream_chunk':
+            # Chunks coalesced under load count as the chunks they were
+            coalesced = data.get('coalesced')
+            current['chunk_count'] += coalesced if isinstance(coalesced, int) and coalesced > 0 else 1
+            current['first_chunk_at'] = current['first_chunk_at'] or received
+            if data.get('content'):
+                current['chunks'].append(data['content'])
+        elif event_type == 'query_complete':
+            self._finish(device, 'complete', received, tokens=_tokens(data),
+                         usage=normalize_usage(data.get('usage')))
+        elif event_type == 'error':
+            self._finish(device, 'error', received, data.get('message'))
+
+    def _start(self, device, data, received):
+        """Open a new query, closing any query the device left unfinished"""
+        if device in self._open:
+            self._finish(device, 'interrupted', received)
+        with self._lock:
+            cur = self._conn.execute(
+                'INSERT INTO queries (device, started_at, provider, model, title, prompt, trace_id, book) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (device, received, data.get('provider'), data.get('model'),
+                 data.get('title') or '', _format_prompt(data.get('history')), data.get('trace_id'),
+                 _book(data)))
+            self._conn.commit()
+        self._open[device] = _open_query(cur.lastrowid, data)
+        return cur.lastrowid
+
+    def _finish(self, device, status, received, error=None, tokens=None, usage=None):
+        """
+        Write the assembled response of the device's open query
+        received is when the query ended (device time, if known); logged_at
+        is when it was written, late for events caught up from a spool.
+        Reported token usage is added to the cost totals
+        """
+        current = self._open.pop(device, None)
+        if current is None:
+            return
+        response = ''.join(current['chunks'])
+        usage = usage or {}
+        cost = None
+        if usage and self.costs is not None:
+            cost = self.costs.add(current.get('provider'), current.get('model'), current.get('book'),
+                                  received, usage)
+        if tokens is None and usage:
+            tokens = usage['prompt_tokens'] + usage['completion_tokens']
+        with self._lock:
+            self._conn.execute(
+                'UPDATE queries SET completed_at = ?, status = ?, response = ?, error = ?, '
+                'first_chunk_at = ?, chunks = ?, tokens = ?, logged_at = ?, '
+                'prompt_tokens = ?, completion_tokens = ?, reasoning_tokens = ?, cached_tokens = ?, '
+                'cost = ? WHERE id = ?',
+                (received, status, response, error, current['first_chunk_at'],
+                 current['chunk_count'], tokens, time.time(),
+                 usage.get('prompt_tokens'), usage.get('completion_tokens'),
+                 usage.get('reasoning_tokens'), usage.get('cached_tokens'), cost, current['id']))
+            self._conn.commit()
+
+    def _add_spans(self, device, data):
+        """Store the spans of a trace event; returns the id of the traced query"""
+        rows = []
+        for span in data.get('spans') or []:
+            try:
+                rows.append((device, str(span.get('trace_id') or data.get('trace_id')), int(span['id']),
+                             span.get('parent_id'), str(span.get('name') or ''),
+                             float(span['start']), float(span['duration']),
+                             json.dumps(span['attrs']) if span.get('attrs') else None))
+            except (AttributeError, KeyError, TypeError, ValueError):
+                continue  # not a span
+        if not rows:
+            return None
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO spans VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+            row = self._conn.execute(
+                'SELECT id FROM queries WHERE device = ? AND trace_id = ? ORDER BY id DESC LIMIT 1',
+                (device, rows[0][1])).fetchone()
+        return row[0] if row else None
+
+    def trace(self, query_id):
+        """
+        Waterfall of a query: its spans in tree order with their depth,
+        offset from the start of the trace and duration in milliseconds
+        """
+        with self._lock:
+            query = self._conn.execute(
+                'SELECT device, trace_id FROM queries WHERE id = ?', (query_id,)).fetchone()
+            if query is None or query['trace_id'] is None:
+                return None
+            rows = self._conn.execute(
+                'SELECT span_id, parent_id, name, start, duration, attrs FROM spans '
+                'WHERE device = ? AND trace_id = ? ORDER BY start, span_id',
+                (query['device'], query['trace_id'])).fetchall()
+        if not rows:
+            return None
+
+        ids = {row['span_id'] for row in rows}
+        children = {}
+        for row in rows:
+            parent = row['parent_id'] if row['parent_id'] in ids else None
+            children.setdefault(parent, []).append(row)
+
+        origin = rows[0]['start']
+        spans = []
+        stack = [(row, 0) for row in reversed(children.get(None, []))]
+        while stack:
+            row, depth = stack.pop()
+            spans.append({
+                'id': row['span_id'],
+                'parent_id': row['parent_id'],
+                'name': row['name'],
+                'depth': depth,
+                'offset_ms': round((row['start'] - origin) * 1000, 1),
+                'duration_ms': round(row['duration'] * 1000, 1),
+                'attrs': json.loads(row['attrs']) if row['attrs'] else {},
+            })
+            stack.extend((child, depth + 1) for child in reversed(children.get(row['span_id'], [])))
+        return {
+            'query_id': query_id,
+            'trace_id': query['trace_id'],
+            'duration_ms': round(max(r['start'] + r['duration'] - origin for r in rows) * 1000, 1),
+            'spans': spans,
+        }
+
+    def render_timings(self, since=None, device=None):
+        """
+        Durations of the viewer's render spans grouped by render mode
+        (incremental, full or plain text) and answer size, to compare
+        incremental markdown rendering with full re-rendering
+        """
+        sql = "SELECT duration, attrs FROM spans WHERE name = 'render'"
+        params = []
+        if since is not None:
+            sql += ' AND start >= ?'
+            params.append(since)
+        if device:
+            sql += ' AND device = ?'
+            params.append(device)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        groups = {}
+        for row in rows:
+            attrs = json.loads(row['attrs']) if row['attrs'] else {}
+            mode = attrs.get('mode') or ('full' if attrs.get('markdown') else 'plain')
+            chars = attrs.get('chars') or 0
+            size = next((bound for bound in RENDER_SIZES if chars <= bound), None)
+            group = groups.setdefault((mode, size), {'durations': [], 'parse_ms': [], 'parsed': []})
+            group['durations'].append(row['duration'] * 1000)
+            if isinstance(attrs.get('parse_ms'), (int, float)):
+                group['parse_ms'].append(attrs['parse_ms'])
+            if isinstance(attrs.get('parsed'), int) and isinstance(attrs.get('blocks'), int):
+                group['parsed'].append((attrs['parsed'], attrs['blocks']))
+
+        timings = []
+        for (mode, size), group in sorted(groups.items(), key=lambda g: (g[0][0], g[0][1] or float('inf'))):
+            durations = sorted(group['durations'])
+            timings.append({
+                'mode': mode,
+                'max_chars': size,
+                'count': len(durations),
+                'mean_ms': round(sum(durations) / len(durations), 1),
+                'p50_ms': round(_percentile(durations, 0.5), 1),
+                'p90_ms': round(_percentile(durations, 0.9), 1),
+                'parse_ms': round(sum(group['parse_ms']) / len(group['parse_ms']), 1)
+                            if group['parse_ms'] else None,
+                'parsed_blocks': round(sum(p for p, _ in group['parsed']) / sum(b for _, b in group['parsed']), 3)
+                                 if group['parsed'] else None,
+            })
+        return timings
+
+    def timings(self, query_id):
+        """Provider, model, status, times and output tokens of a query (None if unknown)"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT provider, model, status, started_at, first_chunk_at, completed_at, completion_tokens '
+                'FROM queries WHERE id = ?', (query_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get(self, query_id):
+        """Get a single query with its full prompt and response"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM queries WHERE id = ?', (query_id,)).fetchone()
+        if row is None:
+            return None
+        query = dict(row)
+        current = self._open.get(query['device'])
+        if current and current['id'] == query_id:
+            query['response'] = ''.join(current['chunks'])
+        return query
+
+    def search(self, text, fields=None, provider=None, model=None, limit=20, offset=0):
+        """
+        Full-text search over titles, prompts and responses
+        Results are ranked by bm25 (title matches weigh more) and carry an
+        HTML snippet with the matched terms wrapped in <mark>
+        """
+        match = _fts_query(text)
+        if not match:
+            return {'results': [], 'has_more': False}
+        if fields:
+            match = '{%s} : (%s)' % (' '.join(fields), match)
+
+        # Rank and page first, snippets are only built for the rows of the page
+        # (a rowid lookup each, a join on queries_fts would run the match again)
+        sql = [
+            'WITH page AS (',
+            '    SELECT queries_fts.rowid AS id, bm25(queries_fts, 4.0, 1.0, 1.0) AS score',
+            '    FROM queries_fts JOIN queries q ON q.id = queries_fts.rowid',
+            '    WHERE queries_fts MATCH ?',
+        ]
+        params = [match]
+        if provider:
+            sql.append('    AND q.provider = ?')
+            params.append(provider)
+        if model:
+            sql.append('    AND q.model = ?')
+            params.append(model)
+        sql += [
+            '    ORDER BY score LIMIT ? OFFSET ?',
+            ')',
+            'SELECT q.id, q.device, q.started_at, q.completed_at, q.status,',
+            '       q.provider, q.model, q.title,',
+            "       (SELECT snippet(queries_fts, -1, ?, ?, '…', 16) FROM queries_fts",
+            '        WHERE queries_fts MATCH ? AND queries_fts.rowid = page.id) AS snippet,',
+            '       page.score',
+            'FROM page JOIN queries q ON q.id = page.id',
+            'ORDER BY page.score',
+        ]
+        # Fetch one extra row to know whether there is another page
+        params += [limit + 1, offset, _HL_START, _HL_END, match]
+
+        with self._lock:
+            rows = self._conn.execute('\n'.join(sql), params).fetchall()
+
+        results = []
+        for row in rows[:limit]:
+            result = dict(row)
+            result['snippet'] = _highlight(result['snippet'])
+            results.append(result)
+        return {'results': results, 'has_more': len(rows) > limit}
+
+    def count(self):
+        """Number of stored queries"""
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
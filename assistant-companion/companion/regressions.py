@@ -0,0 +1,264 @@
+"""
+Latency regression detection
+Every completed query adds its time to first chunk, total latency and
+output rate (tokens per second) to quantile sketches of its provider and
+model. A sketch counts values in log-spaced buckets, like the rollup
+histograms (quantiles within ~6%), and folds the buckets at the end the
+check does not look at together past MAX_BINS (the lowest for times,
+the highest for the output rate), so it stays the same size however
+many values it counts (the DDSketch scheme).
+
+A sketch covers one slot of the window; every series keeps a ring of
+the last RECENT_SLOTS + BASELINE_SLOTS of them. The recent window is
+compared with the baseline window before it: a series regressed when
+its p90 (p10 of the output rate) got RATIO times worse and more recent
+queries fall past the baseline p90 than chance allows (one-sided
+binomial test, p < ALPHA). It recovers once the ratio drops below
+RESOLVE_RATIO. Alerts are raised and resolved as `regression` events on
+the stream of the device whose query changed them
+"""
+
+import math
+import os
+import threading
+from collections import deque
+
+from rollups import GAMMA
+
+# Recent window (seconds) and how much worse its quantile must get
+WINDOW = float(os.environ.get('COMPANION_REGRESSION_WINDOW', 3600))
+RATIO = float(os.environ.get('COMPANION_REGRESSION_RATIO', 2.0))
+RESOLVE_RATIO = 1 + (RATIO - 1) / 2
+
+# The recent window is split into slots; the baseline is the six windows before it
+RECENT_SLOTS = 6
+BASELINE_SLOTS = 36
+SLOT = WINDOW / RECENT_SLOTS
+
+QUANTILE = 0.9
+ALPHA = 0.01
+MIN_RECENT = 10
+MIN_BASELINE = 30
+
+# Buckets per sketch, and values below MIN_VALUE count as MIN_VALUE
+MAX_BINS = 64
+MIN_VALUE = 1e-3
+
+# metric -> (unit, whether higher values are worse)
+METRICS = {
+    'first_chunk': ('s', True),
+    'latency': ('s', True),
+    'throughput': ('tokens/s', False),
+}
+
+MAX_ALERTS = 200
+
+
+class Sketch:
+    """
+    Counts of values in log-spaced buckets, at most MAX_BINS of them
+    high tells which end must stay exact: high quantiles (True) or low ones
+    """
+
+    __slots__ = ('bins', 'count', 'high')
+
+    def __init__(self, bins=None, high=True):
+        self.bins = {int(index): count for index, count in (bins or {}).items()}
+        self.count = sum(self.bins.values())
+        self.high = high
+
+    @staticmethod
+    def index(value):
+        return math.floor(math.log(max(value, MIN_VALUE), GAMMA))
+
+    def add(self, value):
+        index = self.index(value)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+
+    def _collapse(self):
+        """Fold the buckets at the far end from the kept quantiles into one"""
+        extra = len(self.bins) - MAX_BINS + 1
+        folded = sorted(self.bins, reverse=not self.high)[:extra]
+        for index in folded[:-1]:
+            self.bins[folded[-1]] += self.bins.pop(index)
+
+    def quantile(self, q):
+        """Approximate quantile (None for an empty sketch)"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return GAMMA ** (index + 0.5)
+        return None
+
+    def count_beyond(self, value, higher):
+        """Values in buckets entirely above (or below) the bucket of value"""
+        edge = self.index(value)
+        return sum(count for index, count in self.bins.items()
+                   if (index > edge if higher else index < edge))
+
+
+def binomial_tail(k, n, p):
+    """P(X >= k) for X ~ Binomial(n, p)"""
+    if k <= 0:
+        return 1.0
+    log_p, log_q = math.log(p), math.log1p(-p)
+    return min(1.0, sum(math.exp(math.lgamma(n + 1) - math.lgamma(i + 1) - math.lgamma(n - i + 1)
+                                 + i * log_p + (n - i) * log_q)
+                        for i in range(k, n + 1)))
+
+
+class Series:
+    """Ring of per-slot sketches of one provider, model and metric"""
+
+    def __init__(self, high, slots=()):
+        self.high = high  # whether higher values are worse
+        self.slots = deque(((number, Sketch(bins, high)) for number, bins in slots),
+                           maxlen=RECENT_SLOTS + BASELINE_SLOTS)
+
+    def add(self, at, value):
+        number = int(at // SLOT)
+        if not self.slots or self.slots[-1][0] < number:
+            self.slots.append((number, Sketch(high=self.high)))
+        # Values caught up late land in their own slot, if it is still kept
+        for slot, sketch in reversed(self.slots):
+            if slot <= number:
+                if slot == number:
+                    sketch.add(value)
+                return
+
+    def windows(self):
+        """Merged sketches of the recent and the baseline window, ending at the newest slot"""
+        recent, baseline = Sketch(high=self.high), Sketch(high=self.high)
+        newest = self.slots[-1][0]
+        for number, sketch in self.slots:
+            age = newest - number
+            if age < RECENT_SLOTS:
+                recent.merge(sketch)
+            elif age < RECENT_SLOTS + BASELINE_SLOTS:
+                baseline.merge(sketch)
+        return recent, baseline
+
+
+class Regressions:
+    """Latency sketches of all providers and models, and the alerts they raised"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}    # (provider, model, metric) -> Series
+        self._active = {}    # (provider, model, metric) -> alert
+        self._alerts = deque(maxlen=MAX_ALERTS)
+        self._next_id = 1
+
+    def observe(self, device, query):
+        """
+        Count a completed query (a row of QueryLog.timings)
+        Returns the alerts it raised or resolved
+        """
+        started, completed, first_chunk = query['started_at'], query['completed_at'], query['first_chunk_at']
+        if query['status'] != 'complete' or not started or not completed:
+            return []
+        values = {'latency': completed - started}
+        if first_chunk:
+            values['first_chunk'] = first_chunk - started
+            if query['completion_tokens'] and completed > first_chunk:
+                values['throughput'] = query['completion_tokens'] / (completed - first_chunk)
+
+        changes = []
+        with self._lock:
+            for metric, value in values.items():
+                if value <= 0:
+                    continue
+                key = (query['provider'] or '', query['model'] or '', metric)
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = Series(METRICS[metric][1])
+                series.add(completed, value)
+                change = self._check(key, series, device, completed)
+                if change:
+                    changes.append(change)
+        return changes
+
+    def _check(self, key, series, device, at):
+        """Raise or resolve the alert of a series; returns the alert if it changed"""
+        unit, higher = METRICS[key[2]]
+        recent, baseline = series.windows()
+        if recent.count < MIN_RECENT or baseline.count < MIN_BASELINE:
+            return None
+        q = QUANTILE if higher else 1 - QUANTILE
+        before, now = baseline.quantile(q), recent.quantile(q)
+        ratio = now / before if higher else before / now
+        active = self._active.get(key)
+
+        if active is None:
+            p_value = binomial_tail(recent.count_beyond(before, higher), recent.count, 1 - QUANTILE)
+            if ratio < RATIO or p_value >= ALPHA:
+                return None
+            alert = self._active[key] = {
+                'id': self._next_id,
+                'status': 'active',
+                'provider': key[0],
+                'model': key[1],
+                'metric': key[2],
+                'quantile': f'p{round(q * 100)}',
+                'unit': unit,
+                'baseline': round(before, 3),
+                'current': round(now, 3),
+                'ratio': round(ratio, 2),
+                'p_value': float(f'{p_value:.3g}'),
+                'samples': recent.count,
+                'baseline_samples': baseline.count,
+                'device': device,
+                'raised_at': at,
+                'resolved_at': None,
+            }
+            self._next_id += 1
+            self._alerts.append(alert)
+            return dict(alert)
+
+        if ratio < RESOLVE_RATIO:
+            del self._active[key]
+            active.update(status='resolved', current=round(now, 3), ratio=round(ratio, 2), resolved_at=at)
+            return dict(active)
+        return None
+
+    def alerts(self, active_only=False, limit=None):
+        """Alerts, newest first"""
+        with self._lock:
+            alerts = [dict(alert) for alert in reversed(self._alerts)
+                      if not active_only or alert['status'] == 'active']
+        return alerts[:limit] if limit else alerts
+
+    def state(self):
+        """Sketches and alerts as plain values, for a snapshot"""
+        with self._lock:
+            return {
+                'series': [list(key) + [[(number, sketch.bins) for number, sketch in series.slots]]
+                           for key, series in self._series.items()],
+                'alerts': [dict(alert) for alert in self._alerts],
+                'next_id': self._next_id,
+            }
+
+    def restore(self, state):
+        """Load a state taken by state() after a restart"""
+        with self._lock:
+            for provider, model, metric, slots in state.get('series', []):
+                if metric in METRICS:
+                    self._series[(provider, model, metric)] = Series(METRICS[metric][1], slots)
+            self._alerts.extend(state.get('alerts', []))
+            self._active = {(a['provider'], a['model'], a['metric']): a
+                            for a in self._alerts if a['status'] == 'active'}
+            self._next_id = state.get('next_id', self._next_id)
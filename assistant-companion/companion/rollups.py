@@ -0,0 +1,258 @@
+"""
+Time-series rollups of the query log
+Completed queries are aggregated per minute and per hour, per provider
+and model: counts, chunks, tokens, response size and latency histograms.
+Raw queries and minute rollups then expire under a retention policy,
+while hour rollups are small enough to keep for long-term dashboards
+"""
+
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+RESOLUTIONS = {'minute': MINUTE, 'hour': HOUR}
+
+# Retention in days (0 = keep forever); raw queries feed search, so they
+# are kept much longer than the minute rollups
+DAY = 86400
+RETENTION = {
+    'raw': int(os.environ.get('COMPANION_RETENTION_DAYS', 180)),
+    MINUTE: 14,
+    HOUR: 0,
+}
+
+# Seconds between background passes, and how long a query may still be
+# running before a pass skips past it
+INTERVAL = 60
+GRACE = 5
+
+# Latency histograms use log-spaced buckets: bucket i covers
+# [GAMMA^i, GAMMA^(i+1)) milliseconds, so quantiles are within ~6%
+GAMMA = 1.12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    queries INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    interrupted INTEGER NOT NULL DEFAULT 0,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    response_chars INTEGER NOT NULL DEFAULT 0,
+    latency TEXT NOT NULL DEFAULT '{}',
+    first_chunk TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (resolution, bucket, provider, model)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+COUNTERS = ('queries', 'errors', 'interrupted', 'chunks', 'tokens', 'response_chars')
+
+
+def histogram_add(hist, seconds):
+    """Count a duration into a {bucket index: count} histogram"""
+    ms = max(seconds * 1000, 1)
+    index = str(int(math.log(ms, GAMMA)))
+    hist[index] = hist.get(index, 0) + 1
+
+
+def histogram_merge(into, other):
+    for index, count in other.items():
+        into[index] = into.get(index, 0) + count
+
+
+def histogram_quantile(hist, q):
+    """Approximate quantile in seconds (None for an empty histogram)"""
+    total = sum(hist.values())
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for index in sorted(hist, key=int):
+        seen += hist[index]
+        if seen > rank:
+            # Middle of the bucket, in seconds
+            return GAMMA ** (int(index) + 0.5) / 1000
+    return None
+
+
+class Rollups:
+    """Rollup tables next to the query log, updated by a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rollups', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(INTERVAL):
+            try:
+                self.update()
+                self.expire()
+            except sqlite3.Error as e:
+                logger.error(f"Rollup failed: {e}")
+
+    def update(self, now=None):
+        """
+        Roll up the queries logged since the last pass; returns how many
+        Queries caught up late still land in the bucket of their completion
+        """
+        now = now or time.time()
+        with self._lock:
+            since = self._state('rolled_up_to')
+            until = now - GRACE
+            if until <= since:
+                return 0
+            rows = self._conn.execute(
+                'SELECT started_at, completed_at, first_chunk_at, status, provider, model, '
+                '       chunks, tokens, length(response) AS response_chars '
+                'FROM queries WHERE logged_at >= ? AND logged_at < ?',
+                (since, until)).fetchall()
+
+            buckets = {}
+            for row in rows:
+                for resolution in RESOLUTIONS.values():
+                    bucket = int(row['completed_at'] // resolution) * resolution
+                    key = (resolution, bucket, row['provider'] or '', row['model'] or '')
+                    self._add(buckets.setdefault(key, self._empty()), row)
+
+            for key, agg in buckets.items():
+                self._save(key, agg)
+            self._set_state('rolled_up_to', until)
+            self._conn.commit()
+            return len(rows)
+
+    @staticmethod
+    def _empty():
+        agg = dict.fromkeys(COUNTERS, 0)
+        agg['latency'] = {}
+        agg['first_chunk'] = {}
+        return agg
+
+    @staticmethod
+    def _add(agg, row):
+        agg['queries'] += 1
+        agg['errors'] += row['status'] == 'error'
+        agg['interrupted'] += row['status'] == 'interrupted'
+        agg['chunks'] += row['chunks'] or 0
+        agg['tokens'] += row['tokens'] or 0
+        agg['response_chars'] += row['response_chars'] or 0
+        if row['status'] == 'complete':
+            histogram_add(agg['latency'], row['completed_at'] - row['started_at'])
+        if row['first_chunk_at']:
+            histogram_add(agg['first_chunk'], row['first_chunk_at'] - row['started_at'])
+
+    def _save(self, key, agg):
+        """Merge an aggregate into its stored bucket"""
+        row = self._conn.execute(
+            'SELECT * FROM rollups WHERE resolution = ? AND bucket = ? AND provider = ? AND model = ?',
+            key).fetchone()
+        if row:
+            for counter in COUNTERS:
+                agg[counter] += row[counter]
+            histogram_merge(agg['latency'], json.loads(row['latency']))
+            histogram_merge(agg['first_chunk'], json.loads(row['first_chunk']))
+        self._conn.execute(
+            'INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            key + tuple(agg[c] for c in COUNTERS)
+            + (json.dumps(agg['latency']), json.dumps(agg['first_chunk'])))
+
+    def expire(self, now=None):
+        """Apply the retention policy; returns the number of deleted raw queries"""
+        now = now or time.time()
+        deleted = 0
+        with self._lock:
+            for resolution in RESOLUTIONS.values():
+                if RETENTION[resolution]:
+                    self._conn.execute('DELETE FROM rollups WHERE resolution = ? AND bucket < ?',
+                                       (resolution, now - RETENTION[resolution] * DAY))
+            if RETENTION['raw']:
+                # Only queries that are already rolled up (or never finished)
+                cutoff = now - RETENTION['raw'] * DAY
+                deleted = self._conn.execute(
+                    'DELETE FROM queries WHERE started_at < ? AND (logged_at < ? OR logged_at IS NULL)',
+                    (cutoff, self._state('rolled_up_to'))).rowcount
+                self._conn.execute('DELETE FROM spans WHERE start < ?', (cutoff,))
+            self._conn.commit()
+        if deleted:
+            logger.info(f"Expired {deleted} queries older than {RETENTION['raw']} days")
+        return deleted
+
+    def query(self, resolution, since, until=None, provider=None, model=None, total=False):
+        """
+        Rollup buckets in a time range, oldest first
+        With total, providers and models are merged into one row per bucket.
+        Latency histograms are returned as p50/p90/p99 in seconds
+        """
+        sql = ['SELECT * FROM rollups WHERE resolution = ? AND bucket >= ?']
+        params = [resolution, since]
+        if until is not None:
+            sql.append('AND bucket < ?')
+            params.append(until)
+        if provider:
+            sql.append('AND provider = ?')
+            params.append(provider)
+        if model:
+            sql.append('AND model = ?')
+            params.append(model)
+        sql.append('ORDER BY bucket, provider, model')
+        with self._lock:
+            rows = self._conn.execute(' '.join(sql), params).fetchall()
+
+        merged = {}
+        for row in rows:
+            key = row['bucket'] if total else (row['bucket'], row['provider'], row['model'])
+            result = merged.get(key)
+            if result is None:
+                result = merged[key] = {'bucket': row['bucket'], 'latency': {}, 'first_chunk': {}}
+                if not total:
+                    result.update(provider=row['provider'], model=row['model'])
+            for counter in COUNTERS:
+                result[counter] = result.get(counter, 0) + row[counter]
+            for name in ('latency', 'first_chunk'):
+                histogram_merge(result[name], json.loads(row[name]))
+
+        for result in merged.values():
+            for name in ('latency', 'first_chunk'):
+                hist = result[name]
+                result[name] = {f"p{int(q * 100)}": histogram_quantile(hist, q) for q in (0.5, 0.9, 0.99)}
+        return list(merged.values())
+
+    def _state(self, key):
+        row = self._conn.execute('SELECT value FROM rollup_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_state(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO rollup_state VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,175 @@
+"""
+Warm restart of the companion's in-memory state
+The event rings, duplicate windows, queries still being assembled and
+device clock samples are written to a compact snapshot (gzipped JSON)
+every SNAPSHOT_INTERVAL seconds by a background thread: to a temporary
+file first, then renamed over the previous snapshot, so a crash never
+leaves a partial one. Events stored since the last snapshot go to a
+small tail log. On boot the snapshot is loaded and the tail replayed.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Seconds between snapshots, and tail size (bytes) that forces one sooner
+SNAPSHOT_INTERVAL = float(os.environ.get('COMPANION_SNAPSHOT_INTERVAL', 30))
+MAX_TAIL_BYTES = 8 * 1024 * 1024
+
+# How often the snapshot thread looks at the tail (seconds)
+CHECK_INTERVAL = 5
+
+
+class Snapshots:
+    """Snapshot and tail log files of one data directory"""
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, 'state.snapshot')
+        self.tail_path = os.path.join(data_dir, 'state.tail')
+        # Tail of a snapshot being written, kept until the snapshot is in place
+        self.old_tail_path = self.tail_path + '.1'
+        self._lock = threading.Lock()
+        self._tail = None
+        self._tail_bytes = 0
+        self._written_at = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """The last snapshot, None if there is none (or it cannot be read)"""
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            logger.error(f"Cannot read snapshot {self.path}: {e}")
+            return None
+        if not isinstance(state, dict) or state.get('version') != VERSION:
+            logger.warning(f"Ignoring snapshot {self.path} of another version")
+            return None
+        return state
+
+    def tail(self):
+        """
+        Entries logged since the last snapshot, oldest first: ('event', seq,
+        encoded event) or ('clear',). A torn last line is skipped
+        """
+        for path in (self.old_tail_path, self.tail_path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        if not line.endswith('\n'):
+                            break  # cut off by a crash
+                        kind, _, rest = line[:-1].partition('\t')
+                        if kind == 'e':
+                            seq, _, encoded = rest.partition('\t')
+                            yield ('event', int(seq), encoded)
+                        elif kind == 'c':
+                            yield ('clear',)
+            except FileNotFoundError:
+                continue
+
+    def log_event(self, seq, encoded):
+        """Append a stored event to the tail (flushed by flush())"""
+        self._write(f'e\t{seq}\t{encoded}\n')
+
+    def log_clear(self):
+        self._write('c\n')
+        self.flush()
+
+    def _write(self, line):
+        with self._lock:
+            if self._tail is None:
+                self._tail = open(self.tail_path, 'a', encoding='utf-8')
+                self._tail_bytes = self._tail.tell()
+            self._tail.write(line)
+            self._tail_bytes += len(line)
+
+    def flush(self):
+        """Hand the tail to the OS, once per ingest request"""
+        with self._lock:
+            if self._tail is not None:
+                self._tail.flush()
+
+    def dirty(self):
+        """Whether anything was logged since the last snapshot"""
+        return os.path.exists(self.tail_path) or os.path.exists(self.old_tail_path)
+
+    def rotate(self):
+        """
+        Start a new tail for the snapshot about to be taken
+        Called while ingest is held off, so every event is either in the
+        snapshot or in the new tail
+        """
+        with self._lock:
+            if self._tail is not None:
+                self._tail.close()
+                self._tail = None
+            self._tail_bytes = 0
+            if not os.path.exists(self.tail_path):
+                return
+            if os.path.exists(self.old_tail_path):
+                # The previous snapshot failed: its tail is still needed
+                with open(self.tail_path, encoding='utf-8') as src, \
+                        open(self.old_tail_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(self.tail_path)
+            else:
+                os.replace(self.tail_path, self.old_tail_path)
+
+    def write(self, state):
+        """Write a snapshot atomically and drop the tail it covers"""
+        state = dict(state, version=VERSION, written_at=time.time())
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(state, f, separators=(',', ':'))
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        try:
+            os.remove(self.old_tail_path)
+        except FileNotFoundError:
+            pass
+        self._written_at = time.monotonic()
+
+    def start(self, take):
+        """Take snapshots in the background; take() captures and writes one"""
+        self._thread = threading.Thread(target=self._run, args=(take,), name='snapshots', daemon=True)
+        self._thread.start()
+
+    def _due(self):
+        with self._lock:
+            size = self._tail_bytes
+        if size >= MAX_TAIL_BYTES:
+            return True
+        return time.monotonic() - self._written_at >= SNAPSHOT_INTERVAL and self.dirty()
+
+    def _run(self, take):
+        while not self._stop.wait(min(CHECK_INTERVAL, SNAPSHOT_INTERVAL)):
+            if not self._due():
+                continue
+            try:
+                take()
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"Snapshot failed: {e}")
+
+    def stop(self):
+        """Stop taking snapshots, waiting for one being written"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            if self._tail is not None:
+                self._tail.close()
+                self._tail = None
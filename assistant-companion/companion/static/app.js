@@ -1,190 +1,437 @@
+// Event parsing, storage and aggregation run in a Web Worker (worker.js);
+// this thread only applies the diffs it posts.
+const WORKER_URL = new URL('worker.js', document.currentScript.src);
+const RAW_ROW_HEIGHT = 44;          // px, fixed row heights of the virtual lists
+const PROMPT_ROW_HEIGHT = 64;
+const MAX_OUTPUT_QUERIES = 200;     // query blocks kept in the live output
+
 // Global state
-let eventSource = null;
-let allEvents = [];
-let stats = {
-    total: 0,
-    query_start: 0,
-    stream_chunk: 0,
-    query_complete: 0,
-    error: 0,
-    heartbeat: 0
-};
+let worker = null;
+let pendingDiffs = [];
+let flushScheduled = false;
+let openBlocks = new Map();         // device -> output block of the query it is streaming
+let lastBlocks = new Map();         // device -> its most recent output block
+let queryBlocks = new Map();        // query id -> output block, for its trace
+let rawList = null;
+let promptList = null;
 
 // Initialize on page load
 document.addEventListener('DOMContentLoaded', () => {
-    connectToStream();
-    setInterval(updateStats, 2000);
+    rawList = new VirtualList('raw', {
+        rowHeight: RAW_ROW_HEIGHT,
+        renderRow: renderRawRow
+    });
+    promptList = new VirtualList('prompts', {
+        rowHeight: PROMPT_ROW_HEIGHT,
+        renderRow: renderPromptRow
+    });
+    startWorker();
 });
 
-// Connect to Server-Sent Events stream
-function connectToStream() {
+// Start the worker, it connects to the Server-Sent Events stream itself
+function startWorker() {
     const statusEl = document.getElementById('connection-status');
     statusEl.textContent = '⚪ Connecting...';
     statusEl.className = 'status-disconnected';
     
-    eventSource = new EventSource('/stream');
+    worker = new Worker(WORKER_URL);
+    worker.onmessage = (e) => handleWorkerMessage(e.data);
+    worker.onerror = (err) => console.error('Worker error:', err);
+    worker.postMessage({ type: 'connect', url: streamUrl('') });
     
-    eventSource.onopen = () => {
+    // Devices that reported before the page was opened
+    fetch('/api/stats')
+        .then(res => res.json())
+        .then(stats => addDeviceOptions(Object.keys(stats.devices || {})))
+        .catch(err => console.error('Error loading devices:', err));
+}
+
+function streamUrl(device) {
+    const url = new URL('/stream', location.href);
+    if (device) url.searchParams.set('device', device);
+    return url.href;
+}
+
+// Show one device only: the worker reconnects to that device's stream
+function selectDevice(device) {
+    resetView();
+    worker.postMessage({ type: 'connect', url: streamUrl(device) });
+}
+
+function addDeviceOptions(devices) {
+    const select = document.getElementById('device-filter');
+    const known = new Set(Array.from(select.options, option => option.value));
+    devices.filter(device => !known.has(device)).sort().forEach(device => {
+        const option = document.createElement('option');
+        option.value = device;
+        option.textContent = device;
+        select.appendChild(option);
+    });
+}
+
+function handleWorkerMessage(msg) {
+    switch (msg.type) {
+        case 'status':
+            updateConnectionStatus(msg.connected);
+            break;
+        case 'diff':
+            pendingDiffs.push(msg);
+            scheduleFlush();
+            break;
+        case 'rows':
+            (msg.list === 'raw' ? rawList : promptList).receiveRows(msg);
+            break;
+        case 'detail':
+            if (msg.list === 'raw') {
+                showRawDetail(msg);
+            } else {
+                showPromptDetail(msg);
+            }
+            break;
+    }
+}
+
+function updateConnectionStatus(connected) {
+    const statusEl = document.getElementById('connection-status');
+    if (connected) {
         console.log('Connected to event stream');
         statusEl.textContent = '🟢 Connected';
         statusEl.className = 'status-connected';
-    };
-    
-    eventSource.onmessage = (e) => {
-        try {
-            const event = JSON.parse(e.data);
-            handleEvent(event);
-        } catch (err) {
-            console.error('Error parsing event:', err);
-        }
-    };
-    
-    eventSource.onerror = (err) => {
-        console.error('EventSource error:', err);
+    } else {
+        console.error('EventSource error, reconnecting');
         statusEl.textContent = '🔴 Disconnected';
         statusEl.className = 'status-disconnected';
-        
-        // Try to reconnect after 3 seconds
-        setTimeout(() => {
-            eventSource.close();
-            connectToStream();
-        }, 3000);
-    };
-}
-
-// Handle incoming event
-function handleEvent(event) {
-    allEvents.push(event);
-    
-    // Update stats
-    stats.total++;
-    const eventType = event.event || 'unknown';
-    if (stats[eventType] !== undefined) {
-        stats[eventType]++;
     }
+}
+
+// Diffs are applied at most once per animation frame
+function scheduleFlush() {
+    if (flushScheduled) return;
+    flushScheduled = true;
+    // Animation frames are paused in background tabs, keep draining anyway
+    if (document.hidden) {
+        setTimeout(flushDiffs, 500);
+    } else {
+        requestAnimationFrame(flushDiffs);
+    }
+}
+
+function flushDiffs() {
+    flushScheduled = false;
+    if (pendingDiffs.length === 0) return;
     
-    // Update event count display
-    document.getElementById('event-count').textContent = `${stats.total} events`;
+    const diffs = pendingDiffs;
+    pendingDiffs = [];
     
-    // Route to appropriate handler
-    switch (eventType) {
-        case 'query_start':
-            handleQueryStart(event);
+    const output = document.getElementById('output');
+    const stickToBottom = isScrolledToBottom(output);
+    removeEmptyState(output);
+    
+    let stats = null;
+    diffs.forEach(diff => {
+        diff.ops.forEach(applyOp);
+        rawList.update(diff.raw);
+        promptList.update(diff.prompts);
+        if (diff.stats) stats = diff.stats;
+    });
+    
+    // One layout pass per frame instead of one per event
+    const last = diffs[diffs.length - 1];
+    document.getElementById('event-count').textContent = `${last.total} events`;
+    rawList.render();
+    promptList.render();
+    if (stats) updateStats(stats);
+    if (stickToBottom) {
+        output.scrollTop = output.scrollHeight;
+    }
+}
+
+// Apply one live output change
+function applyOp(op) {
+    switch (op.op) {
+        case 'start':
+            handleQueryStart(op);
             break;
-        case 'stream_chunk':
-            handleStreamChunk(event);
+        case 'content':
+        case 'reasoning':
+            handleStreamText(op);
             break;
-        case 'query_complete':
-            handleQueryComplete(event);
+        case 'complete':
+            handleQueryComplete(op);
             break;
         case 'error':
-            handleError(event);
+            handleError(op);
             break;
-        case 'heartbeat':
-            // Silent, just for connection check
+        case 'trace': {
+            // Spans arrive after the query ended, in its block if still shown
+            const block = queryBlocks.get(op.queryId);
+            if (block && block.element.isConnected) loadTrace(op.queryId, block.element);
+            break;
+        }
+        case 'regression':
+            handleRegression(op);
             break;
-        default:
-            console.log('Unknown event type:', eventType);
     }
-    
-    // Always update raw events tab
-    updateRawEvents(event);
 }
 
-// Handle query start event
-function handleQueryStart(event) {
-    const output = document.getElementById('output');
-    const data = event.data || {};
+// Handle query start
+function handleQueryStart(op) {
+    const block = startQueryBlock(op);
     
     const header = document.createElement('div');
     header.className = 'query-header';
     header.innerHTML = `
         <strong>📤 NEW QUERY</strong><br>
-        Provider: ${data.provider || 'unknown'}<br>
-        Model: ${data.model || 'unknown'}<br>
-        Title: ${data.title || 'untitled'}<br>
-        Time: ${formatTime(event.timestamp)}
+        Device: ${escapeHtml(op.device)}<br>
+        Provider: ${escapeHtml(op.provider)}<br>
+        Model: ${escapeHtml(op.model)}<br>
+        Title: ${escapeHtml(op.title)}<br>
+        Time: ${formatTime(op.timestamp)}
     `;
-    output.appendChild(header);
-    
-    // Add to prompts tab
-    updatePrompts(event);
-    
-    // Auto-scroll
-    output.scrollTop = output.scrollHeight;
+    block.element.appendChild(header);
 }
 
-// Handle streaming chunk
-function handleStreamChunk(event) {
-    const output = document.getElementById('output');
-    const data = event.data || {};
-    
-    if (data.reasoning) {
-        const reasoning = document.createElement('span');
-        reasoning.className = 'reasoning';
-        reasoning.textContent = `[Thinking: ${data.reasoning}]\n`;
-        output.appendChild(reasoning);
-    }
-    
-    if (data.content) {
-        const chunk = document.createElement('span');
-        chunk.className = 'chunk';
-        chunk.textContent = data.content;
-        output.appendChild(chunk);
+// Handle streamed text, already merged per batch by the worker
+function handleStreamText(op) {
+    const block = queryBlock(op);
+    
+    // Text is kept in one text node per query and kind
+    if (op.op === 'reasoning') {
+        if (!block.reasoning) {
+            block.reasoning = appendTextSpan(block.element, 'reasoning', '💭 ');
+        }
+        block.reasoning.appendData(op.text);
+    } else {
+        if (!block.content) {
+            if (block.reasoning) block.reasoning.appendData('\n');
+            block.content = appendTextSpan(block.element, 'chunk', '');
+        }
+        block.content.appendData(op.text);
     }
-    
-    // Auto-scroll
-    output.scrollTop = output.scrollHeight;
 }
 
 // Handle query complete
-function handleQueryComplete(event) {
-    const output = document.getElementById('output');
-    const data = event.data || {};
-    
+function handleQueryComplete(op) {
     const complete = document.createElement('div');
     complete.className = 'query-header';
     complete.style.background = 'rgba(206, 145, 120, 0.1)';
     complete.style.borderLeftColor = '#ce9178';
     
     let info = '<strong>✅ QUERY COMPLETE</strong><br>';
-    if (data.tokens) {
-        info += `Tokens: ${data.tokens.prompt || 0} prompt + ${data.tokens.completion || 0} completion<br>`;
+    // Reporters send the provider's usage; older ones sent tokens
+    const usage = op.usage || {};
+    const tokens = op.tokens || {};
+    if (op.usage || op.tokens) {
+        const prompt = usage.prompt_tokens || tokens.prompt || 0;
+        const completion = usage.completion_tokens || tokens.completion || 0;
+        info += `Tokens: ${prompt} prompt + ${completion} completion<br>`;
     }
-    if (data.duration) {
-        info += `Duration: ${data.duration}ms<br>`;
+    if (op.duration) {
+        info += `Duration: ${op.duration}ms<br>`;
     }
-    info += `Time: ${formatTime(event.timestamp)}`;
+    info += `Time: ${formatTime(op.timestamp)}`;
     
     complete.innerHTML = info;
-    output.appendChild(complete);
-    
-    // Auto-scroll
-    output.scrollTop = output.scrollHeight;
+    queryBlock(op).element.appendChild(complete);
+    openBlocks.delete(op.device);
 }
 
-// Handle error event
-function handleError(event) {
-    const output = document.getElementById('output');
-    const data = event.data || {};
-    
+// Handle error
+function handleError(op) {
     const error = document.createElement('div');
     error.className = 'error-message';
     error.innerHTML = `
         <strong>❌ ERROR</strong><br>
-        ${data.message || 'Unknown error'}<br>
-        Time: ${formatTime(event.timestamp)}
+        ${escapeHtml(op.message)}<br>
+        Time: ${formatTime(op.timestamp)}
     `;
-    output.appendChild(error);
+    queryBlock(op).element.appendChild(error);
+    openBlocks.delete(op.device);
+}
+
+// Handle a latency regression raised or resolved by the device's last query
+function handleRegression(op) {
+    const alert = op.alert;
+    const notice = document.createElement('div');
+    notice.className = alert.status === 'active' ? 'error-message' : 'regression-resolved';
+    notice.innerHTML = `
+        <strong>${alert.status === 'active' ? '⚠️ REGRESSION' : '✅ RECOVERED'}</strong><br>
+        ${escapeHtml(alert.provider)}/${escapeHtml(alert.model)}: ${escapeHtml(alert.metric)}
+        ${escapeHtml(alert.quantile)} ${alert.baseline} → ${alert.current} ${escapeHtml(alert.unit)} (×${alert.ratio})<br>
+        Time: ${formatTime(op.timestamp)}
+    `;
+    (lastBlocks.get(op.device) || startQueryBlock(op)).element.appendChild(notice);
+}
+
+// Open block of the op's query, a new one if its device streams another query
+function queryBlock(op) {
+    const block = openBlocks.get(op.device);
+    if (block && block.queryId === op.queryId) return block;
+    return startQueryBlock(op);
+}
+
+// Start a new output block, dropping the oldest ones past the limit
+function startQueryBlock(op) {
+    const output = document.getElementById('output');
+    const element = document.createElement('div');
+    element.className = 'query-block';
+    output.appendChild(element);
+    
+    while (output.children.length > MAX_OUTPUT_QUERIES) {
+        output.removeChild(output.firstChild);
+    }
+    
+    const block = { element, device: op.device, queryId: op.queryId, content: null, reasoning: null };
+    openBlocks.set(op.device, block);
+    lastBlocks.set(op.device, block);
+    if (op.queryId) {
+        queryBlocks.set(op.queryId, block);
+        // Maps keep insertion order, the first entry is the oldest block
+        if (queryBlocks.size > MAX_OUTPUT_QUERIES) {
+            queryBlocks.delete(queryBlocks.keys().next().value);
+        }
+    }
+    return block;
+}
+
+function appendTextSpan(parent, className, text) {
+    const span = document.createElement('span');
+    span.className = className;
+    const node = document.createTextNode(text);
+    span.appendChild(node);
+    parent.appendChild(span);
+    return node;
+}
+
+function isScrolledToBottom(element) {
+    return element.scrollHeight - element.scrollTop - element.clientHeight < 40;
+}
+
+// Virtualized list: only the rows in view exist in the DOM.
+// Items live in the worker, visible rows are requested as compact summaries.
+class VirtualList {
+    constructor(name, { rowHeight, renderRow }) {
+        this.name = name;
+        this.container = document.getElementById(name);
+        this.rowHeight = rowHeight;
+        this.renderRow = renderRow;
+        this.count = 0;
+        this.added = 0;
+        this.version = 0;
+        this.rows = new Map();      // index -> summary
+        this.requested = false;
+        this.pool = [];
+        this.frame = null;
+        
+        this.spacer = document.createElement('div');
+        this.spacer.className = 'virtual-spacer';
+        this.container.appendChild(this.spacer);
+        
+        this.container.addEventListener('scroll', () => {
+            if (this.frame) return;
+            this.frame = requestAnimationFrame(() => {
+                this.frame = null;
+                this.render();
+            });
+        });
+    }
+    
+    update({ count, added, reset }) {
+        if (reset) {
+            this.container.scrollTop = 0;
+            this.added = 0;
+        } else if (added === 0 && count === this.count) {
+            return;
+        }
+        this.count = count;
+        this.added += reset ? 0 : added;
+        // Indexes shifted, cached summaries are stale
+        this.version++;
+        this.rows.clear();
+        this.requested = false;
+    }
+    
+    receiveRows({ from, version, rows }) {
+        this.requested = false;
+        if (version !== this.version) {
+            this.render();
+            return;
+        }
+        rows.forEach((row, i) => this.rows.set(from + i, row));
+        this.render();
+    }
     
-    // Auto-scroll
-    output.scrollTop = output.scrollHeight;
+    render() {
+        const container = this.container;
+        
+        this.spacer.style.height = `${this.count * this.rowHeight}px`;
+        container.classList.toggle('is-empty', this.count === 0);
+        
+        // Keep the rows the user is looking at in place while new ones arrive on top
+        if (this.added > 0 && container.scrollTop > 0) {
+            container.scrollTop += this.added * this.rowHeight;
+        }
+        this.added = 0;
+        
+        // Hidden tabs have no height, they render when shown
+        if (container.clientHeight === 0) return;
+        
+        const overscan = 5;
+        const first = Math.max(0, Math.floor(container.scrollTop / this.rowHeight) - overscan);
+        const last = Math.min(this.count, first + Math.ceil(container.clientHeight / this.rowHeight) + 2 * overscan);
+        
+        while (this.pool.length < last - first) {
+            const row = document.createElement('div');
+            row.className = 'virtual-row';
+            row.style.height = `${this.rowHeight}px`;
+            row.onclick = () => {
+                if (row.summary) worker.postMessage({ type: 'detail', list: this.name, seq: row.summary.seq });
+            };
+            this.spacer.appendChild(row);
+            this.pool.push(row);
+        }
+        
+        let missing = false;
+        this.pool.forEach((row, i) => {
+            const index = first + i;
+            if (index >= last) {
+                row.style.display = 'none';
+                row.summary = null;
+                return;
+            }
+            row.style.display = '';
+            row.style.transform = `translateY(${index * this.rowHeight}px)`;
+            
+            // Keep showing the old content until the worker answers
+            const summary = this.rows.get(index);
+            if (summary === undefined) {
+                missing = true;
+            } else if (summary && (!row.summary || row.summary.seq !== summary.seq)) {
+                row.summary = summary;
+                this.renderRow(row, summary);
+            }
+        });
+        
+        if (missing && !this.requested) {
+            this.requested = true;
+            worker.postMessage({ type: 'rows', list: this.name, from: first, to: last, version: this.version });
+        }
+    }
+}
+
+// Prompts tab: one summary row per query, full history on click
+function renderPromptRow(row, summary) {
+    row.innerHTML = `
+        <div class="prompt-meta">
+            <span class="provider">${escapeHtml(summary.provider)} / ${escapeHtml(summary.model)}</span>
+            <span class="time">${escapeHtml(summary.title)} · ${formatTime(summary.timestamp)}</span>
+        </div>
+        <div class="row-preview">${escapeHtml(summary.preview)}</div>
+    `;
 }
 
-// Update prompts display
-function updatePrompts(event) {
-    const prompts = document.getElementById('prompts');
-    const data = event.data || {};
+function showPromptDetail(detail) {
+    const pane = document.getElementById('prompt-detail');
     
     const card = document.createElement('div');
     card.className = 'prompt-card';
@@ -192,101 +439,249 @@ function updatePrompts(event) {
     const meta = document.createElement('div');
     meta.className = 'prompt-meta';
     meta.innerHTML = `
-        <span class="provider">${data.provider || 'unknown'} / ${data.model || 'unknown'}</span>
-        <span class="time">${formatTime(event.timestamp)}</span>
+        <span class="provider">${escapeHtml(detail.provider)} / ${escapeHtml(detail.model)}</span>
+        <span class="time">${formatTime(detail.timestamp)}</span>
     `;
     card.appendChild(meta);
     
-    if (data.history && Array.isArray(data.history)) {
-        const history = document.createElement('div');
-        history.className = 'message-history';
-        
-        data.history.forEach(msg => {
-            const msgDiv = document.createElement('div');
-            msgDiv.className = `message ${msg.role || 'user'}`;
-            msgDiv.innerHTML = `
-                <div class="message-role">${msg.role || 'user'}</div>
-                <div class="message-content">${escapeHtml(msg.content || '')}</div>
-            `;
-            history.appendChild(msgDiv);
-        });
-        
-        card.appendChild(history);
-    }
+    const history = document.createElement('div');
+    history.className = 'message-history';
     
-    prompts.insertBefore(card, prompts.firstChild);
-}
-
-// Update raw events display
-function updateRawEvents(event) {
-    const raw = document.getElementById('raw');
+    detail.history.forEach(msg => {
+        const msgDiv = document.createElement('div');
+        msgDiv.className = `message ${msg.role || 'user'}`;
+        msgDiv.innerHTML = `
+            <div class="message-role">${escapeHtml(msg.role || 'user')}</div>
+            <div class="message-content">${escapeHtml(msg.content || '')}</div>
+        `;
+        history.appendChild(msgDiv);
+    });
     
-    const eventDiv = document.createElement('div');
-    eventDiv.className = 'raw-event';
+    card.appendChild(history);
     
-    const header = document.createElement('div');
-    header.className = 'raw-event-header';
-    header.innerHTML = `
-        <span class="event-type ${event.event || 'unknown'}">${event.event || 'unknown'}</span>
-        <span class="event-time">${formatTime(event.timestamp)}</span>
+    pane.innerHTML = '';
+    pane.appendChild(card);
+}
+
+// Raw events tab: one line per event, full JSON on click
+function renderRawRow(row, summary) {
+    row.innerHTML = `
+        <span class="event-type ${escapeHtml(summary.type)}">${escapeHtml(summary.type)}</span>
+        <span class="event-time">${formatTime(summary.timestamp)}</span>
+        <span class="row-preview">${escapeHtml(summary.preview)}</span>
     `;
-    eventDiv.appendChild(header);
+}
+
+function showRawDetail(detail) {
+    const pane = document.getElementById('raw-detail');
     
     const body = document.createElement('pre');
     body.className = 'raw-event-body';
-    body.textContent = JSON.stringify(event, null, 2);
-    eventDiv.appendChild(body);
+    body.textContent = detail.json;
     
-    raw.insertBefore(eventDiv, raw.firstChild);
-    
-    // Keep only last 100 events in DOM
-    while (raw.children.length > 100) {
-        raw.removeChild(raw.lastChild);
-    }
+    pane.innerHTML = '';
+    pane.appendChild(body);
+}
+
+// Filtering runs in the worker, typing never blocks on the event store
+let filterTimer = null;
+
+function filterRaw() {
+    clearTimeout(filterTimer);
+    filterTimer = setTimeout(() => {
+        worker.postMessage({ type: 'filter', text: document.getElementById('raw-filter').value });
+    }, 150);
 }
 
-// Update statistics
-function updateStats() {
+// Update statistics from a worker snapshot
+function updateStats(stats) {
     document.getElementById('stat-total').textContent = stats.total;
     document.getElementById('stat-queries').textContent = stats.query_start;
     document.getElementById('stat-chunks').textContent = stats.stream_chunk;
     document.getElementById('stat-errors').textContent = stats.error;
+    addDeviceOptions(Object.keys(stats.devices));
     
     // Update detailed stats
     const details = document.getElementById('stats-details');
-    if (details && allEvents.length > 0) {
-        const providers = {};
-        const models = {};
-        
-        allEvents.forEach(event => {
-            if (event.event === 'query_start' && event.data) {
-                const provider = event.data.provider || 'unknown';
-                const model = event.data.model || 'unknown';
-                providers[provider] = (providers[provider] || 0) + 1;
-                models[model] = (models[model] || 0) + 1;
-            }
+    if (!details) return;
+    if (stats.query_start === 0) {
+        details.innerHTML = '';
+        return;
+    }
+    
+    let html = '<h3 style="margin-bottom: 1rem; color: #4ec9b0;">Breakdown</h3>';
+    
+    if (Object.keys(stats.providers).length > 0) {
+        html += '<h4 style="color: #999; margin-top: 1rem;">Providers</h4><ul style="list-style: none; padding-left: 1rem;">';
+        Object.entries(stats.providers).forEach(([provider, count]) => {
+            html += `<li style="margin: 0.5rem 0;"><strong>${escapeHtml(provider)}</strong>: ${count} queries</li>`;
         });
-        
-        let html = '<h3 style="margin-bottom: 1rem; color: #4ec9b0;">Breakdown</h3>';
-        
-        if (Object.keys(providers).length > 0) {
-            html += '<h4 style="color: #999; margin-top: 1rem;">Providers</h4><ul style="list-style: none; padding-left: 1rem;">';
-            Object.entries(providers).forEach(([provider, count]) => {
-                html += `<li style="margin: 0.5rem 0;"><strong>${provider}</strong>: ${count} queries</li>`;
-            });
-            html += '</ul>';
-        }
-        
-        if (Object.keys(models).length > 0) {
-            html += '<h4 style="color: #999; margin-top: 1rem;">Models</h4><ul style="list-style: none; padding-left: 1rem;">';
-            Object.entries(models).forEach(([model, count]) => {
-                html += `<li style="margin: 0.5rem 0;"><strong>${model}</strong>: ${count} queries</li>`;
-            });
-            html += '</ul>';
-        }
-        
-        details.innerHTML = html;
+        html += '</ul>';
+    }
+    
+    if (Object.keys(stats.models).length > 0) {
+        html += '<h4 style="color: #999; margin-top: 1rem;">Models</h4><ul style="list-style: none; padding-left: 1rem;">';
+        Object.entries(stats.models).forEach(([model, count]) => {
+            html += `<li style="margin: 0.5rem 0;"><strong>${escapeHtml(model)}</strong>: ${count} queries</li>`;
+        });
+        html += '</ul>';
+    }
+    
+    details.innerHTML = html;
+}
+
+// Hourly history of the last 24 hours, from the server's rollups
+function loadHistory() {
+    const since = Math.floor(Date.now() / 1000) - 24 * 3600;
+    fetch(`/api/rollups?resolution=hour&group=total&since=${since}`)
+        .then(res => res.json())
+        .then(data => renderHistory(data.buckets))
+        .catch(err => console.error('Error loading history:', err));
+}
+
+function renderHistory(buckets) {
+    const container = document.getElementById('stats-history');
+    if (!buckets.length) {
+        container.innerHTML = '';
+        return;
+    }
+    const seconds = (value) => value === null ? '-' : `${value.toFixed(1)}s`;
+    let html = '<h3 style="margin-bottom: 1rem; color: #4ec9b0;">Last 24 hours</h3>';
+    html += '<table><thead><tr><th>Hour</th><th>Queries</th><th>Errors</th><th>Tokens</th>' +
+        '<th>First chunk p50</th><th>Latency p50</th><th>Latency p90</th></tr></thead><tbody>';
+    buckets.slice().reverse().forEach(bucket => {
+        html += `<tr><td>${formatTime(bucket.bucket)}</td><td>${bucket.queries}</td>` +
+            `<td>${bucket.errors}</td><td>${bucket.tokens}</td>` +
+            `<td>${seconds(bucket.first_chunk.p50)}</td><td>${seconds(bucket.latency.p50)}</td>` +
+            `<td>${seconds(bucket.latency.p90)}</td></tr>`;
+    });
+    container.innerHTML = html + '</tbody></table>';
+}
+
+// Search past queries
+let searchTimer = null;
+
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runSearch, 250);
+}
+
+function runSearch() {
+    const q = document.getElementById('search-input').value.trim();
+    const status = document.getElementById('search-status');
+    const results = document.getElementById('search-results');
+    
+    if (!q) {
+        status.textContent = '';
+        results.innerHTML = '';
+        return;
+    }
+    
+    const params = new URLSearchParams({ q });
+    const type = document.getElementById('search-type').value;
+    const provider = document.getElementById('search-provider').value.trim();
+    if (type) params.set('type', type);
+    if (provider) params.set('provider', provider);
+    
+    fetch(`/api/search?${params}`)
+        .then(res => res.json())
+        .then(data => {
+            if (data.error) {
+                status.textContent = data.error;
+                return;
+            }
+            const more = data.has_more ? '+' : '';
+            status.textContent = `${data.results.length}${more} matches in ${data.took_ms} ms`;
+            results.innerHTML = '';
+            data.results.forEach(result => results.appendChild(renderSearchResult(result)));
+        })
+        .catch(err => console.error('Error searching:', err));
+}
+
+function renderSearchResult(result) {
+    const card = document.createElement('div');
+    card.className = 'prompt-card search-result';
+    
+    const meta = document.createElement('div');
+    meta.className = 'prompt-meta';
+    meta.innerHTML = `
+        <span class="provider">${escapeHtml(result.provider || 'unknown')} / ${escapeHtml(result.model || 'unknown')}</span>
+        <span class="time">${escapeHtml(result.title || '')} · ${formatTime(result.started_at)}</span>
+    `;
+    card.appendChild(meta);
+    
+    // Snippets are escaped server-side, only <mark> tags are HTML
+    const snippet = document.createElement('div');
+    snippet.className = 'message-content';
+    snippet.innerHTML = result.snippet;
+    card.appendChild(snippet);
+    
+    card.onclick = () => toggleQueryDetails(card, result.id);
+    return card;
+}
+
+function toggleQueryDetails(card, queryId) {
+    const existing = card.querySelector('.message-history');
+    if (existing) {
+        existing.remove();
+        return;
     }
+    
+    fetch(`/api/queries/${queryId}`)
+        .then(res => res.json())
+        .then(query => {
+            const history = document.createElement('div');
+            history.className = 'message-history';
+            [['user', query.prompt], ['assistant', query.response || query.error || '']].forEach(([role, text]) => {
+                const msgDiv = document.createElement('div');
+                msgDiv.className = `message ${role}`;
+                msgDiv.innerHTML = `
+                    <div class="message-role">${role === 'user' ? 'prompt' : 'response'}</div>
+                    <div class="message-content">${escapeHtml(text)}</div>
+                `;
+                history.appendChild(msgDiv);
+            });
+            card.appendChild(history);
+            loadTrace(queryId, history);
+        })
+        .catch(err => console.error('Error loading query:', err));
+}
+
+// On-device timings of a query as a waterfall, replacing an older one
+function loadTrace(queryId, container) {
+    fetch(`/api/queries/${queryId}/trace`)
+        .then(res => res.ok ? res.json() : null)
+        .then(trace => {
+            if (!trace) return;
+            const existing = container.querySelector('.waterfall');
+            const waterfall = renderWaterfall(trace);
+            if (existing) {
+                container.replaceChild(waterfall, existing);
+            } else {
+                container.appendChild(waterfall);
+            }
+        })
+        .catch(err => console.error('Error loading trace:', err));
+}
+
+function renderWaterfall(trace) {
+    const element = document.createElement('div');
+    element.className = 'waterfall';
+    const total = Math.max(trace.duration_ms, 1);
+    let html = `<div class="waterfall-title">⏱ ${trace.duration_ms.toFixed(0)} ms on device</div>`;
+    trace.spans.forEach(span => {
+        const left = (span.offset_ms / total) * 100;
+        const width = Math.max((span.duration_ms / total) * 100, 0.5);
+        // Totals (parsing, rendering) are spread over their parent span
+        const label = span.attrs.total ? `${span.name} (total)` : span.name;
+        html += `<div class="waterfall-row">` +
+            `<span class="waterfall-name" style="padding-left: ${span.depth}em">${escapeHtml(label)}</span>` +
+            `<span class="waterfall-track"><span class="waterfall-bar span-${escapeHtml(span.name)}" ` +
+            `style="left: ${left}%; width: ${width}%"></span></span>` +
+            `<span class="waterfall-time">${span.duration_ms.toFixed(0)} ms</span></div>`;
+    });
+    element.innerHTML = html;
+    return element;
 }
 
 // Tab switching
@@ -303,19 +698,19 @@ function showTab(tabName) {
     });
     document.getElementById(`${tabName}-tab`).classList.add('active');
     
+    // Virtual lists skip rendering while hidden
+    if (tabName === 'raw') rawList.render();
+    if (tabName === 'prompts') promptList.render();
+    if (tabName === 'stats') loadHistory();
+    
     // Show empty state if needed
     checkEmptyState(tabName);
 }
 
 // Check and show empty state
 function checkEmptyState(tabName) {
-    const containers = {
-        'output': document.getElementById('output'),
-        'prompts': document.getElementById('prompts'),
-        'raw': document.getElementById('raw')
-    };
-    
-    const container = containers[tabName];
+    // Virtual lists show their own empty state (.is-empty)
+    const container = tabName === 'output' ? document.getElementById('output') : null;
     if (!container) return;
     
     if (container.children.length === 0) {
@@ -329,6 +724,11 @@ function checkEmptyState(tabName) {
     }
 }
 
+function removeEmptyState(container) {
+    const empty = container.querySelector(':scope > .empty-state');
+    if (empty) empty.remove();
+}
+
 // Clear all events
 function clearEvents() {
     if (!confirm('Clear all events?')) return;
@@ -336,28 +736,28 @@ function clearEvents() {
     fetch('/api/clear', { method: 'POST' })
         .then(res => res.json())
         .then(() => {
-            allEvents = [];
-            stats = {
-                total: 0,
-                query_start: 0,
-                stream_chunk: 0,
-                query_complete: 0,
-                error: 0,
-                heartbeat: 0
-            };
-            
-            document.getElementById('output').innerHTML = '';
-            document.getElementById('prompts').innerHTML = '';
-            document.getElementById('raw').innerHTML = '';
-            
-            updateStats();
-            
-            // Show empty states
-            ['output', 'prompts', 'raw'].forEach(checkEmptyState);
+            // The worker answers with a reset diff for the lists and stats
+            worker.postMessage({ type: 'clear' });
+            resetView();
         })
         .catch(err => console.error('Error clearing events:', err));
 }
 
+// Empty the output and detail panes; lists are reset by the worker's next diff
+function resetView() {
+    pendingDiffs = [];
+    openBlocks.clear();
+    lastBlocks.clear();
+    queryBlocks.clear();
+    
+    document.getElementById('output').innerHTML = '';
+    document.getElementById('raw-detail').innerHTML = '';
+    document.getElementById('prompt-detail').innerHTML = '';
+    
+    // Show empty states
+    checkEmptyState('output');
+}
+
 // Utility functions
 function formatTime(timestamp) {
     if (!timestamp) return 'N/A';
@@ -373,5 +773,7 @@ function escapeHtml(text) {
 
 // Initialize empty states
 window.addEventListener('load', () => {
-    ['output', 'prompts', 'raw'].forEach(checkEmptyState);
+    checkEmptyState('output');
+    rawList.render();
+    promptList.render();
 });
@@ -0,0 +1,405 @@
+// Dashboard worker
+// Owns the event store: reads the SSE stream, parses and aggregates events
+// and answers row/detail requests, so the UI thread only applies small diffs.
+
+// Limits that keep a long-running tab bounded
+const MAX_EVENTS = 5000;            // events kept for the raw tab
+const MAX_PROMPTS = 1000;           // queries kept for the prompts tab
+const FLUSH_INTERVAL = 50;          // ms between diffs posted to the UI
+const STATS_INTERVAL = 1000;        // ms between stats snapshots
+const PREVIEW_LENGTH = 300;
+
+// Fixed-size buffer that overwrites its oldest entries,
+// items are addressed by their sequence number (0 = first ever pushed)
+class RingBuffer {
+    constructor(capacity) {
+        this.capacity = capacity;
+        this.clear();
+    }
+
+    clear() {
+        this.data = new Array(this.capacity);
+        this.total = 0;
+    }
+
+    get length() {
+        return Math.min(this.total, this.capacity);
+    }
+
+    get oldest() {
+        return this.total - this.length;
+    }
+
+    push(item) {
+        this.data[this.total % this.capacity] = item;
+        return this.total++;
+    }
+
+    bySeq(seq) {
+        if (seq < this.oldest || seq >= this.total) return undefined;
+        return this.data[seq % this.capacity];
+    }
+}
+
+let source = null;
+let streamUrl = null;
+let streamAbort = null;             // aborts the fetch-based reader
+let reconnectTimer = null;
+let events = new RingBuffer(MAX_EVENTS);
+let prompts = new RingBuffer(MAX_PROMPTS);
+let stats = newStats();
+let statsDirty = true;
+let lastStatsPost = 0;
+
+// Raw tab filter: null, or the matching event seqs in arrival order
+let rawFilter = '';
+let rawMatches = null;
+
+// Diff accumulated since the last post
+let ops = [];
+let rawAdded = 0;
+let promptsAdded = 0;
+let resetRaw = false;
+let flushTimer = null;
+let statsTimer = null;
+
+function newStats() {
+    return {
+        total: 0,
+        query_start: 0,
+        stream_chunk: 0,
+        query_complete: 0,
+        error: 0,
+        heartbeat: 0,
+        providers: {},
+        models: {},
+        devices: {}
+    };
+}
+
+self.onmessage = (e) => {
+    const msg = e.data;
+    switch (msg.type) {
+        case 'connect':
+            // A new URL (other device) starts over with an empty store
+            if (streamUrl) {
+                disconnect();
+                reset();
+            }
+            streamUrl = msg.url;
+            connect();
+            break;
+        case 'rows':
+            postRows(msg);
+            break;
+        case 'detail':
+            postDetail(msg);
+            break;
+        case 'filter':
+            setRawFilter(msg.text || '');
+            break;
+        case 'clear':
+            reset();
+            break;
+    }
+};
+
+function reset() {
+    events.clear();
+    prompts.clear();
+    stats = newStats();
+    statsDirty = true;
+    rawMatches = rawFilter ? [] : null;
+    ops = [];
+    resetRaw = true;
+    scheduleFlush();
+}
+
+// Server-Sent Events, with a fetch-based reader where workers lack EventSource
+function connect() {
+    if (typeof EventSource === 'undefined') {
+        streamWithFetch();
+        return;
+    }
+
+    const current = new EventSource(streamUrl);
+    source = current;
+    current.onopen = () => postStatus(true);
+    current.onmessage = (e) => ingest(e.data);
+    current.onerror = () => {
+        postStatus(false);
+        current.close();
+        // Try to reconnect after 3 seconds
+        if (source === current) reconnectTimer = setTimeout(connect, 3000);
+    };
+}
+
+function disconnect() {
+    clearTimeout(reconnectTimer);
+    if (source) source.close();
+    if (streamAbort) streamAbort.abort();
+    source = null;
+    streamAbort = null;
+}
+
+async function streamWithFetch() {
+    const abort = new AbortController();
+    streamAbort = abort;
+    try {
+        const res = await fetch(streamUrl, {
+            headers: { 'Accept': 'text/event-stream' },
+            signal: abort.signal
+        });
+        postStatus(true);
+        const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = '';
+        for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+            let end;
+            while ((end = buffer.indexOf('\n\n')) >= 0) {
+                const data = buffer.slice(0, end).split('\n')
+                    .filter(line => line.startsWith('data:'))
+                    .map(line => line.slice(5).replace(/^ /, ''))
+                    .join('\n');
+                buffer = buffer.slice(end + 2);
+                if (data) ingest(data);
+            }
+        }
+    } catch (err) {
+        if (abort.signal.aborted) return;
+        console.error('Stream error:', err);
+    }
+    if (abort.signal.aborted) return;
+    postStatus(false);
+    reconnectTimer = setTimeout(connect, 3000);
+}
+
+function postStatus(connected) {
+    self.postMessage({ type: 'status', connected });
+}
+
+// Parse and store one event, and record what the UI has to change
+function ingest(raw) {
+    let event;
+    try {
+        event = JSON.parse(raw);
+    } catch (err) {
+        console.error('Error parsing event:', err);
+        return;
+    }
+
+    const seq = events.push(event);
+    const eventType = event.event || 'unknown';
+    const data = event.data || {};
+
+    stats.total++;
+    const device = event.device || 'unknown';
+    stats.devices[device] = (stats.devices[device] || 0) + 1;
+    if (stats[eventType] !== undefined) {
+        stats[eventType]++;
+    }
+    statsDirty = true;
+
+    // Ops name their device and query, so streams of several devices stay apart
+    const queryId = event.query_id || null;
+
+    switch (eventType) {
+        case 'query_start': {
+            const provider = data.provider || 'unknown';
+            const model = data.model || 'unknown';
+            stats.providers[provider] = (stats.providers[provider] || 0) + 1;
+            stats.models[model] = (stats.models[model] || 0) + 1;
+            prompts.push(event);
+            promptsAdded++;
+            ops.push({
+                op: 'start',
+                device,
+                queryId,
+                provider,
+                model,
+                title: data.title || 'untitled',
+                timestamp: event.timestamp
+            });
+            break;
+        }
+        case 'stream_chunk':
+            if (data.reasoning) appendText('reasoning', data.reasoning, device, queryId);
+            if (data.content) appendText('content', data.content, device, queryId);
+            break;
+        case 'query_complete':
+            ops.push({
+                op: 'complete',
+                device,
+                queryId,
+                usage: data.usage,
+                tokens: data.tokens,
+                duration: data.duration,
+                timestamp: event.timestamp
+            });
+            break;
+        case 'error':
+            ops.push({
+                op: 'error',
+                device,
+                queryId,
+                message: data.message || 'Unknown error',
+                timestamp: event.timestamp
+            });
+            break;
+        case 'trace':
+            if (queryId) ops.push({ op: 'trace', device, queryId });
+            break;
+        case 'regression':
+            ops.push({ op: 'regression', device, alert: data, timestamp: event.timestamp });
+            break;
+    }
+
+    if (rawMatches) {
+        if (matchesFilter(event)) {
+            rawMatches.push(seq);
+            rawAdded++;
+        }
+    } else {
+        rawAdded++;
+    }
+
+    scheduleFlush();
+}
+
+// Consecutive chunks of the same query are merged, the UI appends them with one call
+function appendText(op, text, device, queryId) {
+    const last = ops[ops.length - 1];
+    if (last && last.op === op && last.device === device && last.queryId === queryId) {
+        last.text += text;
+    } else {
+        ops.push({ op, device, queryId, text });
+    }
+}
+
+function scheduleFlush() {
+    if (flushTimer) return;
+    flushTimer = setTimeout(flush, FLUSH_INTERVAL);
+}
+
+function flush() {
+    flushTimer = null;
+
+    const diff = {
+        type: 'diff',
+        ops,
+        total: stats.total,
+        raw: { count: rawCount(), added: rawAdded, reset: resetRaw },
+        prompts: { count: prompts.length, added: promptsAdded, reset: resetRaw }
+    };
+
+    // Stats snapshots are rate limited, a later flush picks up the rest
+    const elapsed = Date.now() - lastStatsPost;
+    if (statsDirty && elapsed >= STATS_INTERVAL) {
+        diff.stats = stats;
+        statsDirty = false;
+        lastStatsPost += elapsed;
+    } else if (statsDirty && !statsTimer) {
+        statsTimer = setTimeout(() => {
+            statsTimer = null;
+            scheduleFlush();
+        }, STATS_INTERVAL - elapsed);
+    }
+
+    self.postMessage(diff);
+    ops = [];
+    rawAdded = 0;
+    promptsAdded = 0;
+    resetRaw = false;
+}
+
+// Raw tab filtering
+function matchesFilter(event) {
+    if ((event.event || '').includes(rawFilter)) return true;
+    return JSON.stringify(event.data || {}).toLowerCase().includes(rawFilter);
+}
+
+function setRawFilter(text) {
+    rawFilter = text.trim().toLowerCase();
+    if (rawFilter) {
+        rawMatches = [];
+        for (let seq = events.oldest; seq < events.total; seq++) {
+            if (matchesFilter(events.bySeq(seq))) rawMatches.push(seq);
+        }
+    } else {
+        rawMatches = null;
+    }
+    resetRaw = true;
+    scheduleFlush();
+}
+
+function rawCount() {
+    if (!rawMatches) return events.length;
+    // Forget matches that have left the ring
+    let stale = 0;
+    while (stale < rawMatches.length && rawMatches[stale] < events.oldest) stale++;
+    if (stale) rawMatches.splice(0, stale);
+    return rawMatches.length;
+}
+
+// Lists are shown newest first, index 0 is the latest item
+function seqAt(list, index) {
+    if (list === 'prompts') return prompts.total - 1 - index;
+    if (rawMatches) return rawMatches[rawMatches.length - 1 - index];
+    return events.total - 1 - index;
+}
+
+function store(list) {
+    return list === 'prompts' ? prompts : events;
+}
+
+function postRows({ list, from, to, version }) {
+    const rows = [];
+    for (let index = from; index < to; index++) {
+        const seq = seqAt(list, index);
+        const event = store(list).bySeq(seq);
+        rows.push(event ? summarize(list, seq, event) : null);
+    }
+    self.postMessage({ type: 'rows', list, from, version, rows });
+}
+
+function summarize(list, seq, event) {
+    const data = event.data || {};
+    if (list === 'raw') {
+        return {
+            seq,
+            type: event.event || 'unknown',
+            timestamp: event.timestamp,
+            preview: JSON.stringify(data).slice(0, PREVIEW_LENGTH)
+        };
+    }
+    const history = Array.isArray(data.history) ? data.history : [];
+    const lastUser = history.filter(msg => msg.role === 'user').pop();
+    return {
+        seq,
+        provider: data.provider || 'unknown',
+        model: data.model || 'unknown',
+        title: data.title || '',
+        timestamp: event.timestamp,
+        preview: lastUser ? String(lastUser.content || '').slice(0, PREVIEW_LENGTH) : ''
+    };
+}
+
+function postDetail({ list, seq }) {
+    const event = store(list).bySeq(seq);
+    if (!event) return;
+    if (list === 'raw') {
+        self.postMessage({ type: 'detail', list, json: JSON.stringify(event, null, 2) });
+    } else {
+        const data = event.data || {};
+        self.postMessage({
+            type: 'detail',
+            list,
+            provider: data.provider || 'unknown',
+            model: data.model || 'unknown',
+            timestamp: event.timestamp,
+            history: Array.isArray(data.history) ? data.history : []
+        });
+    }
+}
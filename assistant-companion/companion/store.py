@@ -0,0 +1,196 @@
+"""
+Event store for the companion app
+Events are partitioned by reporting device: every partition has its own
+lock, its own sequence numbers and its own statistics, so devices
+reporting at the same time never wait on each other
+"""
+
+import contextlib
+import heapq
+import itertools
+import json
+import threading
+from collections import deque
+
+from dedup import RecentIds
+
+# Events kept in memory per device
+DEFAULT_MAXLEN = 1000
+
+# Partition for reporters that do not send a device id
+UNKNOWN_DEVICE = 'unknown'
+
+
+class DevicePartition:
+    """Events of one device, in arrival order"""
+
+    def __init__(self, device, maxlen=DEFAULT_MAXLEN):
+        self.device = device
+        self.lock = threading.Lock()
+        # Held while one of the device's events is ingested, so a snapshot
+        # sees every event either completely or not at all
+        self.ingest_lock = threading.Lock()
+        self.events = deque(maxlen=maxlen)  # (seq, event, SSE line)
+        self.last_seq = 0
+        self.recent = RecentIds()
+
+    def claim(self, device_seq):
+        """Record the device's own event id; False if the event was already received"""
+        with self.lock:
+            return self.recent.add(device_seq)
+
+    def release(self, device_seq):
+        """Undo a claim for an event that could not be stored"""
+        with self.lock:
+            self.recent.discard(device_seq)
+
+    def append(self, event, line):
+        """Store an event with its encoded SSE line; returns its sequence number"""
+        with self.lock:
+            self.last_seq += 1
+            self.events.append((self.last_seq, event, line))
+            return self.last_seq
+
+    def since(self, seq):
+        """Events stored after sequence number seq, as (seq, event, line) triples"""
+        with self.lock:
+            if not self.events or seq >= self.last_seq:
+                return []
+            # Sequence numbers are contiguous, so the position is known
+            start = max(0, len(self.events) - (self.last_seq - seq))
+            return list(itertools.islice(self.events, start, None))
+
+    def clear(self):
+        """Drop the stored events; sequence numbers keep counting"""
+        with self.lock:
+            self.events.clear()
+
+    def snapshot(self):
+        """The partition's state as plain values: events are kept as their JSON"""
+        with self.lock:
+            return {
+                'device': self.device,
+                'last_seq': self.last_seq,
+                'recent': list(self.recent.ids()),
+                'events': [(seq, line[6:-2]) for seq, _, line in self.events],
+            }
+
+    def restore(self, state):
+        """Load a state taken by snapshot()"""
+        with self.lock:
+            self.last_seq = state['last_seq']
+            for device_seq in state['recent']:
+                self.recent.add(device_seq)
+            for seq, encoded in state['events']:
+                self.events.append((seq, json.loads(encoded), f"data: {encoded}\n\n"))
+
+    def replay(self, seq, event, encoded):
+        """Re-add an event from the tail log; False if the snapshot already had it"""
+        with self.lock:
+            if seq <= self.last_seq:
+                return False
+            self.recent.add(event.get('seq'))
+            self.last_seq = seq
+            self.events.append((seq, event, f"data: {encoded}\n\n"))
+            return True
+
+    def stats(self):
+        with self.lock:
+            event_types = {}
+            for _, event, _ in self.events:
+                event_type = event.get('event', 'unknown')
+                event_types[event_type] = event_types.get(event_type, 0) + 1
+            return {
+                'total_events': len(self.events),
+                'event_types': event_types,
+                'oldest_event': self.events[0][1].get('received_at') if self.events else None,
+                'newest_event': self.events[-1][1].get('received_at') if self.events else None,
+            }
+
+
+class EventStore:
+    """In-memory events of all devices"""
+
+    def __init__(self, maxlen=DEFAULT_MAXLEN):
+        self.maxlen = maxlen
+        # Only taken when a new device shows up
+        self._lock = threading.Lock()
+        self._partitions = {}
+
+    def partition(self, device, create=False):
+        """Get a device's partition (None if the device has not reported yet)"""
+        device = device or UNKNOWN_DEVICE
+        partition = self._partitions.get(device)
+        if partition is None and create:
+            with self._lock:
+                partition = self._partitions.get(device)
+                if partition is None:
+                    partition = DevicePartition(device, self.maxlen)
+                    self._partitions[device] = partition
+        return partition
+
+    def partitions(self, device=None):
+        """All partitions, or only the given device's"""
+        if device:
+            partition = self.partition(device)
+            return [partition] if partition else []
+        return list(self._partitions.values())
+
+    def devices(self):
+        return sorted(self._partitions)
+
+    @contextlib.contextmanager
+    def frozen(self):
+        """Hold off ingest on every device, and new devices, for a consistent snapshot"""
+        with self._lock, contextlib.ExitStack() as stack:
+            for partition in self._partitions.values():
+                stack.enter_context(partition.ingest_lock)
+            yield
+
+    def events(self, device=None):
+        """Stored events ordered by arrival time"""
+        return [event for _, event, _ in self.merged(device, {})[0]]
+
+    def merged(self, device, cursors):
+        """
+        New events of every (or one) device, merged by arrival time
+        cursors maps device -> last sequence number seen; returns the
+        (seq, event, line) triples and the advanced cursors
+        """
+        cursors = dict(cursors)
+        streams = []
+        for partition in self.partitions(device):
+            new = partition.since(cursors.get(partition.device, 0))
+            if new:
+                cursors[partition.device] = new[-1][0]
+                streams.append(new)
+        merged = heapq.merge(*streams, key=lambda item: (item[1].get('received_at') or '', item[0]))
+        return list(merged), cursors
+
+    def count(self, device=None):
+        return sum(len(p.events) for p in self.partitions(device))
+
+    def clear(self):
+        for partition in self.partitions():
+            partition.clear()
+
+    def stats(self, device=None):
+        """Statistics of one device, or totals with a per-device breakdown"""
+        if device:
+            partition = self.partition(device)
+            return partition.stats() if partition else None
+
+        devices = {p.device: p.stats() for p in self.partitions()}
+        event_types = {}
+        for stats in devices.values():
+            for event_type, count in stats['event_types'].items():
+                event_types[event_type] = event_types.get(event_type, 0) + count
+        oldest = [s['oldest_event'] for s in devices.values() if s['oldest_event']]
+        newest = [s['newest_event'] for s in devices.values() if s['newest_event']]
+        return {
+            'total_events': sum(s['total_events'] for s in devices.values()),
+            'event_types': event_types,
+            'oldest_event': min(oldest) if oldest else None,
+            'newest_event': max(newest) if newest else None,
+            'devices': devices,
+        }
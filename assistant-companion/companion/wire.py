@@ -0,0 +1,309 @@
+"""
+Wire helpers for the companion app
+Content-Encoding handling for request bodies and compressed responses,
+and decoding of the event formats the Kindle can send (JSON, MessagePack)
+"""
+
+import gzip
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # optional, the built-in decoder is used instead
+    msgpack = None
+
+JSON_TYPES = ('application/json',)
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+# Advertised to reporters on every ingest response, see X-Companion-Accept
+ACCEPTED_FORMATS = 'application/json, application/msgpack'
+
+# Upper bound for a decompressed request body, guards against zip bombs
+MAX_BODY_SIZE = 32 * 1024 * 1024
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# Deepest nesting of arrays and maps accepted in a MessagePack body
+MAX_DEPTH = 64
+
+# Everything a malformed body can make the decoders raise
+DECODE_ERRORS = (ValueError, IndexError, TypeError, RecursionError, struct.error)
+if msgpack is not None:
+    DECODE_ERRORS += (msgpack.UnpackException,)
+
+
+class WireError(ValueError):
+    """Request body that cannot be decoded; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_body(body, encoding):
+    """Undo the Content-Encoding of a request body"""
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding in ('gzip', 'x-gzip'):
+        # 16 + MAX_WBITS: expect a gzip header
+        return _inflate(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # HTTP "deflate" is zlib-wrapped, but some clients send raw deflate
+        try:
+            return _inflate(body, zlib.MAX_WBITS)
+        except WireError:
+            return _inflate(body, -zlib.MAX_WBITS)
+    raise WireError(f"Unsupported Content-Encoding: {encoding}", 415)
+
+
+def _inflate(body, wbits):
+    """Decompress at most MAX_BODY_SIZE bytes"""
+    inflater = zlib.decompressobj(wbits)
+    try:
+        data = inflater.decompress(body, MAX_BODY_SIZE)
+    except zlib.error as e:
+        raise WireError(f"Invalid compressed body: {e}")
+    if inflater.unconsumed_tail:
+        raise WireError('Decompressed body too large', 413)
+    if not inflater.eof:
+        raise WireError('Truncated compressed body')
+    return data
+
+
+def decode_event(body, content_type):
+    """Parse a request body according to its Content-Type"""
+    mimetype = (content_type or 'application/json').split(';')[0].strip().lower()
+    if mimetype in MSGPACK_TYPES:
+        try:
+            return unpackb(body)
+        except DECODE_ERRORS as e:
+            raise WireError(f"Invalid MessagePack: {e}")
+    if mimetype in JSON_TYPES:
+        try:
+            return json.loads(body)
+        except (ValueError, RecursionError) as e:
+            raise WireError(f"Invalid JSON: {e}")
+    raise WireError(f"Unsupported Content-Type: {mimetype}", 415)
+
+
+def unpackb(data):
+    """
+    Decode one MessagePack object (uses the msgpack package when installed)
+    Both decoders return JSON types only: binary becomes text like strings
+    (invalid UTF-8 replaced), map keys become strings, extension types and
+    nesting deeper than MAX_DEPTH raise ValueError
+    """
+    if msgpack is not None:
+        return _plain(msgpack.unpackb(data, raw=False, strict_map_key=False, unicode_errors='replace',
+                                      object_pairs_hook=_pairs))
+    obj, end = _unpack(data, 0)
+    if end != len(data):
+        raise ValueError('Extra data after MessagePack object')
+    return obj
+
+
+def _plain(obj, depth=0):
+    """Values of the msgpack package as the built-in decoder returns them"""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    if isinstance(obj, (list, dict)) and depth >= MAX_DEPTH:
+        raise ValueError('MessagePack nested too deeply')
+    if isinstance(obj, list):
+        return [_plain(item, depth + 1) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _plain(value, depth + 1) for key, value in obj.items()}
+    raise ValueError(f"Unsupported MessagePack value: {type(obj).__name__}")
+
+
+def _pairs(pairs):
+    """Map of the msgpack package, keys converted before they can collide"""
+    return {_key(key): value for key, value in pairs}
+
+
+def _key(key):
+    """Map key as a string, only scalars are accepted"""
+    if isinstance(key, bytes):
+        return key.decode('utf-8', errors='replace')
+    if isinstance(key, (list, dict)) or not (key is None or isinstance(key, (bool, int, float, str))):
+        raise ValueError('MessagePack map key must be a scalar')
+    return key if isinstance(key, str) else str(key)
+
+
+def packb(obj):
+    """Encode one object as MessagePack (for tests, tools and benchmarks)"""
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = []
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def _pack(obj, out):
+    """Compact MessagePack encoder, same output sizes as the Kindle's"""
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True or obj is False:
+        out.append(b'\xc3' if obj else b'\xc2')
+    elif isinstance(obj, int):
+        out.append(_pack_int(obj))
+    elif isinstance(obj, float):
+        out.append(b'\xcb' + struct.pack('>d', obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        out.append(_header(len(data), 0xa0, 32, b'\xd9', b'\xda', b'\xdb') + data)
+    elif isinstance(obj, (list, tuple)):
+        out.append(_header(len(obj), 0x90, 16, None, b'\xdc', b'\xdd'))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        out.append(_header(len(obj), 0x80, 16, None, b'\xde', b'\xdf'))
+        for key, value in obj.items():
+            _pack(str(key), out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} as MessagePack")
+
+
+def _pack_int(n):
+    """Smallest MessagePack integer encoding for n"""
+    if 0 <= n < 0x80 or -32 <= n < 0:
+        return struct.pack('>b' if n < 0 else '>B', n)
+    for limit, prefix, fmt in ((1 << 8, b'\xcc', '>B'), (1 << 16, b'\xcd', '>H'),
+                               (1 << 32, b'\xce', '>I'), (1 << 64, b'\xcf', '>Q')):
+        if 0 <= n < limit:
+            return prefix + struct.pack(fmt, n)
+    for limit, prefix, fmt in ((1 << 7, b'\xd0', '>b'), (1 << 15, b'\xd1', '>h'),
+                               (1 << 31, b'\xd2', '>i'), (1 << 63, b'\xd3', '>q')):
+        if -limit <= n < 0:
+            return prefix + struct.pack(fmt, n)
+    raise OverflowError('Integer too large for MessagePack')
+
+
+def _header(length, fix_base, fix_limit, prefix8, prefix16, prefix32):
+    """Type header for strings, arrays and maps"""
+    if length < fix_limit:
+        return bytes([fix_base + length])
+    if prefix8 and length < (1 << 8):
+        return prefix8 + bytes([length])
+    if length < (1 << 16):
+        return prefix16 + struct.pack('>H', length)
+    return prefix32 + struct.pack('>I', length)
+
+
+def _unpack(data, pos, depth=0):
+    """Minimal MessagePack decoder: returns (object, next position)"""
+    b = data[pos]
+    pos += 1
+    if b <= 0x7f:
+        return b, pos
+    if b >= 0xe0:
+        return b - 0x100, pos
+    if 0xa0 <= b <= 0xbf:
+        return _str(data, pos, b & 0x1f)
+    if 0x90 <= b <= 0x9f:
+        return _array(data, pos, b & 0x0f, depth)
+    if 0x80 <= b <= 0x8f:
+        return _map(data, pos, b & 0x0f, depth)
+    if b == 0xc0:
+        return None, pos
+    if b == 0xc2:
+        return False, pos
+    if b == 0xc3:
+        return True, pos
+    if b in _FIXED:
+        fmt, size = _FIXED[b]
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    if b in _SIZED:
+        kind, fmt, size = _SIZED[b]
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += size
+        if kind in ('str', 'bin'):
+            return _str(data, pos, length)
+        if kind == 'array':
+            return _array(data, pos, length, depth)
+        return _map(data, pos, length, depth)
+    raise ValueError(f"Unsupported MessagePack type 0x{b:02x}")
+
+
+def _str(data, pos, length):
+    end = pos + length
+    if end > len(data):
+        raise ValueError('Truncated MessagePack string')
+    return data[pos:end].decode('utf-8', errors='replace'), end
+
+
+def _array(data, pos, length, depth):
+    if depth >= MAX_DEPTH:
+        raise ValueError('MessagePack nested too deeply')
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(data, pos, depth + 1)
+        items.append(item)
+    return items, pos
+
+
+def _map(data, pos, length, depth):
+    if depth >= MAX_DEPTH:
+        raise ValueError('MessagePack nested too deeply')
+    obj = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos, depth + 1)
+        value, pos = _unpack(data, pos, depth + 1)
+        obj[_key(key)] = value
+    return obj, pos
+
+
+# type byte -> (struct format, size) for fixed-width scalars
+_FIXED = {
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+}
+
+# type byte -> (kind, length format, length size) for length-prefixed types
+_SIZED = {
+    0xd9: ('str', '>B', 1), 0xda: ('str', '>H', 2), 0xdb: ('str', '>I', 4),
+    0xc4: ('bin', '>B', 1), 0xc5: ('bin', '>H', 2), 0xc6: ('bin', '>I', 4),
+    0xdc: ('array', '>H', 2), 0xdd: ('array', '>I', 4),
+    0xde: ('map', '>H', 2), 0xdf: ('map', '>I', 4),
+}
+
+
+def accepts_gzip(accept_encoding):
+    """Check an Accept-Encoding header for gzip (ignoring q-values except q=0)"""
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0')
+    return False
+
+
+def gzip_bytes(data, level=6):
+    """Compress a complete response body"""
+    return gzip.compress(data, compresslevel=level)
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Compress a streaming response
+    Every chunk from the source is followed by a sync flush so the client
+    can decode it right away; callers batch events per chunk to keep the
+    flush overhead low.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush(zlib.Z_FINISH)
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Ingest throughput of a running companion
+Several simulated devices post stream chunks to /events for a while;
+reports events per second and request latency. Start the companion
+with COMPANION_RATE=0 so admission control does not coalesce the load:
+
+    COMPANION_RATE=0 python3 companion/app.py --workers 2
+    python3 examples/bench_ingest.py --devices 8 --seconds 10
+"""
+
+import argparse
+import threading
+import time
+
+import requests
+
+
+def device(base_url, name, deadline, latencies, errors):
+    """Post events as one device until the deadline"""
+    session = requests.Session()
+    seq = 0
+    while time.monotonic() < deadline:
+        seq += 1
+        event = {
+            "event": "stream_chunk",
+            "timestamp": time.time(),
+            "device": name,
+            "seq": seq,
+            "data": {"content": "It was a bright cold day in April. "},
+        }
+        start = time.perf_counter()
+        try:
+            response = session.post(f"{base_url}/events", json=event, timeout=10)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(seq)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--devices', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=device, args=(args.url, f"bench-{i}", deadline, latencies, errors))
+               for i in range(args.devices)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    if not latencies:
+        print(f"No event was accepted ({len(errors)} failed)")
+        return
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{len(latencies)} events in {elapsed:.1f}s from {args.devices} devices: "
+          f"{len(latencies) / elapsed:.0f} events/s, p50 {p50:.1f} ms, p99 {p99:.1f} ms"
+          + (f", {len(errors)} failed" if errors else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare the JSON and MessagePack encodings of companion events
+Reports bytes per event (raw and deflated) and encode/decode time,
+using the sample events and a large synthetic query_start
+"""
+
+import json
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "companion"))
+import wire  # noqa: E402
+
+ROUNDS = 2000
+
+
+def load_events():
+    """Sample events plus one query_start with a long book excerpt"""
+    with open(Path(__file__).parent / "sample_events.json") as f:
+        events = json.load(f)
+    events.append({
+        "event": "query_start",
+        "timestamp": int(time.time()),
+        "data": {
+            "provider": "anthropic",
+            "model": "claude-sonnet",
+            "title": "Explain",
+            "history": [
+                {"role": "system", "content": "You are a helpful reading assistant."},
+                {"role": "user", "content": "Book excerpt: " + "It was a bright cold day in April. " * 200},
+            ],
+        },
+    })
+    return events
+
+
+def bench(name, encode, decode, events):
+    """Time encoding and decoding of every event, ROUNDS times"""
+    bodies = [encode(e) for e in events]
+    raw = sum(len(b) for b in bodies)
+    deflated = sum(len(zlib.compress(b)) for b in bodies)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for e in events:
+            encode(e)
+    encode_us = (time.perf_counter() - start) / (ROUNDS * len(events)) * 1e6
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for b in bodies:
+            decode(b)
+    decode_us = (time.perf_counter() - start) / (ROUNDS * len(events)) * 1e6
+
+    print(f"{name:<22} {raw / len(events):>10.0f} {deflated / len(events):>10.0f} "
+          f"{encode_us:>10.1f} {decode_us:>10.1f}")
+
+
+def main():
+    events = load_events()
+    print(f"{len(events)} events, {ROUNDS} rounds\n")
+    print(f"{'format':<22} {'bytes':>10} {'deflated':>10} {'encode µs':>10} {'decode µs':>10}")
+    bench('json', lambda e: json.dumps(e).encode('utf-8'), json.loads, events)
+    if wire.msgpack is not None:
+        bench('msgpack (C)', wire.packb, wire.unpackb, events)
+        wire.msgpack = None
+    bench('msgpack (built-in)', wire.packb, wire.unpackb, events)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,17 +18,240 @@ local http = require("socket.http")
 local ltn12 = require("ltn12")
 local JSON = require("json")
 
+-- KOReader ships zlib bindings; without them bodies are sent uncompressed
+local zlib_ok, zlib = pcall(require, "ffi/zlib")
+if not (zlib_ok and type(zlib) == "table" and zlib.zlib_compress) then
+    zlib = nil
+end
+
+-- Sub-second clock for trace spans (LuaSocket ships with KOReader)
+local socket_ok, socket = pcall(require, "socket")
+local now = socket_ok and type(socket) == "table" and socket.gettime or os.time
+
+-- Clock exchanges are scheduled on the UI loop when it is available
+local uim_ok, UIManager = pcall(require, "ui/uimanager")
+if not uim_ok then
+    UIManager = nil
+end
+
+-- Offline events are spooled under KOReader's data dir when it is available
+local ds_ok, DataStorage = pcall(require, "datastorage")
+if not ds_ok then
+    DataStorage = nil
+end
+
+-- Event encodings; MessagePack is used once the companion advertises it
+local WIRE_JSON = "application/json"
+local WIRE_MSGPACK = "application/msgpack"
+
+--[[
+    Minimal MessagePack encoder (nil, booleans, numbers, strings, tables)
+    Cheaper than JSON on the device: no string escaping, no number formatting
+]]
+local floor = math.floor
+local char = string.char
+local MAX_DEPTH = 32
+
+local function be_uint(n, bytes)
+    local out = {}
+    for i = bytes, 1, -1 do
+        out[i] = n % 256
+        n = floor(n / 256)
+    end
+    return char(unpack(out))
+end
+
+-- 64-bit two's complement, exact for integers up to 2^53
+local function be_int64(n)
+    local high = floor(n / 4294967296)
+    local low = n - high * 4294967296
+    if high < 0 then
+        high = high + 4294967296
+    end
+    return be_uint(high, 4) .. be_uint(low, 4)
+end
+
+-- IEEE 754 double, big-endian
+local function pack_double(n)
+    local sign = 0
+    if n < 0 or (n == 0 and 1 / n < 0) then
+        sign = 128
+        n = -n
+    end
+    if n ~= n then
+        return char(127, 248, 0, 0, 0, 0, 0, 0) -- NaN
+    elseif n == math.huge then
+        return char(sign + 127, 240, 0, 0, 0, 0, 0, 0)
+    elseif n == 0 then
+        return char(sign, 0, 0, 0, 0, 0, 0, 0)
+    end
+    local mantissa, exponent = math.frexp(n) -- n = mantissa * 2^exponent, 0.5 <= mantissa < 1
+    exponent = exponent + 1022
+    if exponent <= 0 then -- subnormal
+        mantissa = mantissa * 2 ^ (52 + exponent)
+        exponent = 0
+    else
+        mantissa = (mantissa * 2 - 1) * 2 ^ 52
+    end
+    return char(sign + floor(exponent / 16), (exponent % 16) * 16 + floor(mantissa / 2 ^ 48))
+        .. be_uint(mantissa % 2 ^ 48, 6)
+end
+
+local encode_value
+
+local function encode_number(n, out)
+    if n == floor(n) and n >= -2 ^ 53 and n <= 2 ^ 53 then
+        if n >= 0 then
+            if n < 128 then
+                out[#out + 1] = char(n)
+            elseif n < 256 then
+                out[#out + 1] = "\204" .. char(n)
+            elseif n < 65536 then
+                out[#out + 1] = "\205" .. be_uint(n, 2)
+            elseif n < 4294967296 then
+                out[#out + 1] = "\206" .. be_uint(n, 4)
+            else
+                out[#out + 1] = "\207" .. be_int64(n)
+            end
+        elseif n >= -32 then
+            out[#out + 1] = char(n + 256)
+        elseif n >= -128 then
+            out[#out + 1] = "\208" .. char(n + 256)
+        elseif n >= -32768 then
+            out[#out + 1] = "\209" .. be_uint(n + 65536, 2)
+        elseif n >= -2147483648 then
+            out[#out + 1] = "\210" .. be_uint(n + 4294967296, 4)
+        else
+            out[#out + 1] = "\211" .. be_int64(n)
+        end
+    else
+        out[#out + 1] = "\203" .. pack_double(n)
+    end
+end
+
+local function encode_string(s, out)
+    local len = #s
+    if len < 32 then
+        out[#out + 1] = char(160 + len)
+    elseif len < 256 then
+        out[#out + 1] = "\217" .. char(len)
+    elseif len < 65536 then
+        out[#out + 1] = "\218" .. be_uint(len, 2)
+    else
+        out[#out + 1] = "\219" .. be_uint(len, 4)
+    end
+    out[#out + 1] = s
+end
+
+local function encode_table(t, out, depth)
+    if depth > MAX_DEPTH then
+        error("table nested too deeply")
+    end
+    local n = #t
+    local count = 0
+    for _ in pairs(t) do
+        count = count + 1
+    end
+    if n > 0 and n == count then
+        if n < 16 then
+            out[#out + 1] = char(144 + n)
+        elseif n < 65536 then
+            out[#out + 1] = "\220" .. be_uint(n, 2)
+        else
+            out[#out + 1] = "\221" .. be_uint(n, 4)
+        end
+        for i = 1, n do
+            encode_value(t[i], out, depth + 1)
+        end
+    else
+        -- Empty tables are encoded as maps, like event data payloads
+        if count < 16 then
+            out[#out + 1] = char(128 + count)
+        elseif count < 65536 then
+            out[#out + 1] = "\222" .. be_uint(count, 2)
+        else
+            out[#out + 1] = "\223" .. be_uint(count, 4)
+        end
+        for k, v in pairs(t) do
+            encode_string(type(k) == "string" and k or tostring(k), out)
+            encode_value(v, out, depth + 1)
+        end
+    end
+end
+
+encode_value = function(v, out, depth)
+    local t = type(v)
+    if t == "string" then
+        encode_string(v, out)
+    elseif t == "number" then
+        encode_number(v, out)
+    elseif t == "table" then
+        encode_table(v, out, depth)
+    elseif t == "boolean" then
+        out[#out + 1] = v and "\195" or "\194"
+    else
+        out[#out + 1] = "\192" -- nil and unsupported types
+    end
+end
+
 local Companion = {}
 
+--[[
+    Encode a value as MessagePack
+
+    @param value: any - Value to encode (functions and userdata become nil)
+    @return string - Encoded bytes
+]]
+function Companion.encode_msgpack(value)
+    local out = {}
+    encode_value(value, out, 0)
+    return table.concat(out)
+end
+
+-- Sequence numbers are reserved in blocks so settings are not saved on every event
+local SEQ_BLOCK = 1000
+
+-- Round trips per clock exchange with the companion, run after a query
+-- ends (seconds after its last event) and spread out (seconds apart)
+local CLOCK_ROUNDS = 3
+local CLOCK_SYNC_DELAY = 1
+local CLOCK_ROUND_DELAY = 2
+
+-- Events after which the device is idle long enough for a clock exchange
+local QUERY_END = { query_complete = true, error = true, heartbeat = true }
+
+-- Longest Retry-After delay honoured (seconds)
+local MAX_RETRY_AFTER = 300
+
 function Companion:new(settings)
     local o = {
         settings = settings,
         enabled = false,
         url = nil,
-        buffer = {},
-        max_buffer_size = 100,
+        buffer = {}, -- JSON-encoded events waiting to be sent, oldest first
+        buffer_bytes = 0,
+        max_buffer_size = 1000, -- events
+        max_spool_size = 1024 * 1024, -- bytes
+        spool_path = nil, -- file backing the buffer, survives restarts
+        batch_size = 200, -- events per catch-up request
+        max_batch_bytes = 256 * 1024,
+        retry_delay = 10, -- seconds to spool without trying the network after a failure
+        retry_at = 0,
+        device_id = nil,
+        seq = 0,
+        seq_limit = 0,
         last_error_time = 0,
         error_cooldown = 30, -- Don't spam errors more than once per 30 seconds
+        compress_threshold = 1024, -- Deflate request bodies larger than this (bytes)
+        wire_format = "auto", -- json, msgpack, or auto (msgpack once the companion supports it)
+        content_type = WIRE_JSON, -- encoding currently in use
+        spans = {}, -- finished trace spans not sent yet
+        span_count = 0,
+        clock_interval = 300, -- seconds between clock exchanges
+        clock_sync_at = 0,
+        clock_sync_task = nil, -- scheduled round trip of a running exchange
+        clock_samples = {}, -- {t0, t1, t2, t3} of exchanges not reported yet
+        clock_offset = nil, -- companion's estimate, for the status
     }
     setmetatable(o, self)
     self.__index = self
@@ -42,6 +265,25 @@ end
 function Companion:_init_from_settings()
     self.enabled = self.settings:readSetting("companion_enabled") == true
     self.url = self.settings:readSetting("companion_url") or "http://192.168.1.102:8080"
+    self.compress_threshold = self.settings:readSetting("companion_compress_threshold") or self.compress_threshold
+    self.wire_format = self.settings:readSetting("companion_wire_format") or self.wire_format
+    self.content_type = self.wire_format == "msgpack" and WIRE_MSGPACK or WIRE_JSON
+    self.max_buffer_size = self.settings:readSetting("companion_buffer_size") or self.max_buffer_size
+    self.max_spool_size = self.settings:readSetting("companion_spool_size") or self.max_spool_size
+    self.spool_path = self.settings:readSetting("companion_spool_path")
+        or (DataStorage and DataStorage:getDataDir() .. "/cache/assistant_companion.spool")
+    
+    -- Events carry (device_id, seq) so the companion can drop resent events
+    self.device_id = self.settings:readSetting("companion_device_id")
+    if not self.device_id then
+        local address = tostring({}):match("0x(%x+)") or "0"
+        self.device_id = string.format("kindle-%x-%s", os.time(), address:sub(-6))
+        self.settings:saveSetting("companion_device_id", self.device_id)
+    end
+    self.seq = self.settings:readSetting("companion_next_seq") or 0
+    self.seq_limit = self.seq
+    
+    self:_load_spool()
     
     if self.enabled then
         logger.info("[Companion] Enabled, endpoint:", self.url)
@@ -85,26 +327,207 @@ function Companion:send(event_type, data)
         return false
     end
     
+    -- Keep the companion's estimate of this device's clock current; the
+    -- exchange blocks on the network, so it never runs while streaming
+    if QUERY_END[event_type] then
+        self:_schedule_clock_sync()
+    end
+    
     local event = {
         event = event_type,
-        timestamp = os.time(),
+        timestamp = now(), -- device time, mapped to companion time on arrival
+        device = self.device_id,
+        seq = self:_next_seq(),
         data = data or {},
     }
     
-    -- Try to send
-    local success = self:_http_post(event)
+    -- Recently unreachable: spool without waiting for another timeout
+    if os.time() < self.retry_at then
+        self:_buffer_event(event)
+        return false
+    end
     
+    -- Events already waiting go first, the new one is sent with them
+    if #self.buffer > 0 then
+        self:_buffer_event(event)
+        return self:_flush_buffer()
+    end
+    
+    local success = self:_http_post(event)
     if not success then
-        -- Buffer if send failed
         self:_buffer_event(event)
-    else
-        -- If send succeeded, try to flush buffer
-        self:_flush_buffer()
     end
     
     return success
 end
 
+--[[
+    Current time in seconds, with sub-second precision when available
+]]
+function Companion.now()
+    return now()
+end
+
+--[[
+    Start a trace span
+
+    @param name: string - What is measured (query, request, stream, ...)
+    @param parent: table|nil - Parent span; nil starts a new trace
+    @param attrs: table|nil - Extra attributes sent with the span
+    @return table - The span, to pass to span_end or as a parent
+]]
+function Companion:span_start(name, parent, attrs)
+    self.span_count = self.span_count + 1
+    return {
+        trace_id = parent and parent.trace_id or string.format("%x-%x", os.time(), self.span_count),
+        id = self.span_count,
+        parent_id = parent and parent.id,
+        name = name,
+        start = now(),
+        attrs = attrs,
+    }
+end
+
+--[[
+    Finish a span; it is sent with the next flush_spans
+
+    @param span: table - Span from span_start
+    @param attrs: table|nil - Attributes to add (results, counts)
+]]
+function Companion:span_end(span, attrs)
+    span.duration = now() - span.start
+    if attrs then
+        span.attrs = span.attrs or {}
+        for k, v in pairs(attrs) do
+            span.attrs[k] = v
+        end
+    end
+    table.insert(self.spans, span)
+end
+
+--[[
+    Record a finished span measured elsewhere (e.g. in a subprocess)
+
+    @param parent: table - Parent span
+    @param name: string - Span name
+    @param start: number - Start time (seconds)
+    @param finish: number - End time (seconds)
+    @param attrs: table|nil - Extra attributes
+]]
+function Companion:span_add(parent, name, start, finish, attrs)
+    local span = self:span_start(name, parent, attrs)
+    span.start = start
+    span.duration = finish - start
+    table.insert(self.spans, span)
+end
+
+--[[
+    Send the finished spans in one "trace" event
+    Spans are collected during a query and sent afterwards, so tracing
+    adds one request per query instead of one per span
+]]
+function Companion:flush_spans()
+    if #self.spans == 0 then
+        return true
+    end
+    local spans = self.spans
+    self.spans = {}
+    return self:send("trace", { trace_id = spans[1].trace_id, spans = spans })
+end
+
+--[[
+    NTP-style clock exchange with the companion
+    Each round trip records when the request left (t0) and the answer
+    arrived (t3) on this device, and when the companion received (t1) and
+    answered (t2) it. The samples are reported with the next round trip,
+    so the companion can track this clock's offset and drift
+
+    @return boolean - true if the companion answered
+]]
+function Companion:sync_clock()
+    self.clock_sync_at = now() + self.clock_interval
+    for _ = 1, CLOCK_ROUNDS do
+        if not self:_clock_round() then
+            return false
+        end
+    end
+    return true
+end
+
+--[[
+    Start a clock exchange if one is due, one round trip per UI loop task
+    so the reader is never held up for more than one request at a time
+]]
+function Companion:_schedule_clock_sync()
+    if not UIManager or self.clock_sync_task or now() < self.clock_sync_at then
+        return
+    end
+    self.clock_sync_at = now() + self.clock_interval
+    local rounds = CLOCK_ROUNDS
+    local task
+    task = function()
+        rounds = rounds - 1
+        if self.enabled and os.time() >= self.retry_at and self:_clock_round() and rounds > 0 then
+            UIManager:scheduleIn(CLOCK_ROUND_DELAY, task)
+        else
+            self.clock_sync_task = nil
+        end
+    end
+    self.clock_sync_task = task
+    UIManager:scheduleIn(CLOCK_SYNC_DELAY, task)
+end
+
+-- One round trip of a clock exchange; false if the companion did not answer
+function Companion:_clock_round()
+    if not self.url then
+        return false
+    end
+    local ok, payload = pcall(JSON.encode, {
+        device = self.device_id,
+        samples = self.clock_samples,
+    })
+    if not ok then
+        return false
+    end
+    local t0 = now()
+    local status_code, _, body = self:_post("/time", payload, WIRE_JSON, 2)
+    local t3 = now()
+    if status_code ~= 200 then
+        -- Unreachable: spool events for a while. An error status means
+        -- an older companion without /time, events still go through
+        if type(status_code) ~= "number" then
+            self:_post_failed(status_code)
+        end
+        return false
+    end
+    self.clock_samples = {}
+    local decoded, reply = pcall(JSON.decode, body or "")
+    if decoded and type(reply) == "table" and tonumber(reply.t1) and tonumber(reply.t2) then
+        table.insert(self.clock_samples, { t0, tonumber(reply.t1), tonumber(reply.t2), t3 })
+        if type(reply.estimate) == "table" then
+            self.clock_offset = reply.estimate.offset_ms
+        end
+    end
+    return true
+end
+
+--[[
+    Next event sequence number for this device
+    A block of numbers is reserved in the settings at a time, so numbers
+    keep increasing across restarts
+]]
+function Companion:_next_seq()
+    if self.seq >= self.seq_limit then
+        self.seq_limit = self.seq + SEQ_BLOCK
+        self.settings:saveSetting("companion_next_seq", self.seq_limit)
+        if self.settings.flush then
+            self.settings:flush()
+        end
+    end
+    self.seq = self.seq + 1
+    return self.seq
+end
+
 --[[
     Internal HTTP POST implementation
     Non-blocking fire-and-forget style
@@ -114,90 +537,299 @@ function Companion:_http_post(event)
         return false
     end
     
-    local ok, json_str = pcall(JSON.encode, event)
+    local content_type = self.content_type
+    local encode = content_type == WIRE_MSGPACK and Companion.encode_msgpack or JSON.encode
+    local ok, payload = pcall(encode, event)
     if not ok then
-        logger.warn("[Companion] Failed to encode JSON:", json_str)
+        logger.warn("[Companion] Failed to encode event:", payload)
         return false
     end
     
+    local status_code, headers = self:_post("/events", payload, content_type, 2)
+    
+    if status_code == 200 then
+        self:_negotiate(headers)
+        return true
+    elseif status_code == 429 then
+        -- Over this device's budget: the event is spooled and resent later
+        self:_rate_limited(headers)
+        return false
+    elseif status_code == 415 and content_type ~= WIRE_JSON then
+        -- Companion does not understand the binary format, fall back to JSON
+        logger.info("[Companion] Binary events rejected, using JSON")
+        self.content_type = WIRE_JSON
+        self.wire_format = "json"
+        return self:_http_post(event)
+    else
+        self:_post_failed(status_code)
+        return false
+    end
+end
+
+--[[
+    POST a body to the companion, deflating it when worthwhile
+
+    @return number|string|nil status code (or error), table|nil response headers, string response body
+]]
+function Companion:_post(path, payload, content_type, timeout)
+    local body, content_encoding = self:_compress(payload)
     local sink = {}
-    local url = self.url .. "/events"
+    local url = self.url .. path
     
     -- Set timeout to avoid blocking
     local old_timeout = http.TIMEOUT
-    http.TIMEOUT = 2 -- 2 second timeout
-    
-    local _, status_code = pcall(function()
-        return http.request{
-            url = url,
-            method = "POST",
-            headers = {
-                ["Content-Type"] = "application/json",
-                ["Content-Length"] = tostring(#json_str),
-                ["User-Agent"] = "KOReader-AI-Assistant/1.0",
-            },
-            source = ltn12.source.string(json_str),
-            sink = ltn12.sink.table(sink),
-        }
-    end)
+    http.TIMEOUT = timeout
+    
+    -- Table form returns 1, code, headers on success and nil, err on failure
+    local ok, res, status_code, headers = pcall(http.request, {
+        url = url,
+        method = "POST",
+        headers = {
+            ["Content-Type"] = content_type,
+            ["Content-Encoding"] = content_encoding,
+            ["Content-Length"] = tostring(#body),
+            ["User-Agent"] = "KOReader-AI-Assistant/1.0",
+        },
+        source = ltn12.source.string(body),
+        sink = ltn12.sink.table(sink),
+    })
+    if not ok or not res then
+        status_code = res or status_code
+    end
     
     -- Restore timeout
     http.TIMEOUT = old_timeout
     
-    if status_code == 200 or status_code == true then
-        return true
-    else
-        -- Only log errors if not in cooldown
-        if os.time() - self.last_error_time > self.error_cooldown then
-            logger.warn("[Companion] HTTP error:", status_code, "- buffering event")
-            self.last_error_time = os.time()
-        end
-        return false
+    return status_code, headers, table.concat(sink)
+end
+
+--[[
+    Back off after a failed request: events are spooled for a while
+]]
+function Companion:_post_failed(status_code)
+    self.retry_at = os.time() + self.retry_delay
+    -- Only log errors if not in cooldown
+    if os.time() - self.last_error_time > self.error_cooldown then
+        logger.warn("[Companion] HTTP error:", status_code, "- buffering event")
+        self.last_error_time = os.time()
     end
 end
 
+--[[
+    The companion is over this device's event budget (429): events are
+    spooled until its Retry-After delay has passed
+]]
+function Companion:_rate_limited(headers)
+    local delay = tonumber(type(headers) == "table" and headers["retry-after"]) or self.retry_delay
+    delay = math.min(math.max(math.ceil(delay), 1), MAX_RETRY_AFTER)
+    self.retry_at = os.time() + delay
+    logger.dbg("[Companion] Rate limited, spooling events for", delay, "seconds")
+end
+
+--[[
+    Switch to MessagePack when the companion advertises it
+    (X-Companion-Accept header on ingest responses)
+]]
+function Companion:_negotiate(headers)
+    if self.wire_format ~= "auto" or self.content_type == WIRE_MSGPACK then
+        return
+    end
+    local accept = type(headers) == "table" and headers["x-companion-accept"]
+    if accept and accept:find(WIRE_MSGPACK, 1, true) then
+        self.content_type = WIRE_MSGPACK
+        logger.info("[Companion] Using MessagePack events")
+    end
+end
+
+--[[
+    Deflate a request body when it is large enough to be worth it
+    (query_start carries full prompts and book excerpts)
+
+    @return string body, string|nil content encoding
+]]
+function Companion:_compress(body)
+    if not zlib or #body < self.compress_threshold then
+        return body
+    end
+    local ok, compressed = pcall(zlib.zlib_compress, body)
+    if ok and type(compressed) == "string" and #compressed < #body then
+        return compressed, "deflate"
+    end
+    return body
+end
+
 --[[
     Buffer an event when companion is unreachable
+    Events are appended to the spool file as JSON lines; when the spool
+    is over its limits the oldest quarter is dropped
 ]]
 function Companion:_buffer_event(event)
-    table.insert(self.buffer, event)
+    local ok, line = pcall(JSON.encode, event)
+    if not ok then
+        logger.warn("[Companion] Failed to encode event:", line)
+        return
+    end
     
-    -- Limit buffer size
-    if #self.buffer > self.max_buffer_size then
-        table.remove(self.buffer, 1) -- Remove oldest
-        logger.dbg("[Companion] Buffer full, dropped oldest event")
+    table.insert(self.buffer, line)
+    self.buffer_bytes = self.buffer_bytes + #line + 1
+    
+    if #self.buffer > self.max_buffer_size or self.buffer_bytes > self.max_spool_size then
+        local keep_count = math.floor(self.max_buffer_size * 3 / 4)
+        local keep_bytes = math.floor(self.max_spool_size * 3 / 4)
+        local dropped = 0
+        while #self.buffer - dropped > keep_count or self.buffer_bytes > keep_bytes do
+            dropped = dropped + 1
+            self.buffer_bytes = self.buffer_bytes - #self.buffer[dropped] - 1
+        end
+        self:_drop_buffered(dropped)
+        logger.dbg("[Companion] Spool full, dropped", dropped, "oldest events")
+        self:_write_spool()
+    else
+        self:_append_spool(line)
     end
     
     logger.dbg("[Companion] Buffered event, buffer size:", #self.buffer)
 end
 
 --[[
-    Try to flush buffered events
+    Remove the oldest count events from the in-memory buffer
+]]
+function Companion:_drop_buffered(count)
+    local rest = {}
+    for i = count + 1, #self.buffer do
+        rest[#rest + 1] = self.buffer[i]
+    end
+    self.buffer = rest
+end
+
+--[[
+    Send buffered events in batches, oldest first
+
+    @return boolean - true if the buffer was drained
 ]]
 function Companion:_flush_buffer()
     if #self.buffer == 0 then
-        return
+        return true
+    end
+    if not self.url then
+        return false
     end
     
     logger.info("[Companion] Flushing", #self.buffer, "buffered events")
     
     local sent_count = 0
-    local max_flush = 10 -- Don't send too many at once
-    
-    while #self.buffer > 0 and sent_count < max_flush do
-        local event = table.remove(self.buffer, 1)
-        if self:_http_post(event) then
-            sent_count = sent_count + 1
-        else
-            -- Put it back and stop trying
-            table.insert(self.buffer, 1, event)
+    while #self.buffer > 0 do
+        -- Spooled lines are already JSON, the batch is built without re-encoding
+        local lines, bytes = {}, 0
+        for i = 1, math.min(#self.buffer, self.batch_size) do
+            local line = self.buffer[i]
+            if i > 1 and bytes + #line > self.max_batch_bytes then
+                break
+            end
+            lines[i] = line
+            bytes = bytes + #line + 1
+        end
+        
+        local payload = '{"events":[' .. table.concat(lines, ",") .. "]}"
+        local status_code, headers, body = self:_post("/events/batch", payload, WIRE_JSON, 10)
+        if status_code == 429 then
+            -- Part of the batch may have been taken, the rest stays spooled
+            local decoded, reply = pcall(JSON.decode, body or "")
+            local handled = decoded and type(reply) == "table" and tonumber(reply.handled) or 0
+            handled = math.min(math.max(math.floor(handled), 0), #lines)
+            for i = 1, handled do
+                self.buffer_bytes = self.buffer_bytes - #lines[i] - 1
+            end
+            self:_drop_buffered(handled)
+            sent_count = sent_count + handled
+            self:_rate_limited(headers)
+            break
+        elseif status_code == 400 then
+            -- Rejected as malformed: resending would block the spool for good
+            logger.warn("[Companion] Batch rejected, dropping", #lines, "events")
+        elseif status_code ~= 200 then
+            self:_post_failed(status_code)
             break
         end
+        
+        self:_drop_buffered(#lines)
+        self.buffer_bytes = self.buffer_bytes - bytes
+        sent_count = sent_count + #lines
     end
     
     if sent_count > 0 then
         logger.info("[Companion] Flushed", sent_count, "events, remaining:", #self.buffer)
+        self:_write_spool()
+    end
+    return #self.buffer == 0
+end
+
+--[[
+    Read events spooled by a previous session
+]]
+function Companion:_load_spool()
+    if not self.spool_path then
+        return
+    end
+    local f = io.open(self.spool_path, "r")
+    if not f then
+        return
+    end
+    for line in f:lines() do
+        if line ~= "" then
+            table.insert(self.buffer, line)
+            self.buffer_bytes = self.buffer_bytes + #line + 1
+        end
+    end
+    f:close()
+    
+    -- Only the last line can be cut short (power loss while appending)
+    local last = self.buffer[#self.buffer]
+    if last and not pcall(JSON.decode, last) then
+        table.remove(self.buffer)
+        self.buffer_bytes = self.buffer_bytes - #last - 1
+        self:_write_spool()
+    end
+    
+    if #self.buffer > 0 then
+        logger.info("[Companion] Loaded", #self.buffer, "spooled events")
+    end
+end
+
+function Companion:_append_spool(line)
+    if not self.spool_path then
+        return
+    end
+    local f = io.open(self.spool_path, "a")
+    if f then
+        f:write(line, "\n")
+        f:close()
+    end
+end
+
+--[[
+    Replace the spool file with the current buffer
+    Written to a temporary file first so a crash leaves the old spool intact
+]]
+function Companion:_write_spool()
+    if not self.spool_path then
+        return
+    end
+    if #self.buffer == 0 then
+        os.remove(self.spool_path)
+        return
+    end
+    local tmp_path = self.spool_path .. ".tmp"
+    local f = io.open(tmp_path, "w")
+    if not f then
+        logger.warn("[Companion] Cannot write spool:", tmp_path)
+        return
+    end
+    for _, line in ipairs(self.buffer) do
+        f:write(line, "\n")
     end
+    f:close()
+    os.rename(tmp_path, self.spool_path)
 end
 
 --[[
@@ -206,6 +838,8 @@ end
 function Companion:clear_buffer()
     local count = #self.buffer
     self.buffer = {}
+    self.buffer_bytes = 0
+    self:_write_spool()
     logger.info("[Companion] Cleared buffer, removed", count, "events")
 end
 
@@ -217,6 +851,9 @@ function Companion:get_status()
         enabled = self.enabled,
         url = self.url,
         buffered_events = #self.buffer,
+        device_id = self.device_id,
+        content_type = self.content_type,
+        clock_offset_ms = self.clock_offset,
     }
 end
 
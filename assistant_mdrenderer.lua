@@ -0,0 +1,116 @@
+-- incremental markdown renderer
+-- A growing answer is split into top-level blocks. Blocks that can no longer change
+-- keep their HTML from the previous render, only the trailing (open) block and blocks
+-- never seen before are parsed again, so re-rendering a long answer after every
+-- update costs about the size of what was added instead of the whole text
+local MD = require("assistant_mdparser")
+local socket_ok, socket = pcall(require, "socket")
+
+local now = socket_ok and type(socket) == "table" and socket.gettime or os.clock
+
+local MDRenderer = {
+    incremental = true, -- false renders the whole text every time (for comparison)
+}
+
+function MDRenderer:new(o)
+    o = o or {}
+    setmetatable(o, self)
+    self.__index = self
+    o.cache = {} -- block text -> html
+    return o
+end
+
+local function isFence(line)
+    return line:match("^%s*```") or line:match("^%s*~~~")
+end
+
+local function isListItem(line)
+    return line:match("^[%*%-%+][ \t]") or line:match("^%d+[%.%)][ \t]")
+end
+
+-- reference style links and footnotes are resolved across the whole text,
+-- blocks using them cannot be parsed on their own
+local function hasReferences(text)
+    return text:find("\n[ \t]*%[[^%]\n]+%]:") or text:find("^[ \t]*%[[^%]\n]+%]:")
+end
+
+--- Split markdown text into top-level blocks at blank lines outside code fences
+--- @return table list of block texts, the last one is the open block
+function MDRenderer.splitBlocks(text)
+    local blocks = {}
+    local current = {}
+    local in_fence = false
+    local in_list = false
+    local pending_blank = false
+
+    for line in (text .. "\n"):gmatch("([^\n]*)\n") do
+        if in_fence then
+            table.insert(current, line)
+            if isFence(line) then in_fence = false end
+        elseif line:match("^%s*$") then
+            pending_blank = true
+            table.insert(current, line)
+        else
+            -- indented text and further items of a list continue the block before the blank line
+            local continues = line:match("^[ \t]") or (in_list and isListItem(line))
+            if pending_blank and not continues and #current > 0 then
+                -- the blank line closes the block before it
+                while #current > 0 and current[#current]:match("^%s*$") do
+                    table.remove(current)
+                end
+                if #current > 0 then
+                    table.insert(blocks, table.concat(current, "\n"))
+                end
+                current = {}
+                in_list = false
+            end
+            pending_blank = false
+            table.insert(current, line)
+            if isListItem(line) then in_list = true end
+            if isFence(line) then in_fence = true end
+        end
+    end
+    table.insert(blocks, table.concat(current, "\n"))
+    return blocks
+end
+
+--- Render text to HTML
+--- @return string html (nil on error), string error, table stats
+---   stats: mode ("incremental" or "full"), blocks, parsed (blocks parsed this time), parse_ms
+function MDRenderer:render(text)
+    local start = now()
+    text = text or ""
+
+    if not self.incremental or hasReferences(text) then
+        local html, err = MD(text)
+        self.cache = {}
+        return html, err, { mode = "full", blocks = 1, parsed = 1,
+                            parse_ms = (now() - start) * 1000 }
+    end
+
+    local blocks = MDRenderer.splitBlocks(text)
+    local cache = {}
+    local parts = {}
+    local parsed = 0
+    for i, block in ipairs(blocks) do
+        local html = self.cache[block]
+        if not html or i == #blocks then
+            local err
+            html, err = MD(block)
+            if err or not html then
+                return nil, err, nil
+            end
+            parsed = parsed + 1
+        end
+        -- the open block may still grow, keep it out of the cache
+        if i < #blocks then cache[block] = html end
+        parts[i] = html
+    end
+    -- only blocks of the current text are kept, the cache never outgrows the answer
+    self.cache = cache
+
+    return table.concat(parts, "\n"), nil, { mode = "incremental", blocks = #blocks, parsed = parsed,
+                                             parse_ms = (now() - start) * 1000 }
+end
+
+return MDRenderer
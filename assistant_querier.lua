@@ -35,6 +35,18 @@ local Querier = {
     interrupt_stream = nil,      -- function to interrupt the stream query
     user_interrupted = false,  -- flag to indicate if the stream was interrupted
     companion = nil, -- companion app reporter (optional)
+    last_trace = nil, -- root span of the last query, parent for spans reported later
+    stream_marks = nil, -- request timings and parse totals of the last stream
+}
+
+-- Request phases reported as child spans: name, start mark, end mark
+-- (marks are recorded by the handler, see BaseHandler timeRequest)
+local REQUEST_PHASES = {
+    { "spawn", "spawned", "started" },
+    { "connect", "started", "connected" },
+    { "upload", "connected", "sent" },
+    { "wait", "sent", "first_byte" },
+    { "download", "first_byte", "done" },
 }
 
 function Querier:new(o)
@@ -55,6 +67,38 @@ function Querier:is_inited()
     return self.handler ~= nil
 end
 
+--- Start a trace span when the companion is enabled (nil otherwise)
+function Querier:spanStart(name, parent, attrs)
+    if self.companion and self.companion:is_enabled() and (parent or name == "query") then
+        return self.companion:span_start(name, parent, attrs)
+    end
+end
+
+--- Finish a span started with spanStart (no-op for nil)
+function Querier:spanEnd(span, attrs)
+    if span then
+        self.companion:span_end(span, attrs)
+    end
+end
+
+--- Add child spans for the request phases found in marks
+function Querier:addRequestSpans(parent, marks)
+    if not parent or type(marks) ~= "table" then return end
+    for _, phase in ipairs(REQUEST_PHASES) do
+        local from, to = marks[phase[2]], marks[phase[3]]
+        if from and to and to >= from then
+            self.companion:span_add(parent, phase[1], from, to)
+        end
+    end
+end
+
+--- Send the collected spans of the last query to the companion
+function Querier:flushSpans()
+    if self.companion and self.companion:is_enabled() then
+        self.companion:flush_spans()
+    end
+end
+
 --- Load provider model for the Querier
 function Querier:load_model(provider_name)
     -- If the provider is already loaded, do nothing.
@@ -169,13 +213,36 @@ function Querier:query(message_history, title)
         return nil, _("Plugin is not configured.")
     end
 
+    -- The whole query is traced for the companion app, see _query for the phases
+    local trace = self:spanStart("query", nil, { provider = self.provider_name })
+    local res, err = self:_query(message_history, title, trace)
+    self:spanEnd(trace, { status = res and "complete" or (self.user_interrupted and "cancelled" or "error") })
+    self.last_trace = trace
+    self:flushSpans()
+    return res, err
+end
+
+--- Title of the open book (its file name if it has none), costs are reported per book
+function Querier:bookTitle()
+    local document = koutil.tableGetValue(self.assistant, "ui", "document")
+    if not document then return nil end
+    local ok, props = pcall(function() return document:getProps() end)
+    if ok and props and props.title and props.title ~= "" then
+        return props.title
+    end
+    return document.file and document.file:match("([^/]+)$")
+end
+
+function Querier:_query(message_history, title, trace)
     -- Report query start to companion app
     if self.companion and self.companion:is_enabled() then
         self.companion:send("query_start", {
             provider = self.provider_name,
             model = koutil.tableGetValue(self.provider_settings, "model"),
             title = title or "AI Query",
+            book = self:bookTitle(),
             history = trimMessageHistory(message_history),
+            trace_id = trace and trace.trace_id,
         })
     end
 
@@ -190,7 +257,12 @@ function Querier:query(message_history, title)
 
     UIManager:show(infomsg)
     self.handler:setTrapWidget(infomsg)
+    self.handler.request_marks = nil
+    self.handler.last_usage = nil
+    local request_span = self:spanStart("request", trace, { stream = use_stream_mode })
     local res, err = self.handler:query(trimMessageHistory(message_history), self.provider_settings)
+    self:spanEnd(request_span)
+    self:addRequestSpans(request_span, self.handler.request_marks)
     self.handler:resetTrapWidget()
     UIManager:close(infomsg)
 
@@ -253,15 +325,23 @@ function Querier:query(message_history, title)
         UIManager:show(streamDialog)
 
         local stream_mode_auto_scroll = self.settings:readSetting("stream_mode_auto_scroll", true)
+        local stream_span = self:spanStart("stream", trace)
+        local render = { count = 0, time = 0 } -- time spent updating the stream dialog
         local ok, content, err = pcall(self.processStream, self, res, function (content, buffer)
             UIManager:nextTick(function ()
                 -- schedule the text update in the UIManager task queue
+                local started = stream_span and Companion.now()
                 if stream_mode_auto_scroll then
                     streamDialog:addTextToInput(content or "")
                 else
                     streamDialog._input_widget:resyncPos()
                     streamDialog._input_widget:setText(table.concat(buffer or {}), true)
                 end
+                if started then
+                    render.first = render.first or started
+                    render.count = render.count + 1
+                    render.time = render.time + Companion.now() - started
+                end
             end)
         end)
         if not ok then
@@ -269,6 +349,22 @@ function Querier:query(message_history, title)
             err = content -- content contains the error message
         end
 
+        if stream_span then
+            local marks = self.stream_marks or {}
+            self:spanEnd(stream_span, { chunks = marks.chunks })
+            self:addRequestSpans(stream_span, marks)
+            -- Parsing and rendering are spread over the stream, they are
+            -- reported as their total time starting at their first occurrence
+            if marks.parse_first then
+                self.companion:span_add(stream_span, "parse", marks.parse_first,
+                    marks.parse_first + marks.parse_time, { lines = marks.parse_count, total = true })
+            end
+            if render.first then
+                self.companion:span_add(stream_span, "render", render.first,
+                    render.first + render.time, { updates = render.count, total = true })
+            end
+        end
+
         UIManager:close(streamDialog)
 
         if self.user_interrupted then
@@ -327,6 +423,7 @@ function Querier:query(message_history, title)
     if self.companion and self.companion:is_enabled() then
         self.companion:send("query_complete", {
             response_length = #res,
+            usage = self.handler.last_usage,
         })
     end
     
@@ -337,6 +434,9 @@ end
 --  and process the response in realtime, output to the trunk callback
 -- return the full response content when the stream ends
 function Querier:processStream(bgQuery, trunk_callback)
+    -- request timings written by the subprocess, and the JSON parse totals
+    local marks = { spawned = Companion and Companion.now(), chunks = 0, parse_count = 0, parse_time = 0 }
+    self.stream_marks = marks
     local pid, parent_read_fd = ffiutil.runInSubProcess(bgQuery, true) -- pipe: true
 
     if not pid then
@@ -407,10 +507,21 @@ function Querier:processStream(bgQuery, trunk_callback)
                         if json_str == '[DONE]' then break end -- end of SSE stream
 
                         -- Safely parse the JSON
+                        local parse_start = marks.spawned and Companion.now()
                         local ok, event = pcall(rapidjson.decode, json_str, {null = nil})
+                        if parse_start then
+                            marks.parse_first = marks.parse_first or parse_start
+                            marks.parse_count = marks.parse_count + 1
+                            marks.parse_time = marks.parse_time + Companion.now() - parse_start
+                        end
                         if ok and event then
                         
                             local reasoning_content, content
+                            -- token usage, in the last chunk or spread over the stream (Anthropic
+                            -- reports the input in message_start and the output in message_delta)
+                            local usage = self.handler.normalizeUsage(event) or
+                                          self.handler.normalizeUsage(event.message)
+                            self.handler.last_usage = self.handler.mergeUsage(self.handler.last_usage, usage)
 
                             local choice = koutil.tableGetValue(event, "choices", 1)
                             if choice then -- OpenAI (compatiable) API
@@ -430,6 +541,7 @@ function Querier:processStream(bgQuery, trunk_callback)
                             end
                                 
                             if type(content) == "string" and #content > 0 then
+                                marks.chunks = marks.chunks + 1
                                 table.insert(result_buffer, content)
                                 if trunk_callback then trunk_callback(content, result_buffer) end
                                 -- Report to companion
@@ -443,7 +555,7 @@ function Querier:processStream(bgQuery, trunk_callback)
                                 if self.companion and self.companion:is_enabled() then
                                     self.companion:send("stream_chunk", { reasoning = reasoning_content })
                                 end
-                            elseif content == nil and reasoning_content == nil then
+                            elseif content == nil and reasoning_content == nil and not usage then
                                 logger.warn("Unexpected SSE data:", json_str)
                             end
                         else
@@ -457,6 +569,9 @@ function Querier:processStream(bgQuery, trunk_callback)
                         -- If the line starts with '{', it might be a JSON object
                         local ok, j = pcall(rapidjson.decode, line, {null=nil})
                         if ok and j then
+                            -- Ollama streams plain JSON lines, the last one counts the tokens
+                            self.handler.last_usage = self.handler.mergeUsage(self.handler.last_usage,
+                                self.handler.normalizeUsage(j))
                             -- log the json
                             local err_message = koutil.tableGetValue(j, "error", "message")
                             if err_message then
@@ -471,6 +586,10 @@ function Querier:processStream(bgQuery, trunk_callback)
                             -- the json was breaked into lines, just log the raw line
                             table.insert(result_buffer, line)  -- Add the raw line to the result
                         end
+                    elseif line:sub(1, #(self.handler.PROTOCOL_TRACE)) == self.handler.PROTOCOL_TRACE then
+                        -- request timing from the subprocess: "X-TRACE: <mark> <time>"
+                        local name, time = line:match("^%S+%s+(%S+)%s+(%S+)")
+                        if name then marks[name] = tonumber(time) end
                     elseif line:sub(1, #(self.handler.PROTOCOL_NON_200)) == self.handler.PROTOCOL_NON_200 then
                         -- child writes a non-200 response 
                         non200 = true
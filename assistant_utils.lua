@@ -1,5 +1,8 @@
 local util = require("util")
 local logger = require("logger")
+local DataStorage = require("datastorage")
+local LuaSettings = require("luasettings")
+local lfs = require("libs/libkoreader-lfs")
 local UIManager = require("ui/uimanager")
 local InfoMessage = require("ui/widget/infomessage")
 local T = require("ffi/util").template
@@ -19,8 +22,109 @@ local function getGeneralNotebookFilePath(assistant)
   return notebookfile
 end
 
+-- Extracted text of the pages of the open page-based document, by page number.
+-- Page text does not depend on any view setting, so it is also kept on disk,
+-- per document (by partial MD5), and survives closing the book. The disk copy
+-- is written on FlushSettings (suspend, closing the book) and stays bounded:
+-- a book keeps the MAX_CACHED_PAGES pages nearest to where it was last read,
+-- and the least recently used books go once the cache exceeds MAX_CACHE_SIZE
+local PAGE_TEXT_CACHE_DIR = DataStorage:getDataDir() .. "/cache/assistant_pagetext"
+local MAX_CACHED_PAGES = 500
+local MAX_CACHE_SIZE = 8 * 1024 * 1024 -- bytes
+local page_text_cache = { file = nil, path = nil, pages = {}, count = 0, settings = nil, dirty = false }
+
+-- remove the least recently used cache files until the cache fits, keeping the file in use
+local function trimPageTextCacheDir(keep)
+  local files, total = {}, 0
+  for name in lfs.dir(PAGE_TEXT_CACHE_DIR) do
+    local path = PAGE_TEXT_CACHE_DIR .. "/" .. name
+    local attr = name:match("%.lua$") and lfs.attributes(path)
+    if attr and attr.mode == "file" then
+      table.insert(files, { path = path, size = attr.size, used = attr.modification })
+      total = total + attr.size
+    end
+  end
+  table.sort(files, function(a, b) return a.used < b.used end)
+  for _, file in ipairs(files) do
+    if total <= MAX_CACHE_SIZE then break end
+    if file.path ~= keep and os.remove(file.path) then
+      total = total - file.size
+    end
+  end
+end
+
+local function flushPageTextCache(cache)
+  if cache.dirty and cache.settings then
+    cache.settings:saveSetting("pages", cache.pages)
+    cache.settings:flush()
+    local ok, err = pcall(trimPageTextCacheDir, cache.path)
+    if not ok then logger.warn("Assistant: cannot trim page text cache:", err) end
+  end
+  cache.dirty = false
+end
+
+local function getPageTextCache(document)
+  if page_text_cache.file == document.file then
+    return page_text_cache
+  end
+  flushPageTextCache(page_text_cache)
+  page_text_cache = { file = document.file, path = nil, pages = {}, count = 0, settings = nil, dirty = false }
+  local ok, md5 = pcall(util.partialMD5, document.file)
+  if ok and md5 and util.makePath(PAGE_TEXT_CACHE_DIR) then
+    page_text_cache.path = PAGE_TEXT_CACHE_DIR .. "/" .. md5 .. ".lua"
+    lfs.touch(page_text_cache.path) -- most recently used, for trimPageTextCacheDir
+    page_text_cache.settings = LuaSettings:open(page_text_cache.path)
+    page_text_cache.pages = page_text_cache.settings:readSetting("pages") or {}
+    for _ in pairs(page_text_cache.pages) do
+      page_text_cache.count = page_text_cache.count + 1
+    end
+  end
+  return page_text_cache
+end
+
+-- drop the pages farthest from page until at most MAX_CACHED_PAGES are left
+local function trimPageTextCache(cache, page)
+  if cache.count <= MAX_CACHED_PAGES then return end
+  local pages = {}
+  for cached in pairs(cache.pages) do
+    table.insert(pages, cached)
+  end
+  table.sort(pages, function(a, b) return math.abs(a - page) > math.abs(b - page) end)
+  for i = 1, #pages - MAX_CACHED_PAGES do
+    cache.pages[pages[i]] = nil
+  end
+  cache.count = MAX_CACHED_PAGES
+  cache.dirty = true
+end
+
+local function getPageText(document, page, cache)
+  local page_text = cache.pages[page]
+  if page_text then return page_text end
+
+  page_text = document:getPageText(page) or ""
+  if type(page_text) == "table" then
+    local texts = {}
+    for _, block in ipairs(page_text) do
+      if type(block) == "table" then
+        for i = 1, #block do
+          local span = block[i]
+          if type(span) == "table" and span.word then
+            table.insert(texts, span.word)
+          end
+        end
+      end
+    end
+    page_text = table.concat(texts, " ")
+  end
+  cache.pages[page] = page_text
+  cache.count = cache.count + 1
+  cache.dirty = true
+  return page_text
+end
+
 local function extractBookTextForAnalysis(CONFIGURATION, ui)
     local book_text = nil
+    local max_text_length_for_analysis = koutil.tableGetValue(CONFIGURATION, "features", "max_text_length_for_analysis") or 100000
       if not ui.document.info.has_pages then
           -- Only extract text for EPUB documents
           local current_xp = ui.document:getXPointer()
@@ -28,36 +132,31 @@ local function extractBookTextForAnalysis(CONFIGURATION, ui)
           local start_xp = ui.document:getXPointer()
           ui.document:gotoXPointer(current_xp)
           book_text = ui.document:getTextFromXPointers(start_xp, current_xp) or ""
-          local max_text_length_for_analysis = koutil.tableGetValue(CONFIGURATION, "features", "max_text_length_for_analysis") or 100000
           if #book_text > max_text_length_for_analysis then
               book_text = book_text:sub(-max_text_length_for_analysis)
           end
       else
-        -- Extract text from the last n pages up to current reading position for page-based documents
+        -- Extract text from the last n pages up to current reading position for page-based documents,
+        -- walking back from the current page until the text length budget is used up
         local current_page = ui.view.state.page
-        local total_pages = ui.document:getPageCount()
         local max_page_size_for_analysis = koutil.tableGetValue(CONFIGURATION, "features", "max_page_size_for_analysis") or 250
         local start_page = math.max(1, current_page - max_page_size_for_analysis)
-        book_text = ""
-        for page = start_page, current_page do
-            local page_text = ui.document:getPageText(page) or ""
-            if type(page_text) == "table" then
-                local texts = {}
-                for _, block in ipairs(page_text) do
-                    if type(block) == "table" then
-                        for i = 1, #block do
-                            local span = block[i]
-                            if type(span) == "table" and span.word then
-                                table.insert(texts, span.word)
-                            end
-                        end
-                    end
-                end
-                page_text = table.concat(texts, " ")
-            end
-            book_text = book_text .. page_text .. "\n"
+        local cache = getPageTextCache(ui.document)
+        local texts = {}
+        local length = 0
+        for page = current_page, start_page, -1 do
+            local page_text = getPageText(ui.document, page, cache)
+            table.insert(texts, page_text .. "\n")
+            length = length + #page_text + 1
+            if length >= max_text_length_for_analysis then break end
+        end
+        trimPageTextCache(cache, current_page)
+
+        -- pages were collected last to first
+        for i = 1, math.floor(#texts / 2) do
+            texts[i], texts[#texts - i + 1] = texts[#texts - i + 1], texts[i]
         end
-        local max_text_length_for_analysis = koutil.tableGetValue(CONFIGURATION, "features", "max_text_length_for_analysis") or 100000
+        book_text = table.concat(texts)
         if #book_text > max_text_length_for_analysis then
             book_text = book_text:sub(-max_text_length_for_analysis)
         end
@@ -323,6 +422,7 @@ end
 return {
     getGeneralNotebookFilePath = getGeneralNotebookFilePath,
     extractBookTextForAnalysis = extractBookTextForAnalysis,
+    flushPageTextCache = function() flushPageTextCache(page_text_cache) end,
     extractHighlightsNotesAndNotebook = extractHighlightsNotesAndNotebook,
     getPageInfo = getPageInfo,
     saveToNotebookFile = saveToNotebookFile,
@@ -35,7 +35,7 @@ local util = require("util")
 local _ = require("assistant_gettext")
 local InfoMessage = require("ui/widget/infomessage")
 local Screen = Device.screen
-local MD = require("assistant_mdparser")
+local MDRenderer = require("assistant_mdrenderer")
 local Prompts = require("assistant_prompts")
 local assistant_utils = require("assistant_utils")
 
@@ -475,12 +475,11 @@ function ChatGPTViewer:init()
 
   if self.render_markdown then
     -- Convert Markdown to HTML and render in a ScrollHtmlWidget
-    local html_body, err = MD(self.text)
-    if err then
-      logger.warn("ChatGPTViewer: could not generate HTML", err)
-      -- Fallback to plain text if HTML generation fails
-      html_body = self.text or "Missing text."
-    end
+    -- the renderer keeps the HTML of finished blocks for later updates
+    self.md_renderer = MDRenderer:new{
+      incremental = util.tableGetValue(self.assistant.CONFIGURATION, "features", "incremental_markdown") ~= false,
+    }
+    local html_body = self:renderHTML(self.text)
     local css = VIEWER_CSS .. ((self.assistant.settings:readSetting("response_is_rtl") 
                                 or self.assistant.ui_language_is_rtl) and RTL_CSS or "")
     self.scroll_text_w = ScrollHtmlWidget:new {
@@ -593,6 +592,12 @@ function ChatGPTViewer:saveToNotebook()
 end
 
 function ChatGPTViewer:onCloseWidget()
+  -- Drop a pending rebuild of the text widget
+  if self.rebuild_task then
+    UIManager:unschedule(self.rebuild_task)
+    self.rebuild_task = nil
+  end
+
   -- Reset all history and context
   self.text = ""
   self.message_history = nil
@@ -951,8 +956,25 @@ function ChatGPTViewer:html_link_tapped_callback(link)
   end
 end
 
+--- Convert Markdown text to HTML, falls back to the plain text if that fails
+--- @return string html_body, table render stats (nil after a failure)
+function ChatGPTViewer:renderHTML(text)
+  local html_body, err, stats = self.md_renderer:render(text)
+  if err or not html_body then
+    logger.warn("ChatGPTViewer: could not generate HTML", err)
+    -- Fallback to plain text if HTML generation fails
+    return text or "Missing text.", nil
+  end
+  return html_body, stats
+end
+
 function ChatGPTViewer:update(new_text)
   local last_page_num = 1
+  local render_stats
+
+  -- rendering the answer is reported to the companion app as part of the query's trace
+  local querier = self.assistant and self.assistant.querier
+  local render_span = querier and querier:spanStart("render", querier.last_trace, { chars = #new_text })
 
   -- Check if the new text is substantially different from the current text
   if not self.text or #new_text > #self.text then
@@ -965,12 +987,8 @@ function ChatGPTViewer:update(new_text)
       last_page_num = self.scroll_text_w.htmlbox_widget.page_count
 
       -- Convert Markdown to HTML and recreate the ScrollHtmlWidget with the new text
-      local html_body, err = MD(self.text)
-      if err then
-        logger.warn("ChatGPTViewer: could not generate HTML", err)
-        -- Fallback to plain text if HTML generation fails
-        html_body = self.text or "Missing text."
-      end
+      local html_body
+      html_body, render_stats = self:renderHTML(self.text)
       local css = VIEWER_CSS .. ((self.assistant.settings:readSetting("response_is_rtl") 
                                 or self.assistant.ui_language_is_rtl) and RTL_CSS or "")
       self.scroll_text_w = ScrollHtmlWidget:new {
@@ -1017,6 +1035,18 @@ function ChatGPTViewer:update(new_text)
       UIManager:setDirty(self.frame, "partial")
     end
   end
+
+  if render_span then
+    local attrs = { markdown = self.render_markdown and true or false }
+    if render_stats then
+      attrs.mode = render_stats.mode
+      attrs.blocks = render_stats.blocks
+      attrs.parsed = render_stats.parsed
+      attrs.parse_ms = math.floor(render_stats.parse_ms * 1000 + 0.5) / 1000
+    end
+    querier:spanEnd(render_span, attrs)
+    querier:flushSpans()
+  end
 end
 
 return ChatGPTViewer
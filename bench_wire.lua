@@ -0,0 +1,73 @@
+#!/usr/bin/env lua
+--[[
+    Benchmark of the companion wire formats on the device
+    Reports bytes per event (raw, and deflated when KOReader's zlib is there)
+    and encode time per event for Companion.encode_msgpack and JSON.encode,
+    using the sample events and a large synthetic query_start, like
+    assistant-companion/examples/bench_wire.py does on the companion side.
+
+    Run it with KOReader's LuaJIT from the KOReader directory, e.g.:
+        ./luajit plugins/assistant.koplugin/bench_wire.lua [events.json]
+]]
+
+-- Modules next to this script, KOReader's own modules from the working directory
+local dir = arg and arg[0] and arg[0]:match("^(.*)/") or "."
+package.path = dir .. "/?.lua;common/?.lua;frontend/?.lua;" .. package.path
+
+local JSON = require("json")
+local Companion = require("assistant_companion")
+
+local zlib_ok, zlib = pcall(require, "ffi/zlib")
+if not (zlib_ok and type(zlib) == "table" and zlib.zlib_compress) then
+    zlib = nil
+end
+
+local ROUNDS = 2000
+
+-- Sample events plus one query_start with a long book excerpt
+local function load_events(path)
+    local file = assert(io.open(path, "r"), "cannot open " .. path)
+    local events = JSON.decode(file:read("*a"))
+    file:close()
+    table.insert(events, {
+        event = "query_start",
+        timestamp = os.time(),
+        data = {
+            provider = "anthropic",
+            model = "claude-sonnet",
+            title = "Explain",
+            history = {
+                { role = "system", content = "You are a helpful reading assistant." },
+                { role = "user", content = "Book excerpt: " .. string.rep("It was a bright cold day in April. ", 200) },
+            },
+        },
+    })
+    return events
+end
+
+-- Time encoding of every event, ROUNDS times
+local function bench(name, encode, events)
+    local raw, deflated = 0, 0
+    for _, event in ipairs(events) do
+        local body = encode(event)
+        raw = raw + #body
+        if zlib then deflated = deflated + #zlib.zlib_compress(body) end
+    end
+
+    local start = os.clock()
+    for _ = 1, ROUNDS do
+        for _, event in ipairs(events) do
+            encode(event)
+        end
+    end
+    local encode_us = (os.clock() - start) / (ROUNDS * #events) * 1e6
+
+    print(string.format("%-10s %10.0f %10s %10.1f", name, raw / #events,
+        zlib and string.format("%.0f", deflated / #events) or "-", encode_us))
+end
+
+local events = load_events(arg and arg[1] or dir .. "/assistant-companion/examples/sample_events.json")
+print(string.format("%d events, %d rounds\n", #events, ROUNDS))
+print(string.format("%-10s %10s %10s %10s", "format", "bytes", "deflated", "encode µs"))
+bench("json", JSON.encode, events)
+bench("msgpack", Companion.encode_msgpack, events)
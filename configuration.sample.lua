@@ -175,6 +175,7 @@ local CONFIGURATION = {
         long_highlight_threshold = 500,  -- Number of characters considered "long"
         -- system_prompt = "You are a helpful AI assistant. Always respond in Markdown format.", -- Custom system prompt for the AI ("Ask" button) to override the default, to disable set to nil
         render_markdown = true, -- Set to true to render markdown in the AI responses
+        incremental_markdown = true, -- Re-render only the changed end of an updated answer, set to false to re-render the whole text (for comparing render times)
         updater_disabled = false, -- Set to true to disable update check.
         default_folder_for_logs = nil, -- Set the default folder for auto saved logs, nil for the same folder as the book, ex: "/mnt/onboard/logs/" for Kobo , "/mnt/us/documents/logs/" for Kindle
         max_text_length_for_analysis = 100000, -- max text lenght to be used on xray-recap-book analyzes, 
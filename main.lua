@@ -554,6 +554,11 @@ function Assistant:onFlushSettings()
         self.settings:flush()
         self.updated = nil
     end
+    -- page text extracted for book analysis, only if it was used at all
+    local assistant_utils = package.loaded["assistant_utils"]
+    if assistant_utils then
+        assistant_utils.flushPageTextCache()
+    end
 end
 
 function Assistant:isConfigured()
@@ -17,6 +17,13 @@ local logger = {
 }
 _G.logger = logger
 
+-- Mock UI loop: scheduled tasks are collected, tests run them by hand
+local scheduled = {}
+package.loaded["ui/uimanager"] = {
+    scheduleIn = function(_, delay, task) table.insert(scheduled, { delay = delay, task = task }) end,
+    unschedule = function() end,
+}
+
 -- Mock settings for testing
 local MockSettings = {}
 function MockSettings:new()
@@ -198,6 +205,7 @@ end)
 test("Buffer size limit", function()
     local Companion = require("assistant_companion")
     local settings = MockSettings:new()
+    settings:saveSetting("companion_buffer_size", 100)
     local companion = Companion:new(settings)
     companion:set_enabled(true)
     companion:set_url("http://invalid:9999")
@@ -211,6 +219,163 @@ test("Buffer size limit", function()
     assert_true(status.buffered_events <= 100, "Buffer should not exceed max size")
 end)
 
+-- Test 11: Small bodies are sent uncompressed
+test("Small bodies are not compressed", function()
+    local Companion = require("assistant_companion")
+    local settings = MockSettings:new()
+    local companion = Companion:new(settings)
+    
+    local body, encoding = companion:_compress('{"event":"heartbeat"}')
+    assert_eq(body, '{"event":"heartbeat"}', "Small body should be unchanged")
+    assert_eq(encoding, nil, "Small body should have no Content-Encoding")
+end)
+
+-- Test 12: MessagePack encoding
+test("Encodes events as MessagePack", function()
+    local Companion = require("assistant_companion")
+    
+    assert_eq(Companion.encode_msgpack({}), "\128", "Empty table should be an empty fixmap")
+    assert_eq(Companion.encode_msgpack({ event = "heartbeat" }),
+        "\129\165event\169heartbeat", "Map with one string should be compact")
+    assert_eq(Companion.encode_msgpack({ 1, true }), "\146\001\195", "Sequence should be an array")
+end)
+
+-- Test 13: Events carry a device id and increasing sequence numbers
+test("Events have device id and sequence", function()
+    local Companion = require("assistant_companion")
+    local settings = MockSettings:new()
+    local companion = Companion:new(settings)
+    
+    local device_id = companion:get_status().device_id
+    assert_true(device_id ~= nil, "Should generate a device id")
+    assert_eq(settings.settings.companion_device_id, device_id, "Device id should be saved")
+    
+    local first = companion:_next_seq()
+    assert_eq(companion:_next_seq(), first + 1, "Sequence should increase")
+    
+    -- A new instance continues after the reserved block
+    local restarted = Companion:new(settings)
+    assert_eq(restarted:get_status().device_id, device_id, "Device id should persist")
+    assert_true(restarted:_next_seq() > first + 1, "Sequence should not restart")
+end)
+
+-- Test 14: Buffered events survive a restart through the spool file
+test("Spool survives restart", function()
+    local Companion = require("assistant_companion")
+    local settings = MockSettings:new()
+    local spool_path = os.tmpname()
+    settings:saveSetting("companion_spool_path", spool_path)
+    
+    local companion = Companion:new(settings)
+    companion:set_enabled(true)
+    companion:set_url("http://invalid:9999")
+    companion:send("test", {count = 1})
+    companion:send("test", {count = 2})
+    local buffered = companion:get_status().buffered_events
+    assert_true(buffered >= 2, "Should buffer events")
+    
+    -- Simulate a write cut short by power loss
+    local f = io.open(spool_path, "a")
+    f:write('{"event":"te')
+    f:close()
+    
+    local restarted = Companion:new(settings)
+    assert_eq(restarted:get_status().buffered_events, buffered, "Should reload spooled events")
+    
+    restarted:clear_buffer()
+    assert_eq(io.open(spool_path, "r"), nil, "Clearing should remove the spool")
+end)
+
+-- Test 15: Trace spans are collected and sent as one event
+test("Trace spans are sent together", function()
+    local Companion = require("assistant_companion")
+    local companion = Companion:new(MockSettings:new())
+    companion:set_enabled(true)
+    companion:set_url("http://invalid:9999")
+    companion:clear_buffer()
+    
+    local root = companion:span_start("query")
+    local child = companion:span_start("request", root)
+    assert_eq(child.trace_id, root.trace_id, "Child should share the trace")
+    assert_eq(child.parent_id, root.id, "Child should point to its parent")
+    companion:span_end(child)
+    companion:span_add(root, "connect", root.start, root.start + 0.5)
+    companion:span_end(root, {status = "complete"})
+    assert_true(root.duration >= 0, "Finished span should have a duration")
+    
+    companion:flush_spans()
+    assert_eq(#companion.spans, 0, "Spans should be handed over")
+    assert_eq(companion:get_status().buffered_events, 1, "Spans should go out in one event")
+    local line = companion.buffer[1]
+    assert_true(line:find('"event":"trace"', 1, true), "Event should be a trace")
+    assert_true(line:find('"name":"connect"', 1, true), "Trace should carry all spans")
+    companion:clear_buffer()
+end)
+
+-- Test 16: Rate limited events wait for Retry-After in the spool
+test("Rate limited events are spooled", function()
+    local Companion = require("assistant_companion")
+    local companion = Companion:new(MockSettings:new())
+    companion:set_enabled(true)
+    companion:clear_buffer()
+    
+    local posts = 0
+    companion._post = function(self, path)
+        posts = posts + 1
+        return 429, {["retry-after"] = "7"}, '{"status": "deferred", "handled": 0}'
+    end
+    companion.clock_sync_at = math.huge
+    companion.retry_at = 0
+    
+    assert_false(companion:send("stream_chunk", {content = "a"}), "Deferred event should not count as sent")
+    assert_eq(companion:get_status().buffered_events, 1, "Deferred event should be spooled")
+    assert_eq(companion.retry_at - os.time(), 7, "Retry-After should be honoured")
+    
+    companion:send("stream_chunk", {content = "b"})
+    assert_eq(posts, 1, "Nothing should be sent before Retry-After")
+    assert_eq(companion:get_status().buffered_events, 2, "Later events should be spooled too")
+    companion:clear_buffer()
+end)
+
+-- Test 17: Clock exchanges wait for the end of a query, one round trip per task
+test("Clock sync runs after a query", function()
+    local Companion = require("assistant_companion")
+    local companion = Companion:new(MockSettings:new())
+    companion:set_enabled(true)
+    companion:clear_buffer()
+    
+    local clock_posts = 0
+    companion._post = function(self, path)
+        if path == "/time" then
+            clock_posts = clock_posts + 1
+            return 200, {}, '{"t1": 1, "t2": 2}'
+        end
+        return 200, {}, '{"status": "ok"}'
+    end
+    companion.retry_at = 0
+    companion.clock_sync_at = 0
+    companion.clock_sync_task = nil
+    for k in pairs(scheduled) do scheduled[k] = nil end
+    
+    companion:send("stream_chunk", {content = "a"})
+    assert_eq(clock_posts, 0, "No clock exchange while streaming")
+    assert_eq(#scheduled, 0, "Nothing should be scheduled while streaming")
+    
+    companion:send("query_complete", {})
+    companion:send("query_complete", {})
+    assert_eq(clock_posts, 0, "The exchange should not run inside send()")
+    assert_eq(#scheduled, 1, "One exchange should be scheduled")
+    
+    local rounds = 0
+    while #scheduled > 0 do
+        table.remove(scheduled, 1).task()
+        rounds = rounds + 1
+        assert_eq(clock_posts, rounds, "Every task should make one round trip")
+    end
+    assert_eq(rounds, 3, "The exchange should take three round trips")
+    assert_true(companion.clock_sync_task == nil, "The exchange should be over")
+end)
+
 -- Run all tests
 print("\n" .. string.rep("=", 60))
 print("Running Companion Module Tests")
@@ -4,12 +4,16 @@ Integration test for companion app
 Tests the full flow: Kindle module → Flask server → Browser
 """
 
+import os
 import sys
 import time
 import json
 import requests
 import subprocess
 import signal
+import tempfile
+import gzip
+import zlib
 from pathlib import Path
 
 # Colors for output
@@ -38,23 +42,11 @@ class TestRunner:
             return False
         
         try:
-            self.server_process = subprocess.Popen(
-                [sys.executable, str(app_path)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=str(companion_dir)
-            )
-            
-            # Wait for server to start
-            for i in range(10):
-                try:
-                    response = requests.get(f"{self.base_url}/health", timeout=1)
-                    if response.status_code == 200:
-                        print(f"{GREEN}✓ Server started successfully{RESET}")
-                        return True
-                except requests.exceptions.RequestException:
-                    time.sleep(0.5)
-            
+            # Keep persistent data (query log) out of the working tree
+            self.data_dir = tempfile.TemporaryDirectory()
+            if self.launch_server():
+                print(f"{GREEN}✓ Server started successfully{RESET}")
+                return True
             print(f"{RED}✗ Server failed to start{RESET}")
             return False
             
@@ -62,12 +54,35 @@ class TestRunner:
             print(f"{RED}Error starting server: {e}{RESET}")
             return False
     
+    def launch_server(self):
+        """Run the server on the current data directory; True once it answers"""
+        companion_dir = Path(__file__).parent / "assistant-companion"
+        self.server_process = subprocess.Popen(
+            [sys.executable, str(companion_dir / "companion" / "app.py")],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=str(companion_dir),
+            env=dict(os.environ, COMPANION_DATA_DIR=self.data_dir.name),
+            start_new_session=True  # its own process group, pre-fork workers included
+        )
+        
+        # Wait for server to start
+        for i in range(10):
+            try:
+                response = requests.get(f"{self.base_url}/health", timeout=1)
+                if response.status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                time.sleep(0.5)
+        return False
+    
     def stop_server(self):
         """Stop the Flask server"""
         if self.server_process:
             print(f"{BLUE}Stopping companion server...{RESET}")
             self.server_process.send_signal(signal.SIGTERM)
             self.server_process.wait(timeout=5)
+            self.data_dir.cleanup()
             print(f"{GREEN}✓ Server stopped{RESET}")
     
     def test(self, name, func):
@@ -259,6 +274,482 @@ class TestRunner:
         data = response.json()
         self.assert_eq(data['total'], 7, "Should have 7 events (1 start + 5 chunks + 1 complete)")
     
+    def test_search(self):
+        """Test full-text search over prompts and responses"""
+        requests.post(f"{self.base_url}/events", json={
+            "event": "query_start",
+            "timestamp": int(time.time()),
+            "data": {
+                "provider": "searchprov",
+                "model": "test-model",
+                "title": "Explain",
+                "history": [{"role": "user", "content": "What is a marmoset?"}]
+            }
+        }, timeout=2)
+        for part in ["A marmoset is a small ", "New World monkey."]:
+            requests.post(f"{self.base_url}/events", json={
+                "event": "stream_chunk",
+                "timestamp": int(time.time()),
+                "data": {"content": part}
+            }, timeout=2)
+        requests.post(f"{self.base_url}/events", json={
+            "event": "query_complete",
+            "timestamp": int(time.time()),
+            "data": {"response_length": 39}
+        }, timeout=2)
+        
+        response = requests.get(f"{self.base_url}/api/search",
+                                params={"q": "monk", "type": "response"}, timeout=2)
+        self.assert_eq(response.status_code, 200, "Search should return 200")
+        results = response.json()['results']
+        self.assert_eq(len(results), 1, "Prefix search should find the response")
+        self.assert_in('<mark>monkey</mark>', results[0]['snippet'], "Snippet should highlight the match")
+        
+        response = requests.get(f"{self.base_url}/api/search",
+                                params={"q": "marmoset", "provider": "other"}, timeout=2)
+        self.assert_eq(len(response.json()['results']), 0, "Provider filter should exclude results")
+        
+        response = requests.get(f"{self.base_url}/api/search",
+                                params={"q": "marmoset", "provider": "searchprov", "limit": -3}, timeout=2)
+        self.assert_eq(len(response.json()['results']), 1, "Negative limit should be clamped to one result")
+        
+        query = requests.get(f"{self.base_url}/api/queries/{results[0]['id']}", timeout=2).json()
+        self.assert_eq(query['response'], "A marmoset is a small New World monkey.", "Response should be assembled")
+        self.assert_eq(query['status'], 'complete', "Query should be complete")
+    
+    def test_compressed_transport(self):
+        """Test gzip/deflate request bodies and gzip responses"""
+        event = {
+            "event": "query_start",
+            "timestamp": int(time.time()),
+            "data": {"provider": "test", "history": [{"role": "user", "content": "excerpt " * 500}]}
+        }
+        body = json.dumps(event).encode('utf-8')
+        for encoding, compressed in [("gzip", gzip.compress(body)), ("deflate", zlib.compress(body))]:
+            response = requests.post(f"{self.base_url}/events", data=compressed, headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": encoding,
+            }, timeout=2)
+            self.assert_eq(response.status_code, 200, f"{encoding} body should be accepted")
+        
+        response = requests.post(f"{self.base_url}/events", data=b"not gzip", headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        }, timeout=2)
+        self.assert_eq(response.status_code, 400, "Corrupt gzip body should be rejected")
+        
+        response = requests.get(f"{self.base_url}/api/events", headers={"Accept-Encoding": "gzip"}, timeout=2)
+        self.assert_eq(response.headers.get('Content-Encoding'), 'gzip', "Events should be gzip-compressed")
+        self.assert_true(response.json()['total'] >= 2, "Compressed response should decode")
+        
+        response = requests.get(f"{self.base_url}/stream", headers={"Accept-Encoding": "gzip"},
+                                stream=True, timeout=2)
+        self.assert_eq(response.headers.get('Content-Encoding'), 'gzip', "Stream should be gzip-compressed")
+        first = next(response.iter_content(chunk_size=None))
+        response.close()
+        self.assert_in(b'data: ', first, "Compressed stream should decode")
+    
+    def test_msgpack_transport(self):
+        """Test MessagePack request bodies and format negotiation"""
+        sys.path.insert(0, str(Path(__file__).parent / "assistant-companion" / "companion"))
+        from wire import packb
+        
+        event = {
+            "event": "stream_chunk",
+            "timestamp": int(time.time()),
+            "data": {"content": "Grüße from msgpack", "tokens": 3}
+        }
+        response = requests.post(f"{self.base_url}/events", data=packb(event), headers={
+            "Content-Type": "application/msgpack",
+        }, timeout=2)
+        self.assert_eq(response.status_code, 200, "MessagePack body should be accepted")
+        self.assert_in("application/msgpack", response.headers.get('X-Companion-Accept', ''),
+                       "Server should advertise MessagePack")
+        
+        latest = requests.get(f"{self.base_url}/api/events", timeout=2).json()['events'][-1]
+        self.assert_eq(latest['data']['content'], "Grüße from msgpack", "Decoded event should be stored")
+        
+        # Binary values are stored as text; list keys and deep nesting are rejected
+        binary = b'\x83\xa5event\xacstream_chunk\xa9timestamp\x01\xa4data\x81\xa7content\xc4\x02hi'
+        response = requests.post(f"{self.base_url}/events", data=binary, headers={
+            "Content-Type": "application/msgpack",
+        }, timeout=2)
+        self.assert_eq(response.status_code, 200, "Binary MessagePack value should be accepted")
+        latest = requests.get(f"{self.base_url}/api/events", timeout=2).json()['events'][-1]
+        self.assert_eq(latest['data']['content'], "hi", "Binary value should be stored as text")
+        for body in (b'\x81\x91\x01\x01', b'\x91' * 200 + b'\x01'):
+            response = requests.post(f"{self.base_url}/events", data=body, headers={
+                "Content-Type": "application/msgpack",
+            }, timeout=2)
+            self.assert_eq(response.status_code, 400, "Malformed MessagePack should be rejected")
+        
+        response = requests.post(f"{self.base_url}/events", data=b"<event/>", headers={
+            "Content-Type": "application/xml",
+        }, timeout=2)
+        self.assert_eq(response.status_code, 415, "Unknown Content-Type should be rejected")
+    
+    def test_batch_catch_up(self):
+        """Test spooled event batches and duplicate detection"""
+        batch = {"events": [
+            {"event": "heartbeat", "timestamp": int(time.time()), "device": "kindle-test", "seq": seq, "data": {}}
+            for seq in range(1, 6)
+        ]}
+        response = requests.post(f"{self.base_url}/events/batch", json=batch, timeout=2)
+        self.assert_eq(response.status_code, 200, "Batch should be accepted")
+        self.assert_eq(response.json()['accepted'], 5, "All events should be stored")
+        
+        # The Kindle resends a batch when the response got lost
+        batch["events"].append({"event": "heartbeat", "timestamp": int(time.time()),
+                                "device": "kindle-test", "seq": 6, "data": {}})
+        body = gzip.compress(json.dumps(batch).encode('utf-8'))
+        response = requests.post(f"{self.base_url}/events/batch", data=body, headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        }, timeout=2)
+        self.assert_eq(response.json()['accepted'], 1, "Only the new event should be stored")
+        self.assert_eq(response.json()['duplicates'], 5, "Resent events should be dropped")
+        
+        response = requests.post(f"{self.base_url}/events", json=batch["events"][0], timeout=2)
+        self.assert_eq(response.json()['status'], 'duplicate', "Single resent event should be dropped")
+        
+        response = requests.post(f"{self.base_url}/events/batch", json={"events": ["bad"]}, timeout=2)
+        self.assert_eq(response.status_code, 400, "Malformed batch should be rejected")
+        response = requests.post(f"{self.base_url}/events", json={"event": "query_start", "data": ["bad"]}, timeout=2)
+        self.assert_eq(response.status_code, 400, "Event data that is not an object should be rejected")
+        
+        # An event that could not be stored is not remembered as received
+        event = {"event": "query_start", "timestamp": int(time.time()), "device": "kindle-test", "seq": 7,
+                 "data": {"provider": {"not": "a name"}}}
+        response = requests.post(f"{self.base_url}/events", json=event, timeout=2)
+        self.assert_eq(response.status_code, 500, "Event the query log cannot take should fail")
+        event["data"] = {"provider": "openai"}
+        response = requests.post(f"{self.base_url}/events", json=event, timeout=2)
+        self.assert_eq(response.json().get('status'), 'ok', "Resent event should be stored")
+    
+    def test_multiple_devices(self):
+        """Test per-device partitions, streams and statistics"""
+        for device in ("kindle-a", "kobo-b"):
+            for seq in range(1, 4):
+                response = requests.post(f"{self.base_url}/events", json={
+                    "event": "stream_chunk", "timestamp": int(time.time()),
+                    "device": device, "seq": seq, "data": {"content": f"{device} {seq}"}
+                }, timeout=2)
+                self.assert_eq(response.json()['event_id'], seq, "Each device should have its own sequence")
+        
+        stats = requests.get(f"{self.base_url}/api/stats", timeout=2).json()
+        self.assert_in("kindle-a", stats['devices'], "Stats should list devices")
+        self.assert_eq(stats['devices']['kobo-b']['total_events'], 3, "Stats should be per device")
+        
+        stats = requests.get(f"{self.base_url}/api/stats?device=kindle-a", timeout=2).json()
+        self.assert_eq(stats['event_types'].get('stream_chunk'), 3, "Device stats should be filtered")
+        
+        events = requests.get(f"{self.base_url}/api/events?device=kobo-b", timeout=2).json()['events']
+        self.assert_eq([e['data']['content'] for e in events], ["kobo-b 1", "kobo-b 2", "kobo-b 3"],
+                       "Device events should be in order")
+        
+        response = requests.get(f"{self.base_url}/stream?device=kindle-a", stream=True, timeout=2)
+        first = next(response.iter_content(chunk_size=None)).decode('utf-8')
+        response.close()
+        self.assert_in("kindle-a 1", first, "Device stream should include the device's events")
+        self.assert_true("kobo-b" not in first, "Device stream should not include other devices")
+    
+    def test_rollups(self):
+        """Test per-minute rollups of completed queries"""
+        device = "rollup-device"
+        events = [("query_start", {"provider": "rollprov", "model": "roll-model", "title": "Summarize"})]
+        events += [("stream_chunk", {"content": "chunk "})] * 3
+        events.append(("query_complete", {"response_length": 18, "tokens": 42}))
+        for seq, (event, data) in enumerate(events, 1):
+            requests.post(f"{self.base_url}/events", json={
+                "event": event, "timestamp": int(time.time()),
+                "device": device, "seq": seq, "data": data
+            }, timeout=2)
+        
+        # Queries are rolled up once they are a few seconds old
+        time.sleep(5.5)
+        response = requests.get(f"{self.base_url}/api/rollups",
+                                params={"resolution": "minute", "provider": "rollprov"}, timeout=2)
+        self.assert_eq(response.status_code, 200, "Rollups should return 200")
+        buckets = response.json()['buckets']
+        self.assert_eq(len(buckets), 1, "Query should land in one minute bucket")
+        self.assert_eq(buckets[0]['queries'], 1, "Bucket should count the query")
+        self.assert_eq(buckets[0]['chunks'], 3, "Bucket should count chunks")
+        self.assert_eq(buckets[0]['tokens'], 42, "Bucket should count tokens")
+        self.assert_true(buckets[0]['latency']['p50'] is not None, "Bucket should have a latency")
+        
+        response = requests.get(f"{self.base_url}/api/rollups", params={"resolution": "day"}, timeout=2)
+        self.assert_eq(response.status_code, 400, "Unknown resolution should be rejected")
+    
+    def test_export(self):
+        """Test CSV export of query summaries and events"""
+        response = requests.get(f"{self.base_url}/api/export/queries",
+                                params={"format": "csv", "provider": "rollprov"}, timeout=5)
+        self.assert_eq(response.status_code, 200, "Export should return 200")
+        self.assert_in("attachment", response.headers.get('Content-Disposition', ''), "Export should be a download")
+        lines = response.text.splitlines()
+        self.assert_true(lines[0].startswith("id,device,started_at"), "Export should start with a header")
+        self.assert_eq(len(lines), 2, "Provider filter should leave one query")
+        self.assert_in("rollup-device", lines[1], "Row should hold the query's device")
+        
+        response = requests.get(f"{self.base_url}/api/export/events",
+                                params={"format": "csv", "device": "rollup-device"}, timeout=5)
+        self.assert_eq(len(response.text.splitlines()), 6, "Events export should have a row per event")
+        
+        response = requests.get(f"{self.base_url}/api/export/queries",
+                                params={"format": "csv", "since": time.time() + 60}, timeout=5)
+        self.assert_eq(len(response.text.splitlines()), 1, "Time range should exclude older queries")
+        
+        response = requests.get(f"{self.base_url}/api/export/queries", params={"format": "xml"}, timeout=5)
+        self.assert_eq(response.status_code, 400, "Unknown format should be rejected")
+    
+    def test_trace(self):
+        """Test the waterfall of a traced query"""
+        device = "trace-device"
+        start = time.time()
+        events = [
+            ("query_start", {"provider": "traceprov", "model": "m", "trace_id": "t1"}),
+            ("query_complete", {"response_length": 2}),
+            ("trace", {"trace_id": "t1", "spans": [
+                {"trace_id": "t1", "id": 1, "name": "query", "start": start, "duration": 2.0},
+                {"trace_id": "t1", "id": 2, "parent_id": 1, "name": "stream", "start": start + 0.1, "duration": 1.8},
+                {"trace_id": "t1", "id": 3, "parent_id": 2, "name": "connect", "start": start + 0.2, "duration": 0.3},
+            ]}),
+            ("trace", {"trace_id": "t1", "spans": [
+                {"trace_id": "t1", "id": 4, "parent_id": 1, "name": "render", "start": start + 2.1, "duration": 0.4},
+            ]}),
+        ]
+        for seq, (event, data) in enumerate(events, 1):
+            requests.post(f"{self.base_url}/events", json={
+                "event": event, "timestamp": int(start), "device": device, "seq": seq, "data": data
+            }, timeout=2)
+        
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        query_id = stored[-1].get('query_id')
+        self.assert_true(query_id, "Trace event should be linked to its query")
+        
+        response = requests.get(f"{self.base_url}/api/queries/{query_id}/trace", timeout=2)
+        self.assert_eq(response.status_code, 200, "Trace should return 200")
+        trace = response.json()
+        self.assert_eq([s['name'] for s in trace['spans']], ["query", "stream", "connect", "render"],
+                       "Spans should be in tree order")
+        self.assert_eq([s['depth'] for s in trace['spans']], [0, 1, 2, 1], "Spans should have their depth")
+        self.assert_eq(trace['spans'][2]['offset_ms'], 200.0, "Offsets should be relative to the trace")
+        self.assert_eq(trace['duration_ms'], 2500.0, "Duration should cover late spans")
+        
+        response = requests.get(f"{self.base_url}/api/queries/999999/trace", timeout=2)
+        self.assert_eq(response.status_code, 404, "Unknown query should have no trace")
+    
+    def test_render_timings(self):
+        """Test render timings grouped by render mode"""
+        device = "render-device"
+        start = time.time()
+        spans = [
+            {"trace_id": "r1", "id": 1, "name": "render", "start": start, "duration": 0.8,
+             "attrs": {"chars": 5000, "markdown": True}},
+            {"trace_id": "r1", "id": 2, "name": "render", "start": start + 1, "duration": 0.2,
+             "attrs": {"chars": 5000, "markdown": True, "mode": "incremental", "blocks": 20, "parsed": 2,
+                       "parse_ms": 40.0}},
+        ]
+        requests.post(f"{self.base_url}/events", json={
+            "event": "trace", "timestamp": start, "device": device, "seq": 1,
+            "data": {"trace_id": "r1", "spans": spans}
+        }, timeout=2)
+        
+        timings = requests.get(f"{self.base_url}/api/render-timings?since={start}&device={device}", timeout=2).json()['timings']
+        by_mode = {t['mode']: t for t in timings}
+        self.assert_eq(sorted(by_mode), ["full", "incremental"], "Timings should be grouped by mode")
+        self.assert_eq(by_mode['full']['p50_ms'], 800.0, "Full renders should keep their duration")
+        self.assert_eq(by_mode['incremental']['max_chars'], 8000, "Timings should be grouped by size")
+        self.assert_eq(by_mode['incremental']['parsed_blocks'], 0.1, "Share of parsed blocks should be reported")
+    
+    def test_costs(self):
+        """Test token and cost totals per provider, model and book"""
+        device = "cost-device"
+        with open(os.path.join(self.data_dir.name, "prices.json"), "w") as f:
+            json.dump({"costprov/m1": {"prompt": 1.0, "cached": 0.5, "completion": 2.0}}, f)
+        
+        usages = [("m1", {"prompt_tokens": 1000, "completion_tokens": 500, "reasoning_tokens": 100,
+                          "cached_tokens": 200, "total_tokens": 1500}),
+                  ("m2", {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110})]
+        seq = 0
+        for model, usage in usages:
+            for event, data in (("query_start", {"provider": "costprov", "model": model, "book": "Dune"}),
+                                ("query_complete", {"response_length": 0, "usage": usage})):
+                seq += 1
+                requests.post(f"{self.base_url}/events", json={
+                    "event": event, "timestamp": int(time.time()), "device": device, "seq": seq, "data": data
+                }, timeout=2)
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        
+        models = {t['key']: t for t in requests.get(f"{self.base_url}/api/costs?by=model", timeout=2).json()['totals']}
+        self.assert_eq(models['costprov/m1']['cost'], 0.0019, "Cached input should be priced apart")
+        self.assert_eq(models['costprov/m2']['unpriced'], 1, "Models without a price should be counted as unpriced")
+        
+        providers = requests.get(f"{self.base_url}/api/costs?by=provider", timeout=2).json()['totals']
+        provider = next(t for t in providers if t['key'] == "costprov")
+        self.assert_eq((provider['queries'], provider['prompt_tokens'], provider['reasoning_tokens']), (2, 1100, 100),
+                       "Provider totals should add up both queries")
+        books = requests.get(f"{self.base_url}/api/costs?by=book", timeout=2).json()['totals']
+        self.assert_eq(next(t for t in books if t['key'] == "Dune")['queries'], 2, "Costs should be totalled per book")
+        
+        query = requests.get(f"{self.base_url}/api/queries/{stored[0]['query_id']}", timeout=2).json()
+        self.assert_eq((query['cost'], query['cached_tokens']), (0.0019, 200), "Queries should keep their usage")
+        response = requests.get(f"{self.base_url}/api/costs?by=author", timeout=2)
+        self.assert_eq(response.status_code, 400, "Unknown grouping should be rejected")
+    
+    def test_admission(self):
+        """Test load shedding and 429 deferral when a device is over its budget"""
+        device = "flood-device"
+        batch = [{"event": "query_start", "data": {"provider": "floodprov", "model": "m"}}]
+        batch += [{"event": "stream_chunk", "data": {"content": "x"}} for _ in range(500)]
+        batch += [{"event": "heartbeat", "data": {}} for _ in range(50)]
+        batch += [{"event": "query_complete", "data": {}}]
+        for seq, event in enumerate(batch, 1):
+            event.update({"timestamp": int(time.time()), "device": device, "seq": seq})
+        response = requests.post(f"{self.base_url}/events/batch", json={"events": batch}, timeout=5)
+        self.assert_eq(response.status_code, 200, "Batch within budget after shedding should be taken")
+        self.assert_eq(response.json()['handled'], len(batch), "All events should be handled")
+        
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        self.assert_eq([e['event'] for e in stored], ["query_start", "stream_chunk", "query_complete"],
+                       "Chunks should be merged and heartbeats shed")
+        query = requests.get(f"{self.base_url}/api/queries/{stored[-1]['query_id']}", timeout=2).json()
+        self.assert_eq(query['response'], "x" * 500, "Merged chunks should keep the response")
+        self.assert_eq(query['chunks'], 500, "Merged chunks should keep the chunk count")
+        
+        flood = [{"event": "test", "timestamp": int(time.time()), "device": device, "seq": 1000 + i, "data": {}}
+                 for i in range(600)]
+        response = requests.post(f"{self.base_url}/events/batch", json={"events": flood}, timeout=5)
+        self.assert_eq(response.status_code, 429, "Events over budget should be deferred")
+        self.assert_true(int(response.headers['Retry-After']) >= 1, "Deferral should carry Retry-After")
+        handled = response.json()['handled']
+        self.assert_true(0 < handled < len(flood), "Part of the batch should be handled")
+        
+        # Still over budget: the heartbeat is shed, the error borrows a token
+        mixed = [{"event": event, "timestamp": int(time.time()), "device": device, "seq": 2000 + i, "data": {}}
+                 for i, event in enumerate(["heartbeat", "error"] + ["test"] * 200)]
+        response = requests.post(f"{self.base_url}/events/batch", json={"events": mixed}, timeout=5)
+        self.assert_eq(response.status_code, 429, "Batch over budget should be deferred")
+        self.assert_true(response.json()['handled'] >= 2, "Heartbeat and error should be handled")
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        self.assert_in("error", [e['event'] for e in stored], "Critical events should be kept under load")
+        
+        admission = requests.get(f"{self.base_url}/api/stats?device={device}", timeout=2).json()['admission']
+        self.assert_eq(admission['shed'], 51, "Shed events should be counted")
+    
+    def test_restart(self):
+        """Test that events and open queries survive a restart"""
+        device = "restart-device"
+        events = [("query_start", {"provider": "restartprov", "model": "m"}),
+                  ("stream_chunk", {"content": "before "})]
+        for seq, (event, data) in enumerate(events, 1):
+            requests.post(f"{self.base_url}/events", json={
+                "event": event, "timestamp": time.time(), "device": device, "seq": seq, "data": data
+            }, timeout=2)
+        total = requests.get(f"{self.base_url}/health", timeout=2).json()['events_count']
+        
+        # A crash leaves no final snapshot, the tail log is replayed
+        os.killpg(self.server_process.pid, signal.SIGKILL)
+        self.server_process.wait(timeout=5)
+        self.assert_true(self.launch_server(), "Server should come back")
+        
+        self.assert_eq(requests.get(f"{self.base_url}/health", timeout=2).json()['events_count'], total,
+                       "Events should be restored")
+        response = requests.post(f"{self.base_url}/events", json={
+            "event": "stream_chunk", "timestamp": time.time(), "device": device, "seq": 2,
+            "data": {"content": "before "}
+        }, timeout=2)
+        self.assert_eq(response.json()['status'], "duplicate", "Duplicate ids should be restored")
+        for seq, (event, data) in enumerate([("stream_chunk", {"content": "after"}), ("query_complete", {})], 3):
+            requests.post(f"{self.base_url}/events", json={
+                "event": event, "timestamp": time.time(), "device": device, "seq": seq, "data": data
+            }, timeout=2)
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        query = requests.get(f"{self.base_url}/api/queries/{stored[-1]['query_id']}", timeout=2).json()
+        self.assert_eq(query['response'], "before after", "Open query should continue after the restart")
+        
+        # A clean stop writes a final snapshot that covers the whole tail
+        total = requests.get(f"{self.base_url}/health", timeout=2).json()['events_count']
+        self.server_process.send_signal(signal.SIGTERM)
+        self.server_process.wait(timeout=10)
+        data_dir = Path(self.data_dir.name)
+        self.assert_true((data_dir / "state.snapshot").exists(), "Clean stop should write a snapshot")
+        self.assert_true(not (data_dir / "state.tail").exists(), "Final snapshot should cover the tail")
+        self.assert_true(self.launch_server(), "Server should come back after a clean stop")
+        self.assert_eq(requests.get(f"{self.base_url}/health", timeout=2).json()['events_count'], total,
+                       "Events should be restored from the final snapshot")
+    
+    def test_clock_sync(self):
+        """Test clock offset estimation and normalized event times"""
+        device = "skewed-device"
+        skew = -100.0  # device clock runs 100 s behind
+        samples = []
+        for _ in range(3):
+            t0 = time.time() + skew
+            reply = requests.post(f"{self.base_url}/time",
+                                  json={"device": device, "samples": samples}, timeout=2).json()
+            t3 = time.time() + skew
+            samples = [[t0, reply['t1'], reply['t2'], t3]]
+        self.assert_eq(round(reply['estimate']['offset_ms'] / 1000), 100, "Offset should be estimated")
+        
+        sent = time.time()
+        requests.post(f"{self.base_url}/events", json={
+            "event": "heartbeat", "timestamp": sent + skew, "device": device, "seq": 1, "data": {}
+        }, timeout=2)
+        event = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events'][-1]
+        self.assert_true(abs(event['server_time'] - sent) < 0.05, "Event time should be in server time")
+        self.assert_true(0 <= event['transit_ms'] < 1000, "Transit should be measured")
+        
+        clocks = requests.get(f"{self.base_url}/api/clocks", timeout=2).json()['devices']
+        self.assert_in(device, clocks, "Clock estimates should list the device")
+        
+        # Span times moved to server time are the same on the stream as in the store
+        requests.post(f"{self.base_url}/events", json={
+            "event": "trace", "timestamp": sent + skew, "device": device, "seq": 2,
+            "data": {"trace_id": "skewed", "spans": [
+                {"trace_id": "skewed", "id": 1, "name": "query", "start": sent + skew, "duration": 0.1}]}
+        }, timeout=2)
+        stored = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events'][-1]
+        response = requests.get(f"{self.base_url}/stream?device={device}", stream=True, timeout=2)
+        first = next(response.iter_content(chunk_size=None)).decode('utf-8')
+        response.close()
+        streamed = [json.loads(line[6:]) for line in first.split('\n') if line.startswith('data: ')][-1]
+        self.assert_true(abs(stored['data']['spans'][0]['start'] - sent) < 0.05, "Stored spans should be in server time")
+        self.assert_eq(streamed['data']['spans'][0]['start'], stored['data']['spans'][0]['start'],
+                       "Streamed spans should be in server time too")
+    
+    def test_regressions(self):
+        """Test that a slower first chunk for one model raises an alert"""
+        device = "regress-device"
+        samples = []
+        for _ in range(3):
+            t0 = time.time()
+            reply = requests.post(f"{self.base_url}/time", json={"device": device, "samples": samples}, timeout=2).json()
+            samples = [[t0, reply['t1'], reply['t2'], time.time()]]
+        
+        # A baseline three hours ago with a 0.5 s first chunk, then ten minutes at 2 s
+        now = time.time()
+        queries = [(now - 3 * 3600 + i * 60, 0.5) for i in range(40)]
+        queries += [(now - 600 + i * 30, 2.0) for i in range(12)]
+        batch = []
+        for started, first_chunk in queries:
+            batch += [
+                {"event": "query_start", "timestamp": started, "data": {"provider": "regprov", "model": "m"}},
+                {"event": "stream_chunk", "timestamp": started + first_chunk, "data": {"content": "x"}},
+                {"event": "query_complete", "timestamp": started + first_chunk + 0.1, "data": {}},
+            ]
+        for seq, event in enumerate(batch, 1):
+            event.update({"device": device, "seq": seq})
+        response = requests.post(f"{self.base_url}/events/batch", json={"events": batch}, timeout=5)
+        self.assert_eq(response.status_code, 200, "Batch should be taken")
+        
+        alerts = requests.get(f"{self.base_url}/api/alerts?status=active", timeout=2).json()['alerts']
+        alert = next((a for a in alerts if a['provider'] == "regprov" and a['metric'] == "first_chunk"), None)
+        self.assert_true(alert is not None, "Slower first chunks should raise an alert")
+        self.assert_true(alert['ratio'] >= 2 and alert['p_value'] < 0.01, "Alert should be significant")
+        events = requests.get(f"{self.base_url}/api/events?device={device}", timeout=2).json()['events']
+        self.assert_in("regression", [e['event'] for e in events], "Alert should go out on the stream")
+    
     def run_all(self):
         """Run all tests"""
         print("\n" + "=" * 60)
@@ -284,6 +775,20 @@ class TestRunner:
             ("Can get statistics", self.test_get_stats),
             ("Can clear events", self.test_clear_events),
             ("Full query flow works", self.test_full_query_flow),
+            ("Can search past queries", self.test_search),
+            ("Compressed transport works", self.test_compressed_transport),
+            ("MessagePack transport works", self.test_msgpack_transport),
+            ("Spooled events catch up in batches", self.test_batch_catch_up),
+            ("Devices are kept apart", self.test_multiple_devices),
+            ("Completed queries are rolled up", self.test_rollups),
+            ("Can export queries and events", self.test_export),
+            ("Traced queries have a waterfall", self.test_trace),
+            ("Device clocks are synchronized", self.test_clock_sync),
+            ("Render timings are grouped by mode", self.test_render_timings),
+            ("Token usage and costs are totalled", self.test_costs),
+            ("Devices over budget are shed and deferred", self.test_admission),
+            ("Latency regressions raise alerts", self.test_regressions),
+            ("State survives a restart", self.test_restart),
         ]
         
         for name, func in tests: